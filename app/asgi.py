@@ -0,0 +1,229 @@
+"""Asynchronous prediction module"""
+
+import os
+import uuid
+import asyncio
+import contextlib
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import jinja2
+import aiohttp
+import predict
+import prometheus_client
+from sink import AsyncMonitoringSink
+from predict import PREDICTIONS, PREDICTION_STAGES
+from starlette.routing import Mount, Route
+from starlette.responses import Response, HTMLResponse
+from starlette.staticfiles import StaticFiles
+from starlette.applications import Starlette
+
+# The model calls are CPU-bound, they run in a bounded pool of threads so that
+# the event loop keeps serving the other connections
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", str(os.cpu_count() or 1)))
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+model_executor = ThreadPoolExecutor(MODEL_WORKERS, thread_name_prefix="model")
+# The monitoring sink flushes one batch at a time, a single thread runs the
+# synchronous Mongo writes while serving. An async driver such as Motor would
+# work with the pinned pymongo as well, but one bulk insert per batch does not
+# need it and predict.save_to_db stays shared with the Flask app
+database_executor = None
+http_session = None
+
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(APP_DIR, "templates")),
+    autoescape=True,
+)
+
+
+async def send_to_evidently_service(records):
+    """
+    Sends a batch of prediction data to the Evidently monitoring service
+    """
+    with PREDICTION_STAGES["evidently"].time():
+        async with http_session.post(
+            f"{predict.EVIDENTLY_SERVICE_URI}/iterate/maternal-health-risk",
+            json=predict.evidently_rows(records),
+        ) as response:
+            response.raise_for_status()
+
+
+async def save_to_db(records):
+    """
+    Saves a batch of prediction data to the Mongo database, the synchronous
+    client runs in the database thread
+    """
+    await asyncio.get_running_loop().run_in_executor(
+        database_executor, predict.save_to_db, records
+    )
+
+
+monitoring_sink = AsyncMonitoringSink(
+    [send_to_evidently_service, save_to_db],
+    batch_size=predict.MONITORING_BATCH_SIZE,
+    flush_interval=predict.MONITORING_FLUSH_INTERVAL,
+    queue_size=predict.MONITORING_QUEUE_SIZE,
+    block=predict.MONITORING_BACKPRESSURE,
+    counter=predict.MONITORING_RECORDS,
+)
+
+
+async def calculate_risk(record, request_id=None):
+    """
+    Calculates the maternal health risk
+    """
+    loop = asyncio.get_running_loop()
+    # The model may be swapped while predicting
+    loaded_model = predict.current_model
+    with PREDICTION_STAGES["predict"].time():
+        pred = await loop.run_in_executor(
+            model_executor, predict.predict, record, loaded_model
+        )
+    with PREDICTION_STAGES["convert"].time():
+        risk, category = predict.convert_risk(pred)
+    PREDICTIONS.labels(risk_level=risk).inc()
+    if predict.MONITORING_ENABLED:
+        with PREDICTION_STAGES["enqueue"].time():
+            await monitoring_sink.submit(
+                predict.log_record(record, risk, request_id, loaded_model)
+            )
+    return risk, category
+
+
+def make_response(content, status_code=200, media_type="application/json"):
+    """
+    Creates a response reporting the version of the model serving the
+    predictions
+    """
+    headers = {}
+    if predict.current_model.version is not None:
+        headers["X-Model-Version"] = predict.current_model.version
+    return Response(content, status_code, headers, media_type)
+
+
+def get_request_id(request):
+    """
+    Returns the id of a request, forwarded by the client in the X-Request-ID
+    header or generated
+    """
+    return request.headers.get("X-Request-ID") or uuid.uuid4().hex
+
+
+def url_for(endpoint, filename=None):
+    """
+    Resolves the Flask endpoints used by the form template
+    """
+    if endpoint == "static":
+        return f"/static/{filename}"
+    return "/"
+
+
+async def predict_form_endpoint(request):
+    """
+    Prediction form endpoint
+    """
+    messages = []
+    if request.method == "POST":
+        form = parse_qs((await request.body()).decode())
+        record = {}
+        record["Age"] = int(form["Age"][0])
+        record["SystolicBP"] = int(form["SystolicBP"][0])
+        record["DiastolicBP"] = int(form["DiastolicBP"][0])
+        record["BS"] = float(form["BS"][0])
+        record["BodyTemp"] = float(form["BodyTemp"][0])
+        record["HeartRate"] = int(form["HeartRate"][0])
+
+        error_message = predict.validate_record(record)
+        if error_message:
+            messages.append(("info", error_message))
+        else:
+            risk, category = await calculate_risk(record, get_request_id(request))
+            messages.append((category, risk.capitalize()))
+
+    html = templates.get_template("index.html").render(
+        url_for=url_for,
+        get_flashed_messages=lambda with_categories=False: messages,
+    )
+    return make_response(html, media_type=HTMLResponse.media_type)
+
+
+async def predict_json_endpoint(request):
+    """
+    Prediction API endpoint
+    """
+    body = await request.body()
+    with PREDICTION_STAGES["parse"].time():
+        record = predict.decode_record(body)
+
+    error_message = predict.validate_record(record)
+    if error_message:
+        return make_response(predict.ERROR_RESPONSES[error_message])
+
+    risk, _ = await calculate_risk(record, get_request_id(request))
+    return make_response(predict.RISK_RESPONSES[risk])
+
+
+async def predict_batch_json_endpoint(request):
+    """
+    Batch prediction API endpoint
+    """
+    body = await request.body()
+    with PREDICTION_STAGES["batch_parse"].time():
+        try:
+            records = predict.json_loads(body)
+        except ValueError:
+            records = None
+
+    if not isinstance(records, list):
+        error = {"Error": "A list of records should be provided."}
+        return make_response(predict.encode_response(error), 400)
+    if len(records) > predict.MAX_BATCH_SIZE:
+        error = {"Error": f"At most {predict.MAX_BATCH_SIZE} records can be provided."}
+        return make_response(predict.encode_response(error), 413)
+
+    loop = asyncio.get_running_loop()
+    results, monitored = await loop.run_in_executor(
+        model_executor, predict.score_batch, records, get_request_id(request)
+    )
+    if predict.MONITORING_ENABLED and monitored:
+        with PREDICTION_STAGES["batch_enqueue"].time():
+            await monitoring_sink.submit_many(monitored)
+    return make_response(predict.encode_response(results))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    """
+    Warms up the model and runs the monitoring writer while serving
+    """
+    global http_session, database_executor  # pylint: disable=global-statement
+    predict.warm_up()
+    if predict.MLFLOW_ENABLED and predict.MODEL_POLL_INTERVAL > 0:
+        predict.start_model_watcher()
+    http_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=predict.EVIDENTLY_TIMEOUT)
+    )
+    database_executor = ThreadPoolExecutor(1, thread_name_prefix="database")
+    monitoring_sink.start()
+    try:
+        yield
+    finally:
+        await monitoring_sink.close()
+        await http_session.close()
+        database_executor.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route("/", predict_form_endpoint, methods=["GET", "POST"]),
+        Route("/predict", predict_json_endpoint, methods=["POST"]),
+        Route("/predict/batch", predict_batch_json_endpoint, methods=["POST"]),
+        Mount(
+            "/metrics",
+            app=prometheus_client.make_asgi_app(predict.metrics_registry()),
+        ),
+        Mount("/static", app=StaticFiles(directory=os.path.join(APP_DIR, "static"))),
+    ],
+    lifespan=lifespan,
+)
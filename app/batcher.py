@@ -0,0 +1,100 @@
+"""Prediction micro-batching module"""
+
+import os
+import threading
+import collections
+from time import monotonic
+
+import numpy as np
+
+
+class _PendingPrediction:  # pylint: disable=too-few-public-methods
+    __slots__ = ("row", "loaded_model", "arrival", "done", "result", "error")
+
+    def __init__(self, row, loaded_model):
+        self.row = row
+        self.loaded_model = loaded_model
+        self.arrival = monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:  # pylint: disable=too-few-public-methods
+    """
+    Coalesces the single-record predictions of concurrent threads into
+    vectorized model calls, a batch is run once it holds max_batch_size
+    records or its first record has waited max_latency seconds
+    """
+
+    def __init__(
+        self, predict_batch, max_batch_size=64, max_latency=0.002, histogram=None
+    ):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.histogram = histogram
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._pid = None
+
+    def predict(self, row, loaded_model):
+        """
+        Predicts the risk value of a feature row with the given model,
+        blocking until its batch has been run
+        """
+        pending = _PendingPrediction(row, loaded_model)
+        with self._condition:
+            # The batching thread does not survive a fork, so forked workers
+            # start their own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._run, name="micro-batcher", daemon=True
+                ).start()
+            self._pending.append(pending)
+            if len(self._pending) in (1, self.max_batch_size):
+                self._condition.notify()
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = self._pending[0].arrival + self.max_latency
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = [
+                    self._pending.popleft()
+                    for _ in range(min(len(self._pending), self.max_batch_size))
+                ]
+            # The next batch is collected while this one runs
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # A batch is split in the rare case of a model swap
+        groups = collections.defaultdict(list)
+        for pending in batch:
+            groups[id(pending.loaded_model)].append(pending)
+
+        for group in groups.values():
+            if self.histogram is not None:
+                self.histogram.observe(len(group))
+            try:
+                data = np.array([pending.row for pending in group], dtype=float)
+                preds = self.predict_batch(data, group[0].loaded_model)
+                for pending, pred in zip(group, preds):
+                    pending.result = pred
+            except Exception as error:  # pylint: disable=broad-except
+                for pending in group:
+                    pending.error = error
+            for pending in group:
+                pending.done.set()
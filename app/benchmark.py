@@ -0,0 +1,256 @@
+"""Inference benchmark module"""
+
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+# The benchmarks run without the registry and the monitoring services, and
+# without the prediction cache unless asked
+os.environ["MLFLOW_ENABLED"] = "False"
+os.environ["MONITORING_ENABLED"] = "False"
+if "--cache" not in sys.argv:
+    os.environ["PREDICTION_CACHE_SIZE"] = "0"
+
+# pylint: disable=wrong-import-position
+import numpy as np
+import pandas as pd
+import predict
+import sklearn
+import xgboost
+from compiled import TreeEnsemble, flatten_model
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+DATA_FILE = f"{os.path.dirname(os.path.abspath(__file__))}/../data/data.csv"
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+RISK_LEVELS = {"high risk": 0, "low risk": 1, "mid risk": 2}
+
+
+def read_records(filename):
+    """
+    Reads the valid records of a dataset shaped like data/data.csv
+    """
+    records, labels = [], []
+    with open(filename, encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            record = {feature: float(row[feature]) for feature in predict.FEATURES}
+            record["BodyTemp"] = round((record["BodyTemp"] - 32) * 5 / 9, 1)
+            if predict.validate_data(record) is None:
+                records.append(record)
+                labels.append(RISK_LEVELS[row["RiskLevel"]])
+    return records, np.array(labels)
+
+
+def load_models(records, labels):
+    """
+    Returns the default XGBoost model and a random forest pipeline trained on
+    the records, each with the native and the compiled inference engines
+    """
+    xgboost_model = predict.load_default_model()
+    xgboost_compiled = predict.load_compiled_model(xgboost_model)
+    if xgboost_compiled is None:
+        xgboost_compiled = TreeEnsemble(flatten_model(xgboost_model))
+
+    data = pd.DataFrame(predict.records_to_array(records), columns=predict.FEATURES)
+    sklearn_model = make_pipeline(
+        StandardScaler(), RandomForestClassifier(max_depth=5, random_state=1)
+    )
+    sklearn_model.fit(data, labels)
+    sklearn_compiled = TreeEnsemble(flatten_model(sklearn_model))
+    return {
+        "xgboost/native": predict.LoadedModel(xgboost_model, None, "xgboost"),
+        "xgboost/compiled": predict.LoadedModel(
+            xgboost_model, xgboost_compiled, "xgboost"
+        ),
+        "sklearn/native": predict.LoadedModel(sklearn_model, None, "sklearn"),
+        "sklearn/compiled": predict.LoadedModel(
+            sklearn_model, sklearn_compiled, "sklearn"
+        ),
+    }
+
+
+def measure(function, repeat):
+    """
+    Runs a function several times, returns the median and the minimum time
+    """
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), min(timings)
+
+
+def benchmark_cases(records, client):
+    """
+    Returns the benchmarked functions of a batch of records, by name
+    """
+    data = predict.records_to_array(records)
+    preds = predict.predict_batch(data).tolist()
+
+    def loop(function, items):
+        return lambda: [function(item) for item in items]
+
+    return {
+        "validate_data": loop(predict.validate_data, records),
+        "predict": loop(predict.predict, records),
+        "convert_risk": loop(predict.convert_risk, preds),
+        "calculate_risk": loop(predict.calculate_risk, records),
+        "endpoint": loop(lambda record: client.post("/predict", json=record), records),
+        "validate_batch": lambda: predict.validate_batch(data),
+        "predict_batch": lambda: predict.predict_batch(data),
+        "batch_endpoint": lambda: client.post("/predict/batch", json=records),
+    }
+
+
+def run_benchmarks(args):
+    """
+    Runs the benchmarks of each model and batch size
+    """
+    records, labels = read_records(args.data)
+    models = load_models(records, labels)
+    client = predict.app.test_client()
+    results = {}
+
+    for model_name, loaded_model in models.items():
+        predict.set_model(loaded_model)
+        for batch_size in args.batch_sizes:
+            batch = [records[i % len(records)] for i in range(batch_size)]
+            for case, function in benchmark_cases(batch, client).items():
+                key = f"{model_name}/{case}/{batch_size}"
+                # The per-record predictions are slow on the native engines
+                if (
+                    model_name.endswith("native")
+                    and batch_size > args.max_loop_size
+                    and case in ("predict", "calculate_risk", "endpoint")
+                ):
+                    print(f"{key:45} {'skipped':>12}")
+                    continue
+                median, minimum = measure(function, args.repeat)
+                results[key] = {
+                    "seconds": median,
+                    "min_seconds": minimum,
+                    "us_per_record": median / batch_size * 1e6,
+                }
+                print(f"{key:45} {median / batch_size * 1e6:12.1f} us/record")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the ratio to the baseline of each benchmark, returns the keys of
+    the benchmarks slower than the threshold ratio
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[key]["seconds"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "REGRESSION"
+        print(f"{key:45} {ratio:6.2f}x {flag}")
+    return regressions
+
+
+def compare_engines(results, threshold):
+    """
+    Prints the ratio of the batch predictions of the models with compiled
+    tables to those of the native models, returns the keys of the benchmarks
+    slower than the threshold ratio. The larger batches run on the native
+    engine either way and are not compared
+    """
+    regressions = []
+    for key, result in results.items():
+        model_name, engine, case, batch_size = key.split("/")
+        native = results.get(f"{model_name}/native/{case}/{batch_size}")
+        if (
+            engine != "compiled"
+            or case != "predict_batch"
+            or int(batch_size) > predict.COMPILED_MODEL_MAX_ROWS
+            or native is None
+        ):
+            continue
+        # The minimum is less noisy than the median on the large batches
+        ratio = result["min_seconds"] / native["min_seconds"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "REGRESSION"
+        print(f"{key:45} {ratio:6.2f}x native {flag}")
+    return regressions
+
+
+def parse_args():
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-loop-size",
+        type=int,
+        default=100,
+        help="largest batch of per-record predictions on the native engines",
+    )
+    parser.add_argument(
+        "--cache", action="store_true", help="enable the prediction cache"
+    )
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--baseline", help="JSON results file to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="time ratio to the baseline, or to the native engine, reported as a "
+        "regression",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmarks, saves and compares their results
+    """
+    args = parse_args()
+    results = run_benchmarks(args)
+    report = {
+        "metadata": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "xgboost": xgboost.__version__,
+            "scikit-learn": sklearn.__version__,
+            "cache": args.cache,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+    regressions = compare_engines(results, args.threshold)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions += compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmarks slower than {args.threshold}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
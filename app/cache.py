@@ -0,0 +1,85 @@
+"""Prediction cache module"""
+
+import threading
+import collections
+from time import monotonic
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache with an optional time-to-live, counting hits, misses
+    and evictions (LRU evictions and expirations)
+    """
+
+    def __init__(self, max_size, ttl=None, counter=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counter = counter
+        self._events = collections.Counter()
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hits(self):
+        """
+        Number of cache hits
+        """
+        return self._events["hit"]
+
+    @property
+    def misses(self):
+        """
+        Number of cache misses
+        """
+        return self._events["miss"]
+
+    @property
+    def evictions(self):
+        """
+        Number of LRU evictions and expirations
+        """
+        return self._events["eviction"]
+
+    def get(self, key):
+        """
+        Returns the cached value of a key or None
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] < monotonic():
+                del self._data[key]
+                self._count("eviction")
+                item = None
+            if item is None:
+                self._count("miss")
+                return None
+            self._data.move_to_end(key)
+            self._count("hit")
+            return item[0]
+
+    def put(self, key, value):
+        """
+        Caches the value of a key, evicting the least recently used keys
+        """
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._count("eviction")
+
+    def clear(self):
+        """
+        Removes all the cached values
+        """
+        with self._lock:
+            self._data.clear()
+
+    def _count(self, event):
+        self._events[event] += 1
+        if self.counter is not None:
+            self.counter.labels(event=event).inc()
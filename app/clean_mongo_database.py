@@ -1,12 +1,223 @@
 """Prediction database cleaning module"""
 
 import os
+import time
+import argparse
+import datetime
+import collections
 
+import numpy as np
 from pymongo import MongoClient
 
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 MONGO_DATABASE = "prediction_service"
+EXPERIMENT_NAME = os.getenv("EXPERIMENT_NAME", "maternal-health-risk")
+ROLLUP_COLLECTION = f"{EXPERIMENT_NAME}-hourly"
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "30"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", "0.1"))
+
+HOUR = datetime.timedelta(hours=1)
+# Fixed bins over the valid range of each feature, so that the histograms of
+# any hours can be summed
+FEATURE_BINS = {
+    "Age": np.linspace(13, 50, 38),
+    "SystolicBP": np.linspace(50, 200, 31),
+    "DiastolicBP": np.linspace(50, 200, 31),
+    "BS": np.linspace(0, 15, 31),
+    "BodyTemp": np.linspace(34, 41, 36),
+    "HeartRate": np.linspace(45, 130, 35),
+}
+
+
+class HourlyRollup:
+    """
+    Accumulates the count, mean, histogram and risk levels of the
+    predictions of an hour
+    """
+
+    def __init__(self, hour):
+        self.hour = hour
+        self.count = 0
+        self.sums = collections.Counter()
+        self.counts = collections.Counter()
+        self.histograms = {
+            feature: np.zeros(len(bins) - 1, dtype=int)
+            for feature, bins in FEATURE_BINS.items()
+        }
+        self.risk_levels = collections.Counter()
+        self.model_versions = collections.Counter()
+
+    def add(self, documents):
+        """
+        Adds a batch of prediction log documents
+        """
+        self.count += len(documents)
+        for feature, bins in FEATURE_BINS.items():
+            values = np.array(
+                [document.get(feature) for document in documents], dtype=float
+            )
+            values = values[np.isfinite(values)]
+            self.sums[feature] += float(values.sum())
+            self.counts[feature] += len(values)
+            # Values out of the bins are counted in the first or last bin
+            self.histograms[feature] += np.histogram(
+                np.clip(values, bins[0], bins[-1]), bins
+            )[0]
+        self.risk_levels.update(document.get("RiskLevel") for document in documents)
+        self.model_versions.update(
+            str(document.get("model_version")) for document in documents
+        )
+
+    def to_document(self):
+        """
+        Returns the rollup document, identified by its hour
+        """
+        return {
+            "_id": self.hour,
+            "count": self.count,
+            "features": {
+                feature: {
+                    "count": self.counts[feature],
+                    "sum": self.sums[feature],
+                    "mean": self.sums[feature] / self.counts[feature]
+                    if self.counts[feature]
+                    else None,
+                    "bins": bins.tolist(),
+                    "histogram": self.histograms[feature].tolist(),
+                }
+                for feature, bins in FEATURE_BINS.items()
+            },
+            "risk_levels": {
+                str(risk): count for risk, count in self.risk_levels.items()
+            },
+            "model_versions": dict(self.model_versions),
+        }
+
+
+def backfill_timestamps(collection):
+    """
+    Sets the timestamp of the predictions logged without one to their
+    insertion time, in small batches like the deletes
+    """
+    backfilled = 0
+    while True:
+        ids = [
+            document["_id"]
+            for document in collection.find(
+                {"timestamp": {"$exists": False}},
+                projection={"_id": True},
+                limit=RETENTION_BATCH_SIZE,
+            )
+        ]
+        if not ids:
+            break
+        backfilled += collection.update_many(
+            {"_id": {"$in": ids}},
+            [{"$set": {"timestamp": {"$toDate": "$_id"}}}],
+        ).modified_count
+        time.sleep(RETENTION_PAUSE)
+    if backfilled:
+        print(f"Backfilled the timestamp of {backfilled} predictions")
+
+
+def roll_up_hour(collection, rollups, hour):
+    """
+    Stores the rollup of the predictions of an hour, unless a previous run
+    already did, as it is written once all the predictions are aggregated
+    """
+    if rollups.find_one({"_id": hour}, projection={"_id": True}) is not None:
+        return
+
+    rollup = HourlyRollup(hour)
+    cursor = collection.find(
+        {"timestamp": {"$gte": hour, "$lt": hour + HOUR}},
+        projection={"_id": False, "timestamp": False, "request_id": False},
+        batch_size=RETENTION_BATCH_SIZE,
+    )
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == RETENTION_BATCH_SIZE:
+            rollup.add(batch)
+            batch = []
+    if batch:
+        rollup.add(batch)
+    rollups.insert_one(rollup.to_document())
+
+
+def delete_hour(collection, hour):
+    """
+    Deletes the predictions of an hour in small batches, so that no
+    operation holds the collection for long
+    """
+    deleted = 0
+    while True:
+        ids = [
+            document["_id"]
+            for document in collection.find(
+                {"timestamp": {"$gte": hour, "$lt": hour + HOUR}},
+                projection={"_id": True},
+                limit=RETENTION_BATCH_SIZE,
+            )
+        ]
+        if not ids:
+            return deleted
+        deleted += collection.delete_many({"_id": {"$in": ids}}).deleted_count
+        time.sleep(RETENTION_PAUSE)
+
+
+def apply_retention(database, days):
+    """
+    Rolls up into hourly aggregates, then deletes, the predictions older
+    than a number of days, hour by hour
+    """
+    collection = database.get_collection(EXPERIMENT_NAME)
+    rollups = database.get_collection(ROLLUP_COLLECTION)
+    backfill_timestamps(collection)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(days=days)
+    # Only whole hours are rolled up
+    cutoff = cutoff.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+    while True:
+        oldest = collection.find_one(
+            {"timestamp": {"$lt": cutoff}},
+            projection={"timestamp": True},
+            sort=[("timestamp", 1)],
+        )
+        if oldest is None:
+            break
+        hour = oldest["timestamp"].replace(minute=0, second=0, microsecond=0)
+        roll_up_hour(collection, rollups, hour)
+        deleted = delete_hour(collection, hour)
+        print(f"Rolled up and deleted {deleted} predictions of {hour:%Y-%m-%d %H:00}")
+
+
+def parse_args():
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=RETENTION_DAYS,
+        help="age in days of the predictions rolled up and deleted",
+    )
+    parser.add_argument(
+        "--drop",
+        action="store_true",
+        help="drop the whole prediction database instead",
+    )
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
+    args = parse_args()
     client = MongoClient(MONGODB_URI)
-    client.drop_database(MONGO_DATABASE)
+    if args.drop:
+        client.drop_database(MONGO_DATABASE)
+    else:
+        apply_retention(client.get_database(MONGO_DATABASE), args.days)
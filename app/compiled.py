@@ -0,0 +1,257 @@
+"""Compiled tree-ensemble model module"""
+
+import os
+import json
+
+import numpy as np
+
+
+class TreeEnsemble:
+    """
+    Evaluates a tree-ensemble model flattened into node tables (see
+    flatten_model) with NumPy only
+    """
+
+    def __init__(self, tables, features=None):
+        self.feature_names = [str(name) for name in tables["feature_names"]]
+        if features is not None and self.feature_names != list(features):
+            raise ValueError(f"Unexpected features {self.feature_names}")
+        self.kind = str(tables["kind"])
+        self.run_id = str(tables["run_id"]) if "run_id" in tables else None
+        self.depth = int(tables["depth"])
+        n_features = len(self.feature_names)
+        self.tables = {
+            "base_score": np.zeros(1),
+            "scale_mean": np.zeros(n_features),
+            "scale_scale": np.ones(n_features),
+            **tables,
+        }
+
+    @classmethod
+    def load(cls, filename, features=None):
+        """
+        Loads the node tables from a npz file
+        """
+        with np.load(filename) as tables:
+            return cls({key: tables[key] for key in tables.files}, features)
+
+    def predict(self, data):
+        """
+        Predicts the numerical risk of each row of a feature matrix
+        """
+        tables = self.tables
+        feature, threshold = tables["feature"], tables["threshold"]
+        left, right = tables["left"], tables["right"]
+        # Both XGBoost and scikit-learn compare single precision features
+        x = ((data - tables["scale_mean"]) / tables["scale_scale"]).astype(np.float32)
+        rows = np.arange(len(x))[:, None]
+        nodes = np.broadcast_to(tables["roots"], (len(x), len(tables["roots"])))
+        # Leaves point to themselves, so every row can take depth steps
+        for _ in range(self.depth):
+            values = x[rows, feature[nodes]]
+            if self.kind == "xgboost":
+                go_left = values < threshold[nodes]
+            else:
+                go_left = values <= threshold[nodes]
+            go_left |= np.isnan(values) & tables["missing_left"][nodes]
+            nodes = np.where(go_left, left[nodes], right[nodes])
+
+        leaves = tables["value"][nodes]
+        if self.kind == "xgboost":
+            return tables["base_score"][0] + leaves[:, :, 0].sum(axis=1)
+        return tables["classes"][leaves.mean(axis=1).argmax(axis=1)]
+
+
+def load_tree_ensemble(run_id, default_file, features, download=False):
+    """
+    Loads the node tables exported for the run of a model, from the default
+    file when they were exported for the same run, or else downloaded from
+    the run artifacts, returns None if they are not available
+    """
+    try:
+        if os.path.exists(default_file):
+            compiled = TreeEnsemble.load(default_file, features)
+            if compiled.run_id == run_id:
+                print("Loaded default compiled model from disk")
+                return compiled
+
+        if download:
+            # pylint: disable-next=import-outside-toplevel
+            from mlflow.artifacts import download_artifacts
+
+            filename = download_artifacts(
+                run_id=run_id, artifact_path="compiled/model.npz"
+            )
+            compiled = TreeEnsemble.load(filename, features)
+            print("Loaded compiled model from S3 Bucket")
+            return compiled
+    except:
+        pass
+
+    print("Compiled model not available")
+    return None
+
+
+def tree_depth(left, right):
+    """
+    Computes the maximum depth of a tree given its children arrays
+    """
+    depth = 0
+    stack = [(0, 0)]
+    while stack:
+        node, node_depth = stack.pop()
+        if left[node] == -1:
+            depth = max(depth, node_depth)
+        else:
+            stack.append((left[node], node_depth + 1))
+            stack.append((right[node], node_depth + 1))
+    return depth
+
+
+def flatten_trees(trees):
+    """
+    Concatenates per-tree node arrays into global node tables,
+    leaves point to themselves so that they absorb further traversal steps
+    """
+    tables = {key: [] for key in ["feature", "threshold", "left", "right"]}
+    tables.update({"missing_left": [], "value": [], "roots": []})
+    offset = 0
+    depth = 0
+    for tree in trees:
+        nodes = np.arange(len(tree["left"]))
+        leaf = tree["left"] == -1
+        tables["feature"].append(np.where(leaf, 0, tree["feature"]))
+        tables["threshold"].append(np.where(leaf, 0, tree["threshold"]))
+        tables["left"].append(np.where(leaf, nodes, tree["left"]) + offset)
+        tables["right"].append(np.where(leaf, nodes, tree["right"]) + offset)
+        tables["missing_left"].append(tree["missing_left"])
+        tables["value"].append(tree["value"])
+        tables["roots"].append([offset])
+        depth = max(depth, tree_depth(tree["left"], tree["right"]))
+        offset += len(nodes)
+
+    return {
+        "feature": np.concatenate(tables["feature"]).astype(np.int32),
+        "threshold": np.concatenate(tables["threshold"]).astype(np.float64),
+        "left": np.concatenate(tables["left"]).astype(np.int32),
+        "right": np.concatenate(tables["right"]).astype(np.int32),
+        "missing_left": np.concatenate(tables["missing_left"]).astype(bool),
+        "value": np.concatenate(tables["value"]).astype(np.float64),
+        "roots": np.concatenate(tables["roots"]).astype(np.int32),
+        "depth": np.int32(depth),
+    }
+
+
+def flatten_xgboost(booster):
+    """
+    Flattens an XGBoost regression booster into node tables
+    """
+    model = json.loads(booster.save_raw(raw_format="json"))
+    learner = model["learner"]
+    objective = learner["objective"]["name"]
+    if objective not in ("reg:squarederror", "reg:linear"):
+        raise ValueError(f"Unsupported XGBoost objective {objective}")
+    if learner["gradient_booster"]["name"] != "gbtree":
+        raise ValueError("Only gbtree boosters can be flattened")
+
+    trees = []
+    for tree in learner["gradient_booster"]["model"]["trees"]:
+        left = np.array(tree["left_children"])
+        # Leaf values are stored in the split conditions of leaf nodes
+        conditions = np.array(tree["split_conditions"], dtype=np.float32)
+        trees.append(
+            {
+                "feature": np.array(tree["split_indices"]),
+                "threshold": conditions,
+                "left": left,
+                "right": np.array(tree["right_children"]),
+                "missing_left": np.array(tree["default_left"], dtype=bool),
+                "value": np.where(left == -1, conditions, 0).reshape(-1, 1),
+            }
+        )
+
+    tables = flatten_trees(trees)
+    tables["kind"] = np.array("xgboost")
+    tables["base_score"] = np.array(
+        [float(learner["learner_model_param"]["base_score"].strip("[]"))]
+    )
+    tables["feature_names"] = np.array(booster.feature_names)
+    return tables
+
+
+def flatten_sklearn_pipeline(pipeline):
+    """
+    Flattens a random forest pipeline, with optional standard scaler,
+    into node tables
+    """
+    # pylint: disable=import-outside-toplevel
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.preprocessing import StandardScaler
+
+    steps = [step for _, step in getattr(pipeline, "steps", [(None, pipeline)])]
+    *transformers, forest = steps
+    if not isinstance(forest, RandomForestClassifier):
+        raise ValueError(f"Unsupported model {type(forest).__name__}")
+
+    n_features = forest.n_features_in_
+    scale_mean = np.zeros(n_features)
+    scale_scale = np.ones(n_features)
+    for transformer in transformers:
+        if not isinstance(transformer, StandardScaler):
+            raise ValueError(f"Unsupported transformer {type(transformer).__name__}")
+        if transformer.mean_ is not None:
+            scale_mean = transformer.mean_
+        if transformer.scale_ is not None:
+            scale_scale = transformer.scale_
+
+    trees = []
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        value = tree.value[:, 0, :]
+        trees.append(
+            {
+                "feature": tree.feature,
+                "threshold": tree.threshold,
+                "left": tree.children_left,
+                "right": tree.children_right,
+                "missing_left": getattr(
+                    tree, "missing_go_to_left", np.ones(tree.node_count)
+                ),
+                "value": value / value.sum(axis=1, keepdims=True),
+            }
+        )
+
+    tables = flatten_trees(trees)
+    tables["kind"] = np.array("random_forest")
+    tables["classes"] = forest.classes_.astype(np.float64)
+    tables["scale_mean"] = np.asarray(scale_mean, dtype=np.float64)
+    tables["scale_scale"] = np.asarray(scale_scale, dtype=np.float64)
+    tables["feature_names"] = np.array(
+        getattr(pipeline, "feature_names_in_", [f"f{i}" for i in range(n_features)])
+    )
+    return tables
+
+
+def flatten_model(model):
+    """
+    Flattens an MLflow pyfunc, XGBoost booster or scikit-learn pipeline
+    into node tables
+    """
+    import xgboost as xgb  # pylint: disable=import-outside-toplevel
+
+    # Unwrap the pyfunc and the MLflow XGBoost wrapper
+    model = getattr(model, "_model_impl", model)
+    model = getattr(model, "xgb_model", model)
+    if isinstance(model, xgb.Booster):
+        return flatten_xgboost(model)
+    return flatten_sklearn_pipeline(model)
+
+
+def export_model_tables(model, filename, run_id=None):
+    """
+    Saves the node tables of a tree-ensemble model to a npz file
+    """
+    tables = flatten_model(model)
+    if run_id is not None:
+        tables["run_id"] = np.array(run_id)
+    np.savez_compressed(filename, **tables)
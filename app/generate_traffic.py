@@ -2,9 +2,12 @@
 
 import json
 import time
-import random
+import asyncio
+import argparse
+import itertools
 
-import requests
+import numpy as np
+import aiohttp
 
 URL = "http://127.0.0.1:8081/predict"
 
@@ -22,40 +25,238 @@ BODY_TEMP_STD = 0.7
 HEART_RATE_MEAN = 74.3
 HEART_RATE_STD = 8.1
 
+FEATURES = ["Age", "SystolicBP", "DiastolicBP", "BS", "BodyTemp", "HeartRate"]
+MEANS = np.array(
+    [
+        AGE_MEAN,
+        SYSTOLIC_BP_MEAN,
+        DIASTOLIC_BP_MEAN,
+        BS_MEAN,
+        BODY_TEMP_MEAN,
+        HEART_RATE_MEAN,
+    ]
+)
+STDS = np.array(
+    [AGE_STD, SYSTOLIC_BP_STD, DIASTOLIC_BP_STD, BS_STD, BODY_TEMP_STD, HEART_RATE_STD]
+)
+# Distinct payloads, cycled through during the run
+PAYLOADS_COUNT = 10000
+# Latency histogram from 10 us to 100 s, the buckets are about 5% wide
+LATENCY_MIN = 1e-5
+LATENCY_DECADES = 7
+LATENCY_BUCKETS_PER_DECADE = 50
 
-def generate_traffic():
-    """
-    Sends continuous requests to prediction API
-    """
-
-    headers = {"Content-Type": "application/json"}
-
-    while True:
-        test_data = {
-            "Age": random.uniform(AGE_MEAN - 2 * AGE_STD, AGE_MEAN + 2 * AGE_STD),
-            "SystolicBP": random.uniform(
-                SYSTOLIC_BP_MEAN - 2 * SYSTOLIC_BP_STD,
-                SYSTOLIC_BP_MEAN + 2 * SYSTOLIC_BP_STD,
-            ),
-            "DiastolicBP": random.uniform(
-                DIASTOLIC_BP_MEAN - 2 * DIASTOLIC_BP_STD,
-                DIASTOLIC_BP_MEAN + 2 * DIASTOLIC_BP_STD,
-            ),
-            "BS": random.uniform(BS_MEAN - 2 * BS_STD, BS_MEAN + 2 * BS_STD),
-            "BodyTemp": random.uniform(
-                BODY_TEMP_MEAN - 2 * BODY_TEMP_STD, BODY_TEMP_MEAN + 2 * BODY_TEMP_STD
-            ),
-            "HeartRate": random.uniform(
-                HEART_RATE_MEAN - 2 * HEART_RATE_STD,
-                HEART_RATE_MEAN + 2 * HEART_RATE_STD,
-            ),
+
+def generate_payloads(count, seed=None):
+    """
+    Generates request bodies uniformly distributed within two standard
+    deviations from the means
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(MEANS - 2 * STDS, MEANS + 2 * STDS, (count, len(FEATURES)))
+    return [json.dumps(dict(zip(FEATURES, row))).encode() for row in values.tolist()]
+
+
+class LoadStats:
+    """
+    Collects the latency and the outcome of the requests, the latencies are
+    counted in log-spaced buckets so that long runs use constant memory
+    """
+
+    def __init__(self):
+        # The underflow and overflow buckets surround the log-spaced ones
+        self.buckets = np.zeros(LATENCY_DECADES * LATENCY_BUCKETS_PER_DECADE + 2, int)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.start = time.perf_counter()
+
+    def record(self, latency, ok):
+        """
+        Records a completed request
+        """
+        if latency < LATENCY_MIN:
+            index = 0
+        else:
+            index = int(np.log10(latency / LATENCY_MIN) * LATENCY_BUCKETS_PER_DECADE)
+            index = min(index + 1, len(self.buckets) - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        if not ok:
+            self.errors += 1
+
+    def percentiles(self, percents):
+        """
+        Returns the latency percentiles in seconds, as the geometric middle of
+        their bucket, within the bucket precision
+        """
+        cumulative = np.cumsum(self.buckets)
+        ranks = np.maximum(np.ceil(np.asarray(percents) / 100 * self.count), 1)
+        indices = np.searchsorted(cumulative, ranks)
+        values = LATENCY_MIN * 10 ** ((indices - 0.5) / LATENCY_BUCKETS_PER_DECADE)
+        # The outer buckets are unbounded
+        values = np.where(indices == 0, LATENCY_MIN, values)
+        values = np.where(indices == len(self.buckets) - 1, self.max, values)
+        return np.minimum(values, self.max)
+
+    def report(self):
+        """
+        Returns the throughput, error rate and latency percentiles in ms
+        """
+        elapsed = time.perf_counter() - self.start
+        requests = self.count
+        report = {
+            "requests": requests,
+            "errors": self.errors,
+            "error_rate": self.errors / requests if requests else 0.0,
+            "duration": elapsed,
+            "throughput": requests / elapsed if elapsed else 0.0,
         }
-        payload = json.dumps(test_data)
+        if requests:
+            p50, p90, p99 = self.percentiles([50, 90, 99]) * 1000
+            report["latency_ms"] = {
+                "mean": self.total / requests * 1000,
+                "p50": float(p50),
+                "p90": float(p90),
+                "p99": float(p99),
+                "max": self.max * 1000,
+            }
+        return report
+
+
+async def send_request(session, url, payload, stats, start):
+    """
+    Sends a prediction request, the latency is measured from the start time
+    """
+    try:
+        async with session.post(
+            url, data=payload, headers={"Content-Type": "application/json"}
+        ) as response:
+            await response.read()
+            ok = response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # A request exceeding the session timeout counts as a failed one
+        ok = False
+    stats.record(time.perf_counter() - start, ok)
+
+
+async def open_loop(session, args, payloads, stats):
+    """
+    Sends requests at the target rate whatever the response times, requests
+    waiting for a free connection count in their latency
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = set()
+
+    async def scheduled_request(payload, start):
+        async with semaphore:
+            await send_request(session, args.url, payload, stats, start)
+
+    start = time.perf_counter()
+    for sent, payload in enumerate(payloads):
+        scheduled = start + sent / args.rate
+        if args.duration and scheduled - start >= args.duration:
+            break
+        await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+        task = asyncio.create_task(scheduled_request(payload, scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks)
+
+
+async def closed_loop(session, args, payloads, stats):
+    """
+    Keeps each of the concurrent users sending a request as soon as the
+    previous one completes, optionally capped at the target rate
+    """
+    start = time.perf_counter()
+    sent = itertools.count()
+
+    async def user():
+        for payload in payloads:
+            if args.duration and time.perf_counter() - start >= args.duration:
+                return
+            if args.rate:
+                scheduled = start + next(sent) / args.rate
+                await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+            await send_request(session, args.url, payload, stats, time.perf_counter())
+
+    await asyncio.gather(*(user() for _ in range(args.concurrency)))
+
+
+async def generate_traffic(args, stats):
+    """
+    Sends requests to prediction API reusing a pool of connections
+    """
+    payloads = itertools.cycle(generate_payloads(PAYLOADS_COUNT, args.seed))
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if args.mode == "open":
+            await open_loop(session, args, payloads, stats)
+        else:
+            await closed_loop(session, args, payloads, stats)
+
+
+def parse_args():
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=URL)
+    parser.add_argument(
+        "--mode",
+        choices=["open", "closed"],
+        default="open",
+        help="open: requests sent at the target rate, closed: each user waits "
+        "for its response before the next request",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5,
+        help="target requests per second, 0 for no limit in closed mode",
+    )
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--duration", type=float, default=0, help="seconds, 0 to run until stopped"
+    )
+    parser.add_argument("--timeout", type=float, default=10, help="request timeout")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="JSON report file")
+    args = parser.parse_args()
+    if args.mode == "open" and args.rate <= 0:
+        parser.error("open mode needs a positive rate")
+    return args
+
+
+def main():
+    """
+    Runs the load test and reports its results
+    """
+    args = parse_args()
+    stats = LoadStats()
+    try:
+        asyncio.run(generate_traffic(args, stats))
+    except KeyboardInterrupt:
+        pass
 
-        response = requests.request("POST", URL, headers=headers, data=payload)
-        print(response.content)
-        time.sleep(0.2)
+    report = stats.report()
+    report.update(
+        url=args.url,
+        mode=args.mode,
+        rate=args.rate,
+        concurrency=args.concurrency,
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
 
 
 if __name__ == "__main__":
-    generate_traffic()
+    main()
@@ -0,0 +1,49 @@
+"""Gunicorn configuration module"""
+
+import gc
+import os
+import glob
+import tempfile
+
+# Import the application, and load the model, once in the master process.
+# The forked workers share the loaded model copy-on-write.
+preload_app = True
+
+# The Prometheus metrics of the workers are shared through files, the
+# directory must be set before the application is imported and is emptied
+# of the files of the previous runs
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "prometheus-multiproc"),
+)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+for filename in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+    os.remove(filename)
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """
+    Moves the objects created while preloading the application to the
+    permanent generation, so that the garbage collector of the workers does
+    not touch, and therefore copy, the shared memory pages
+    """
+    gc.freeze()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """
+    Warms up the model in every worker before it accepts requests
+    """
+    import predict  # pylint: disable=import-outside-toplevel
+
+    predict.warm_up()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """
+    Drops the live gauges of an exited worker from the metrics
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,13 +1,37 @@
 """Prediction module"""
 
+# pylint: disable=wrong-import-position
+import time
+
+IMPORT_START = time.perf_counter()
+
+# mlflow, pandas, requests and pymongo are imported where they are needed
 import os
+import csv
+import hmac
+import json
+import math
+import uuid
 import pickle
-
-import mlflow
-import pandas as pd
-import requests
-from flask import Flask, flash, jsonify, request, render_template
-from pymongo import MongoClient
+import datetime
+import functools
+import threading
+import collections
+
+import numpy as np
+import prometheus_client
+from sink import MonitoringSink
+from cache import PredictionCache
+from flask import Flask, Response, abort, flash, jsonify, request, render_template
+from batcher import MicroBatcher
+from compiled import load_tree_ensemble
+from profiler import RequestProfiler
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 EXPERIMENT_NAME = os.getenv("EXPERIMENT_NAME", "maternal-health-risk")
 MLFLOW_ENABLED = os.getenv("MLFLOW_ENABLED", "False") == "True"
@@ -16,23 +40,191 @@ DEFAULT_MODEL_ENABLED = os.getenv("DEFAULT_MODEL_ENABLED", "True") == "True"
 MONITORING_ENABLED = os.getenv("MONITORING_ENABLED", "False") == "True"
 EVIDENTLY_SERVICE_URI = os.getenv("EVIDENTLY_SERVICE_URI", "http://localhost:8085")
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+PREDICTION_LOG_TTL_DAYS = float(os.getenv("PREDICTION_LOG_TTL_DAYS", "0"))
+EVIDENTLY_TIMEOUT = float(os.getenv("EVIDENTLY_TIMEOUT", "5"))
+MONITORING_BATCH_SIZE = int(os.getenv("MONITORING_BATCH_SIZE", "100"))
+MONITORING_FLUSH_INTERVAL = float(os.getenv("MONITORING_FLUSH_INTERVAL", "1"))
+MONITORING_QUEUE_SIZE = int(os.getenv("MONITORING_QUEUE_SIZE", "10000"))
+MONITORING_BACKPRESSURE = os.getenv("MONITORING_BACKPRESSURE", "False") == "True"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+COMPILED_MODEL_ENABLED = os.getenv("COMPILED_MODEL_ENABLED", "True") == "True"
+COMPILED_MODEL_MAX_ROWS = int(os.getenv("COMPILED_MODEL_MAX_ROWS", "64"))
+MODEL_POLL_INTERVAL = float(os.getenv("MODEL_POLL_INTERVAL", "60"))
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_WARM_FILE = os.getenv("PREDICTION_CACHE_WARM_FILE")
+MICRO_BATCH_ENABLED = os.getenv("MICRO_BATCH_ENABLED", "False") == "True"
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", "64"))
+MICRO_BATCH_LATENCY = float(os.getenv("MICRO_BATCH_LATENCY", "0.002"))
+PROFILER_SAMPLE_RATE = int(os.getenv("PROFILER_SAMPLE_RATE", "0"))
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN")
 if not os.getenv("MLFLOW_S3_ENDPOINT_URL"):
     os.environ["MLFLOW_S3_ENDPOINT_URL"] = "http://localhost:9000"
 
-if MONITORING_ENABLED:
-    mongo_client = MongoClient(MONGODB_URI)
-    db = mongo_client.get_database("prediction_service")
-    collection = db.get_collection(EXPERIMENT_NAME)
+FEATURES = ["Age", "SystolicBP", "DiastolicBP", "BS", "BodyTemp", "HeartRate"]
+WARM_UP_RECORD = {
+    "Age": 20,
+    "SystolicBP": 120,
+    "DiastolicBP": 70,
+    "BS": 2.0,
+    "BodyTemp": 36,
+    "HeartRate": 60,
+}
+
+MISSING_DATA_ERROR = f"All of {', '.join(FEATURES)} should be provided as numbers."
+AGE_ERROR = "Age should be between 13 and 50 years"
+BLOOD_PRESSURE_ERROR = "Blood pressure should be between 50 and 200 mmHg."
+BLOOD_PRESSURE_ORDER_ERROR = "Systolic blood pressure should be higher that diastolic."
+BLOOD_SUGAR_ERROR = "Blood sugar level should be between 0 and 15 mmol/L."
+BODY_TEMP_ERROR = "Body temperature should be between 34 and 41 celsius degrees."
+HEART_RATE_ERROR = "Heart rate should be between 45 and 130 bpm."
+VALIDATION_RULES = {
+    MISSING_DATA_ERROR: "missing_data",
+    AGE_ERROR: "age",
+    BLOOD_PRESSURE_ERROR: "blood_pressure",
+    BLOOD_PRESSURE_ORDER_ERROR: "blood_pressure_order",
+    BLOOD_SUGAR_ERROR: "blood_sugar",
+    BODY_TEMP_ERROR: "body_temp",
+    HEART_RATE_ERROR: "heart_rate",
+}
+RISK_LEVELS = ["high risk", "low risk", "mid risk"]
+
+DEFAULT_MODEL_VERSION = "default"
+
+# With several gunicorn workers the metrics are shared through the files of
+# PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py), and each process reports
+# the version of its own model
+MODEL_VERSION = prometheus_client.Gauge(
+    "model_version_info",
+    "Version of the model serving predictions",
+    ["version"],
+    multiprocess_mode="liveall",
+)
+
+MODEL_LOAD_DURATION = prometheus_client.Histogram(
+    "model_load_duration_seconds",
+    "Time to load the model and its compiled tables",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+PREDICTION_STAGE_DURATION = prometheus_client.Histogram(
+    "prediction_stage_duration_seconds",
+    "Time spent in each stage of the predictions, the batch stages time a "
+    "whole batch and the monitoring stages run in the background",
+    ["stage"],
+    buckets=(
+        0.00001,
+        0.000025,
+        0.00005,
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+    ),
+)
+# The label lookup is resolved once, not on every observation
+PREDICTION_STAGES = {
+    stage: PREDICTION_STAGE_DURATION.labels(stage=stage)
+    for stage in [
+        "parse",
+        "validate",
+        "predict",
+        "convert",
+        "enqueue",
+        "batch_parse",
+        "batch_validate",
+        "batch_predict",
+        "batch_convert",
+        "batch_enqueue",
+        "mongo",
+        "evidently",
+    ]
+}
+
+MICRO_BATCH_SIZES = prometheus_client.Histogram(
+    "micro_batch_size",
+    "Records per model call of the coalesced single-record predictions",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+
+PREDICTIONS = prometheus_client.Counter(
+    "predictions", "Predictions by risk level", ["risk_level"]
+)
+
+VALIDATION_FAILURES = prometheus_client.Counter(
+    "validation_failures", "Records rejected by each validation rule", ["rule"]
+)
+
+MONITORING_RECORDS = prometheus_client.Counter(
+    "monitoring_records", "Monitoring sink records by outcome", ["outcome"]
+)
+
+PREDICTION_CACHE_EVENTS = prometheus_client.Counter(
+    "prediction_cache_events", "Prediction cache hits, misses and evictions", ["event"]
+)
+
+# The model, its compiled tables and its version are swapped together
+LoadedModel = collections.namedtuple(
+    "LoadedModel", ["model", "compiled_model", "version"]
+)
+current_model = None
+prediction_cache = (
+    PredictionCache(
+        PREDICTION_CACHE_SIZE,
+        ttl=PREDICTION_CACHE_TTL or None,
+        counter=PREDICTION_CACHE_EVENTS,
+    )
+    if PREDICTION_CACHE_SIZE > 0
+    else None
+)
+# Coalesces the predictions of concurrent requests, when threads serve them
+# (gunicorn --threads or the ASGI model executor)
+micro_batcher = (
+    MicroBatcher(
+        # predict_batch is defined below
+        lambda data, loaded_model: predict_batch(data, loaded_model),
+        max_batch_size=MICRO_BATCH_SIZE,
+        max_latency=MICRO_BATCH_LATENCY,
+        histogram=MICRO_BATCH_SIZES,
+    )
+    if MICRO_BATCH_ENABLED
+    else None
+)
+model_watcher_lock = threading.Lock()
+model_watcher_pid = None
+
+
+def get_latest_model_version():
+    """
+    Gets the latest version of the model in the MLFlow registry
+    """
+    from mlflow.tracking import MlflowClient  # pylint: disable=import-outside-toplevel
 
+    client = MlflowClient(MLFLOW_TRACKING_URI)
+    versions = client.get_latest_versions(EXPERIMENT_NAME)
+    return str(max(int(version.version) for version in versions))
 
-def load_model_from_registry():
+
+def load_model_from_registry(version):
     """
     Loads the ML model from the MLFlow registry
     """
+    import mlflow  # pylint: disable=import-outside-toplevel
+
     mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
-    model_uri = f"models:/{EXPERIMENT_NAME}/latest"
+    model_uri = f"models:/{EXPERIMENT_NAME}/{version}"
     loaded_model = mlflow.pyfunc.load_model(model_uri)
-    print("Loaded model from S3 Bucket")
+    print(f"Loaded model version {version} from S3 Bucket")
     return loaded_model
 
 
@@ -46,21 +238,115 @@ def load_default_model():
     return loaded_model
 
 
+def load_compiled_model(loaded_model):
+    """
+    Loads the node tables exported for the ML model
+    """
+    if not COMPILED_MODEL_ENABLED or loaded_model is None:
+        return None
+
+    run_id = getattr(getattr(loaded_model, "metadata", None), "run_id", None)
+    default_file = f"{os.path.dirname(os.path.abspath(__file__))}/model.npz"
+    return load_tree_ensemble(run_id, default_file, FEATURES, download=MLFLOW_ENABLED)
+
+
 def load_model():
     """
-    Loads the ML model
+    Loads the ML model together with its compiled tables and version
+    """
+    with MODEL_LOAD_DURATION.time():
+        return load_latest_model()
+
+
+def load_latest_model():
+    """
+    Loads the latest registered model, or the default one
     """
     try:
         if MLFLOW_ENABLED:
-            return load_model_from_registry()
+            version = get_latest_model_version()
+            loaded_model = load_model_from_registry(version)
+            return LoadedModel(loaded_model, load_compiled_model(loaded_model), version)
 
         if DEFAULT_MODEL_ENABLED:
-            return load_default_model()
+            loaded_model = load_default_model()
+            return LoadedModel(
+                loaded_model, load_compiled_model(loaded_model), DEFAULT_MODEL_VERSION
+            )
     except:
         if DEFAULT_MODEL_ENABLED:
-            return load_default_model()
+            loaded_model = load_default_model()
+            return LoadedModel(
+                loaded_model, load_compiled_model(loaded_model), DEFAULT_MODEL_VERSION
+            )
 
-    return None
+    return LoadedModel(None, None, None)
+
+
+def set_model(loaded_model):
+    """
+    Swaps in the model serving predictions
+    """
+    global current_model  # pylint: disable=global-statement
+    previous_model = current_model
+    current_model = loaded_model
+    if prediction_cache is not None:
+        prediction_cache.clear()
+    if previous_model is not None and previous_model.version is not None:
+        # Removed series are not removed from the multiprocess files
+        MODEL_VERSION.labels(version=previous_model.version).set(0)
+        MODEL_VERSION.remove(previous_model.version)
+    if loaded_model.version is not None:
+        MODEL_VERSION.labels(version=loaded_model.version).set(1)
+
+
+def reload_model():
+    """
+    Loads the latest registered model if its version changed, warms it up
+    and swaps it in, returns whether the model was swapped
+    """
+    version = get_latest_model_version()
+    if version == current_model.version:
+        return False
+
+    with MODEL_LOAD_DURATION.time():
+        loaded_model = load_model_from_registry(version)
+        candidate = LoadedModel(
+            loaded_model, load_compiled_model(loaded_model), version
+        )
+    predict_batch(records_to_array([WARM_UP_RECORD]), candidate)
+    set_model(candidate)
+    print(f"Swapped in model version {version} (pid {os.getpid()})")
+    if PREDICTION_CACHE_WARM_FILE:
+        warm_prediction_cache(PREDICTION_CACHE_WARM_FILE)
+    return True
+
+
+def watch_model_registry():
+    """
+    Polls the MLFlow registry for new model versions
+    """
+    while True:
+        time.sleep(MODEL_POLL_INTERVAL)
+        try:
+            reload_model()
+        except Exception as error:  # pylint: disable=broad-except
+            print(f"Model reload failed: {error!r}")
+
+
+def start_model_watcher():
+    """
+    Starts the registry watcher of the current process, forked workers
+    start their own since threads do not survive a fork
+    """
+    global model_watcher_pid  # pylint: disable=global-statement
+    with model_watcher_lock:
+        if model_watcher_pid == os.getpid():
+            return
+        model_watcher_pid = os.getpid()
+    threading.Thread(
+        target=watch_model_registry, name="model-watcher", daemon=True
+    ).start()
 
 
 def validate_data(record):
@@ -68,7 +354,7 @@ def validate_data(record):
     Performs data validation
     """
     if record["Age"] < 13 or record["Age"] > 50:
-        return "Age should be between 13 and 50 years"
+        return AGE_ERROR
 
     if (
         record["SystolicBP"] < 50
@@ -76,31 +362,216 @@ def validate_data(record):
         or record["DiastolicBP"] < 50
         or record["DiastolicBP"] > 200
     ):
-        return "Blood pressure should be between 50 and 200 mmHg."
+        return BLOOD_PRESSURE_ERROR
 
     if record["SystolicBP"] <= record["DiastolicBP"]:
-        return "Systolic blood pressure should be higher that diastolic."
+        return BLOOD_PRESSURE_ORDER_ERROR
 
     if record["BS"] < 0.1 or record["BS"] > 15:
-        return "Blood sugar level should be between 0 and 15 mmol/L."
+        return BLOOD_SUGAR_ERROR
 
     if record["BodyTemp"] < 34 or record["BodyTemp"] > 41:
-        return "Body temperature should be between 34 and 41 celsius degrees."
+        return BODY_TEMP_ERROR
 
     if record["HeartRate"] < 45 or record["HeartRate"] > 130:
-        return "Heart rate should be between 45 and 130 bpm."
+        return HEART_RATE_ERROR
 
     return None
 
 
-def predict(record):
+def decode_record(body):
+    """
+    Decodes a JSON request body into a record of the six features as floats,
+    numeric strings are accepted, returns None if a feature is missing or
+    not a finite number
+    """
+    try:
+        document = json_loads(body)
+        record = {feature: float(document[feature]) for feature in FEATURES}
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not all(math.isfinite(value) for value in record.values()):
+        return None
+    return record
+
+
+def validate_record(record):
+    """
+    Performs data validation, counting the failures of each rule
+    """
+    with PREDICTION_STAGES["validate"].time():
+        error_message = MISSING_DATA_ERROR if record is None else validate_data(record)
+    if error_message:
+        VALIDATION_FAILURES.labels(rule=VALIDATION_RULES[error_message]).inc()
+    return error_message
+
+
+def records_to_array(records):
+    """
+    Converts a list of records into a feature matrix, missing or
+    non-numeric values are marked as NaN
+    """
+    try:
+        return np.array(
+            [[record.get(feature) for feature in FEATURES] for record in records],
+            dtype=float,
+        ).reshape(-1, len(FEATURES))
+    except (AttributeError, TypeError, ValueError):
+        pass
+
+    data = np.full((len(records), len(FEATURES)), np.nan)
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            continue
+        for j, feature in enumerate(FEATURES):
+            try:
+                data[i, j] = float(record[feature])
+            except (KeyError, TypeError, ValueError):
+                pass
+    return data
+
+
+def validate_batch(data):
+    """
+    Performs vectorized data validation over a feature matrix,
+    returns the error message of each row or None if the row is valid
+    """
+    age, systolic_bp, diastolic_bp, bs, body_temp, heart_rate = data.T
+    # Rules are checked in the same order as validate_data,
+    # the first failing rule determines the error of the row
+    conditions = [
+        np.isnan(data).any(axis=1),
+        (age < 13) | (age > 50),
+        (systolic_bp < 50)
+        | (systolic_bp > 200)
+        | (diastolic_bp < 50)
+        | (diastolic_bp > 200),
+        systolic_bp <= diastolic_bp,
+        (bs < 0.1) | (bs > 15),
+        (body_temp < 34) | (body_temp > 41),
+        (heart_rate < 45) | (heart_rate > 130),
+    ]
+    messages = np.array(
+        [
+            None,
+            MISSING_DATA_ERROR,
+            AGE_ERROR,
+            BLOOD_PRESSURE_ERROR,
+            BLOOD_PRESSURE_ORDER_ERROR,
+            BLOOD_SUGAR_ERROR,
+            BODY_TEMP_ERROR,
+            HEART_RATE_ERROR,
+        ],
+        dtype=object,
+    )
+    rules = np.select(conditions, range(1, len(conditions) + 1), default=0)
+    return messages[rules]
+
+
+def canonicalize(record):
+    """
+    Quantizes a record to the resolution of the prediction form: integer
+    age, blood pressures and heart rate, one-decimal blood sugar and body
+    temperature
+    """
+    return (
+        int(round(record["Age"])),
+        int(round(record["SystolicBP"])),
+        int(round(record["DiastolicBP"])),
+        round(float(record["BS"]), 1),
+        round(float(record["BodyTemp"]), 1),
+        int(round(record["HeartRate"])),
+    )
+
+
+def predict(record, loaded_model=None):
     """
-    Predicts the risk value
+    Predicts the risk value, through the prediction cache when enabled
     """
-    preds = [round(x) for x in model.predict(pd.DataFrame([record]))]
+    loaded_model = loaded_model or current_model
+    if prediction_cache is None:
+        return predict_record(record, loaded_model)
+
+    # Only the records already at the form resolution are cached, the model
+    # may predict differently on a rounded record
+    canonical = canonicalize(record)
+    if canonical != tuple(float(record[feature]) for feature in FEATURES):
+        return predict_record(record, loaded_model)
+
+    key = (loaded_model.version, *canonical)
+    pred = prediction_cache.get(key)
+    if pred is None:
+        pred = predict_record(record, loaded_model)
+        prediction_cache.put(key, pred)
+    return pred
+
+
+def predict_record(record, loaded_model):
+    """
+    Predicts the risk value of a record with the given model
+    """
+    if micro_batcher is not None:
+        row = [record[feature] for feature in FEATURES]
+        return int(micro_batcher.predict(row, loaded_model))
+
+    if loaded_model.compiled_model is not None:
+        data = np.array([[record[feature] for feature in FEATURES]], dtype=float)
+        return int(predict_batch(data, loaded_model)[0])
+
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    preds = [
+        round(x)
+        for x in loaded_model.model.predict(pd.DataFrame([record], columns=FEATURES))
+    ]
     return preds[0]
 
 
+def predict_batch(data, loaded_model=None):
+    """
+    Predicts the risk values of a feature matrix with a single model call,
+    the compiled tables are faster than the native models on small batches
+    only (see benchmark.py)
+    """
+    loaded_model = loaded_model or current_model
+    if loaded_model.compiled_model is not None and len(data) <= COMPILED_MODEL_MAX_ROWS:
+        preds = loaded_model.compiled_model.predict(data)
+    else:
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        preds = loaded_model.model.predict(pd.DataFrame(data, columns=FEATURES))
+    return np.rint(preds).astype(int)
+
+
+def warm_prediction_cache(filename):
+    """
+    Pre-computes the cached predictions of the records of a dataset
+    shaped like data/data.csv (body temperature in Fahrenheit)
+    """
+    if prediction_cache is None:
+        return
+
+    with open(filename, encoding="utf-8-sig") as f_in:
+        records = [
+            {feature: float(row[feature]) for feature in FEATURES}
+            for row in csv.DictReader(f_in)
+        ]
+    for record in records:
+        record["BodyTemp"] = (record["BodyTemp"] - 32) * 5 / 9
+
+    data = records_to_array(records)
+    valid = [error is None for error in validate_batch(data)]
+    keys = sorted({canonicalize(dict(zip(FEATURES, row))) for row in data[valid]})
+    if not keys:
+        return
+
+    loaded_model = current_model
+    preds = predict_batch(np.array(keys, dtype=float), loaded_model)
+    for key, pred in zip(keys, preds):
+        prediction_cache.put((loaded_model.version, *key), int(pred))
+    print(f"Warmed prediction cache with {len(keys)} records")
+
+
 def convert_risk(pred):
     """
     Converts numerical risk into label
@@ -113,43 +584,305 @@ def convert_risk(pred):
     return "mid risk", "warning"
 
 
-def save_to_db(record, risk):
+@functools.lru_cache(maxsize=None)
+def get_collection():
+    """
+    Connects to the Mongo prediction collection, the client is created
+    on first use so that it is never shared across forked workers
+    """
+    return connect_collection(os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def connect_collection(pid):  # pylint: disable=unused-argument
+    """
+    Connects the current process to the Mongo prediction collection and
+    creates its indexes
+    """
+    from pymongo import MongoClient  # pylint: disable=import-outside-toplevel
+
+    mongo_client = MongoClient(MONGODB_URI)
+    db = mongo_client.get_database("prediction_service")
+    collection = db.get_collection(EXPERIMENT_NAME)
+    create_indexes(collection)
+    return collection
+
+
+def create_indexes(collection):
     """
-    Saves the prediction data to the Mongo database
+    Creates the indexes of the time-bounded queries of the prediction log,
+    the timestamp index expires the predictions older than
+    PREDICTION_LOG_TTL_DAYS when set
     """
-    rec = record.copy()
-    rec["RiskLevel"] = risk
-    collection.insert_one(rec)
+    # pylint: disable-next=import-outside-toplevel
+    from pymongo.errors import OperationFailure
+
+    ttl = {}
+    if PREDICTION_LOG_TTL_DAYS > 0:
+        ttl["expireAfterSeconds"] = int(PREDICTION_LOG_TTL_DAYS * 86400)
+    try:
+        collection.create_index("timestamp", **ttl)
+    except OperationFailure:
+        # The TTL option changed since the index was created
+        collection.drop_index("timestamp_1")
+        collection.create_index("timestamp", **ttl)
+    collection.create_index([("model_version", 1), ("timestamp", 1)])
+    collection.create_index("request_id")
+
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    """
+    Creates the keep-alive HTTP session used by the monitoring sink thread
+    """
+    import requests  # pylint: disable=import-outside-toplevel
+
+    return requests.Session()
+
+
+@PREDICTION_STAGES["mongo"].time()
+def save_to_db(records):
+    """
+    Saves a batch of prediction data to the Mongo database
+    """
+    # insert_many adds the _id field to the inserted documents
+    get_collection().insert_many([record.copy() for record in records], ordered=False)
 
 
-def send_to_evidently_service(record, risk):
+def log_record(record, risk, request_id, loaded_model, timestamp=None):
     """
-    Sends the prediction data to the Evidently monitoring service
+    Returns the prediction log entry of a record: its features, risk,
+    prediction time, version of the model that predicted it and request id
     """
-    rec = record.copy()
-    rec["RiskLevel"] = risk
-    requests.post(f"{EVIDENTLY_SERVICE_URI}/iterate/maternal-health-risk", json=[rec])
+    return dict(
+        record,
+        RiskLevel=risk,
+        timestamp=timestamp or datetime.datetime.now(datetime.timezone.utc),
+        model_version=loaded_model.version,
+        request_id=request_id,
+    )
 
 
-def calculate_risk(record):
+def get_request_id():
+    """
+    Returns the id of the current request, forwarded by the client in the
+    X-Request-ID header or generated
+    """
+    return request.headers.get("X-Request-ID") or uuid.uuid4().hex
+
+
+@PREDICTION_STAGES["evidently"].time()
+def send_to_evidently_service(records):
+    """
+    Sends a batch of prediction data to the Evidently monitoring service
+    """
+    response = get_session().post(
+        f"{EVIDENTLY_SERVICE_URI}/iterate/maternal-health-risk",
+        json=evidently_rows(records),
+        timeout=EVIDENTLY_TIMEOUT,
+    )
+    response.raise_for_status()
+
+
+def evidently_rows(records):
+    """
+    Returns the features and risk of prediction log entries
+    """
+    columns = FEATURES + ["RiskLevel"]
+    return [{column: record[column] for column in columns} for record in records]
+
+
+def calculate_risk(record, request_id=None):
     """
     Calculates the maternal health risk
     """
-    pred = predict(record)
-    risk, category = convert_risk(pred)
+    # The model may be swapped while predicting
+    loaded_model = current_model
+    with PREDICTION_STAGES["predict"].time():
+        pred = predict(record, loaded_model)
+    with PREDICTION_STAGES["convert"].time():
+        risk, category = convert_risk(pred)
+    PREDICTIONS.labels(risk_level=risk).inc()
     if MONITORING_ENABLED:
-        save_to_db(record, risk)
-        send_to_evidently_service(record, risk)
+        with PREDICTION_STAGES["enqueue"].time():
+            monitoring_sink.submit(log_record(record, risk, request_id, loaded_model))
     return risk, category
 
 
+def calculate_batch_risk(records, request_id=None):
+    """
+    Calculates the maternal health risk of a batch of records,
+    returns the risk or the validation error of each record
+    """
+    results, monitored = score_batch(records, request_id)
+    if MONITORING_ENABLED and monitored:
+        with PREDICTION_STAGES["batch_enqueue"].time():
+            monitoring_sink.submit_many(monitored)
+    return results
+
+
+def score_batch(records, request_id=None):
+    """
+    Returns the risk or the validation error of each record of a batch,
+    and the valid records labelled with their risk
+    """
+    with PREDICTION_STAGES["batch_validate"].time():
+        data = records_to_array(records)
+        errors = validate_batch(data)
+        valid = np.flatnonzero([error is None for error in errors])
+    for error, count in collections.Counter(errors).items():
+        if error is not None:
+            VALIDATION_FAILURES.labels(rule=VALIDATION_RULES[error]).inc(count)
+
+    results = [{"Error": error} for error in errors]
+    if len(valid) == 0:
+        return results, []
+
+    loaded_model = current_model
+    with PREDICTION_STAGES["batch_predict"].time():
+        preds = predict_batch(data[valid], loaded_model)
+    with PREDICTION_STAGES["batch_convert"].time():
+        risks = [convert_risk(pred)[0] for pred in preds]
+        for i, risk in zip(valid, risks):
+            results[i] = {"RiskLevel": risk}
+    for risk, count in collections.Counter(risks).items():
+        PREDICTIONS.labels(risk_level=risk).inc(count)
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    monitored = [
+        log_record(records[i], risk, request_id, loaded_model, timestamp)
+        for i, risk in zip(valid, risks)
+    ]
+    return results, monitored
+
+
+if MONITORING_ENABLED:
+    monitoring_sink = MonitoringSink(
+        [send_to_evidently_service, save_to_db],
+        batch_size=MONITORING_BATCH_SIZE,
+        flush_interval=MONITORING_FLUSH_INTERVAL,
+        queue_size=MONITORING_QUEUE_SIZE,
+        block=MONITORING_BACKPRESSURE,
+        counter=MONITORING_RECORDS,
+    )
+
+# Profiles 1 in PROFILER_SAMPLE_RATE requests of each worker, the stages
+# are the functions timed by PREDICTION_STAGE_DURATION
+profiler = RequestProfiler(
+    PROFILER_SAMPLE_RATE,
+    stages={
+        "parse": decode_record,
+        "validate": validate_data,
+        "predict": predict,
+        "convert": convert_risk,
+        "enqueue": MonitoringSink.submit,
+    },
+)
+
+
+def encode_response(document):
+    """
+    Encodes a response body exactly as jsonify does
+    """
+    return (json.dumps(document, separators=(",", ":"), sort_keys=True) + "\n").encode()
+
+
+# There are only a few distinct responses, they are encoded once
+RISK_RESPONSES = {risk: encode_response({"RiskLevel": risk}) for risk in RISK_LEVELS}
+ERROR_RESPONSES = {
+    message: encode_response({"Error": message}) for message in VALIDATION_RULES
+}
+
+
+def profiled(view):
+    """
+    Profiles the sampled requests of an endpoint
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        return profiler.profile(view.__name__, view, *args, **kwargs)
+
+    return wrapper
+
+
 app = Flask(EXPERIMENT_NAME)
 app.secret_key = os.urandom(24)
 
-model = load_model()
+
+def metrics_registry():
+    """
+    Returns the registry of the exported metrics, collected from the files
+    of all the processes in multiprocess mode
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return prometheus_client.REGISTRY
+
+    # pylint: disable-next=import-outside-toplevel
+    from prometheus_client import multiprocess
+
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+# Add prometheus wsgi middleware to route /metrics requests
+app.wsgi_app = DispatcherMiddleware(
+    app.wsgi_app, {"/metrics": prometheus_client.make_wsgi_app(metrics_registry())}
+)
+
+
+def warm_up():
+    """
+    Runs a first prediction, so that lazy initialisations do not hit the
+    first request, and reports the time to first prediction
+    """
+    start = time.perf_counter()
+    predict(WARM_UP_RECORD)
+    end = time.perf_counter()
+    # The metric values written before a fork are not inherited
+    if current_model.version is not None:
+        MODEL_VERSION.labels(version=current_model.version).set(1)
+    if PREDICTION_CACHE_WARM_FILE:
+        warm_prediction_cache(PREDICTION_CACHE_WARM_FILE)
+    print(
+        f"First prediction in {end - start:.3f}s, "
+        f"{end - IMPORT_START:.2f}s after start-up (pid {os.getpid()})"
+    )
+
+
+# When served by gunicorn (see gunicorn.conf.py) the model is loaded once in
+# the master process and shared copy-on-write with the forked workers
+MODEL_LOAD_START = time.perf_counter()
+set_model(load_model())
+print(
+    f"Imported in {MODEL_LOAD_START - IMPORT_START:.2f}s, "
+    f"model loaded in {time.perf_counter() - MODEL_LOAD_START:.2f}s"
+)
+
+
+@app.before_request
+def start_model_watcher_hook():
+    """
+    Starts the registry watcher with the first request of each worker
+    """
+    if MLFLOW_ENABLED and MODEL_POLL_INTERVAL > 0:
+        if model_watcher_pid != os.getpid():
+            start_model_watcher()
+
+
+@app.after_request
+def add_model_version_header(response):
+    """
+    Reports the version of the model serving the predictions
+    """
+    if current_model.version is not None:
+        response.headers["X-Model-Version"] = current_model.version
+    return response
 
 
 @app.route("/", methods=["GET", "POST"])
+@profiled
 def predict_form_endpoint():
     """
     Prediction form endpoint
@@ -163,30 +896,103 @@ def predict_form_endpoint():
         record["BodyTemp"] = float(request.form.get("BodyTemp"))
         record["HeartRate"] = int(request.form.get("HeartRate"))
 
-        error_message = validate_data(record)
+        error_message = validate_record(record)
         if error_message:
             flash(error_message, 'info')
         else:
-            risk, category = calculate_risk(record)
+            risk, category = calculate_risk(record, get_request_id())
             flash(risk.capitalize(), category)
 
     return render_template("index.html")
 
 
 @app.route("/predict", methods=["POST"])
+@profiled
 def predict_json_endpoint():
     """
     Prediction API endpoint
     """
-    record = request.get_json()
+    with PREDICTION_STAGES["parse"].time():
+        record = decode_record(request.get_data(cache=False))
 
-    error_message = validate_data(record)
+    error_message = validate_record(record)
     if error_message:
-        return jsonify({"Error": error_message})
+        return Response(ERROR_RESPONSES[error_message], mimetype="application/json")
+
+    risk, _ = calculate_risk(record, get_request_id())
+    return Response(RISK_RESPONSES[risk], mimetype="application/json")
+
+
+@app.route("/predict/batch", methods=["POST"])
+@profiled
+def predict_batch_json_endpoint():
+    """
+    Batch prediction API endpoint
+    """
+    with PREDICTION_STAGES["batch_parse"].time():
+        records = request.get_json()
+
+    if not isinstance(records, list):
+        return jsonify({"Error": "A list of records should be provided."}), 400
+    if len(records) > MAX_BATCH_SIZE:
+        return (
+            jsonify({"Error": f"At most {MAX_BATCH_SIZE} records can be provided."}),
+            413,
+        )
+
+    return jsonify(calculate_batch_risk(records, get_request_id()))
+
+
+def check_admin_token():
+    """
+    Restricts the admin endpoints to the bearer of PROFILER_TOKEN, they do
+    not exist when no token is configured
+    """
+    if not PROFILER_TOKEN:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {PROFILER_TOKEN}"):
+        abort(401)
+
+
+@app.route("/admin/profiler", methods=["GET", "POST"])
+def profiler_endpoint():
+    """
+    Profiler admin endpoint, reports the slowest profiled requests of the
+    worker, or restarts its profiling with the posted sample rate
+    """
+    check_admin_token()
+    if request.method == "POST":
+        sample_rate = (request.get_json(silent=True) or {}).get("sample_rate")
+        if isinstance(sample_rate, bool) or not isinstance(sample_rate, int):
+            sample_rate = -1
+        if sample_rate < 0:
+            return jsonify({"Error": "sample_rate should be a natural number."}), 400
+        profiler.reset(sample_rate)
+
+    return jsonify(dict(profiler.report(), pid=os.getpid()))
+
+
+@app.route("/admin/profiler/stats", methods=["GET"])
+def profiler_stats_endpoint():
+    """
+    Profiler admin endpoint, downloads the aggregated profile of the worker
+    as a pstats file
+    """
+    check_admin_token()
+    stats = profiler.dump_stats()
+    if stats is None:
+        return jsonify({"Error": "No request has been profiled."}), 404
 
-    risk, _ = calculate_risk(record)
-    return jsonify({"RiskLevel": risk})
+    return Response(
+        stats,
+        mimetype="application/octet-stream",
+        headers={
+            "Content-Disposition": f"attachment; filename=predict-{os.getpid()}.pstats"
+        },
+    )
 
 
 if __name__ == "__main__":
+    warm_up()
     app.run(debug=True, host="0.0.0.0", port=8081)
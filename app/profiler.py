@@ -0,0 +1,124 @@
+"""Request profiler module"""
+
+import heapq
+import pstats
+import inspect
+import marshal
+import cProfile
+import itertools
+import threading
+from time import time, perf_counter
+
+
+# The settings, the collected profiles and the two locks are all distinct state
+class RequestProfiler:  # pylint: disable=too-many-instance-attributes
+    """
+    Profiles one request in every sample_rate, aggregating the profiles and
+    keeping the slowest requests with the time spent in each stage function
+    """
+
+    def __init__(self, sample_rate=0, stages=None, slowest_size=10):
+        self.sample_rate = sample_rate
+        self.slowest_size = slowest_size
+        # pstats identifies the functions by file, first line and name
+        self.stage_keys = {}
+        for stage, function in (stages or {}).items():
+            code = inspect.unwrap(function).__code__
+            self.stage_keys[stage] = (
+                code.co_filename,
+                code.co_firstlineno,
+                code.co_name,
+            )
+        self.sampled = 0
+        self._requests = itertools.count()
+        self._stats = None
+        self._slowest = []
+        self._lock = threading.Lock()
+        # A single profiler can be active in a process
+        self._profiling = threading.Lock()
+
+    def reset(self, sample_rate):
+        """
+        Discards the collected profiles and sets the sample rate, 0 turns the
+        profiler off
+        """
+        with self._lock:
+            self.sample_rate = sample_rate
+            self.sampled = 0
+            self._requests = itertools.count()
+            self._stats = None
+            self._slowest = []
+
+    def profile(self, name, function, *args, **kwargs):
+        """
+        Calls a request handler, profiling the sampled requests
+        """
+        sample_rate = self.sample_rate
+        if not sample_rate or next(self._requests) % sample_rate:
+            return function(*args, **kwargs)
+        # Requests overlapping a profiled one are not sampled, a with block
+        # cannot acquire without blocking, the lock is released below
+        # pylint: disable-next=consider-using-with
+        if not self._profiling.acquire(blocking=False):
+            return function(*args, **kwargs)
+
+        try:
+            profile = cProfile.Profile()
+            start = perf_counter()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._record(name, perf_counter() - start, profile)
+        finally:
+            self._profiling.release()
+
+    def _record(self, name, duration, profile):
+        """
+        Adds a request profile to the aggregated ones
+        """
+        stats = pstats.Stats(profile)
+        request = {
+            "endpoint": name,
+            "time": time(),
+            "duration_ms": duration * 1000,
+            "stages_ms": {
+                stage: stats.stats[key][3] * 1000
+                for stage, key in self.stage_keys.items()
+                if key in stats.stats
+            },
+        }
+        with self._lock:
+            self.sampled += 1
+            if self._stats is None:
+                self._stats = stats
+            else:
+                self._stats.add(stats)
+            item = (duration, self.sampled, request)
+            if len(self._slowest) < self.slowest_size:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def report(self):
+        """
+        Returns the sample rate, the number of profiled requests and the
+        slowest ones
+        """
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "sampled": self.sampled,
+                "slowest": [item[2] for item in sorted(self._slowest, reverse=True)],
+            }
+
+    def dump_stats(self):
+        """
+        Returns the aggregated profile in the pstats file format, or None if
+        no request has been profiled
+        """
+        with self._lock:
+            if self._stats is None:
+                return None
+            return marshal.dumps(self._stats.stats)
@@ -0,0 +1,215 @@
+"""Bulk scoring module"""
+
+import os
+import time
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import predict
+
+FORMATS = {
+    ".csv": "csv",
+    ".json": "jsonl",
+    ".jsonl": "jsonl",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+}
+RISK_LEVELS = np.array([predict.convert_risk(pred)[0] for pred in range(3)])
+
+
+def file_format(filename):
+    """
+    Returns the format of a file from its extension
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported file format {extension!r}")
+    return FORMATS[extension]
+
+
+def read_chunks(filename, chunk_size):
+    """
+    Reads a CSV, JSON lines or Parquet file in DataFrames of chunk_size rows
+    """
+    fmt = file_format(filename)
+    if fmt == "csv":
+        yield from pd.read_csv(filename, chunksize=chunk_size, encoding="utf-8-sig")
+    elif fmt == "jsonl":
+        yield from pd.read_json(filename, lines=True, chunksize=chunk_size)
+    else:
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+
+
+def parquet_schema(chunk):
+    """
+    Returns the Parquet schema of the scored chunks, the types inferred from
+    the first chunk are widened to fit the next ones: integer columns to
+    floats, as later chunks can hold missing values, and all-null columns
+    to strings
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+    for index, field in enumerate(schema):
+        if pa.types.is_integer(field.type):
+            schema = schema.set(index, field.with_type(pa.float64()))
+        elif pa.types.is_null(field.type):
+            schema = schema.set(index, field.with_type(pa.string()))
+    return schema
+
+
+def conform_chunk(chunk, schema):
+    """
+    Converts the numeric and string columns of a chunk to the types of the
+    Parquet schema, values that are not numbers are written as nulls
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    columns = {}
+    for field in schema:
+        column = chunk[field.name]
+        if pa.types.is_floating(field.type):
+            columns[field.name] = pd.to_numeric(column, errors="coerce")
+        elif pa.types.is_string(field.type):
+            columns[field.name] = column.where(column.isna(), column.astype(str))
+    return chunk.assign(**columns)
+
+
+def write_chunks(chunks, filename):
+    """
+    Writes DataFrames one after the other to a CSV, JSON lines or Parquet file
+    """
+    fmt = file_format(filename)
+    if fmt == "parquet":
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+        writer = None
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    schema = parquet_schema(chunk)
+                    writer = pq.ParquetWriter(filename, schema)
+                table = pa.Table.from_pandas(
+                    conform_chunk(chunk, schema), schema=schema, preserve_index=False
+                )
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return
+
+    with open(filename, "w", encoding="utf-8", newline="") as file:
+        for i, chunk in enumerate(chunks):
+            if fmt == "csv":
+                chunk.to_csv(file, header=i == 0, index=False)
+            elif len(chunk):
+                file.write(chunk.to_json(orient="records", lines=True).rstrip("\n"))
+                file.write("\n")
+
+
+def score_chunk(chunk, fahrenheit=False):
+    """
+    Validates and predicts the records of a DataFrame with vectorized calls,
+    returns it with the RiskLevel and the validation Error of each row
+    """
+    data = np.full((len(chunk), len(predict.FEATURES)), np.nan)
+    for j, feature in enumerate(predict.FEATURES):
+        if feature in chunk:
+            data[:, j] = pd.to_numeric(chunk[feature], errors="coerce")
+    if fahrenheit:
+        # Same conversion as train.prepare_data
+        data[:, 4] = (data[:, 4] - 32) * 5 / 9
+
+    errors = predict.validate_batch(data)
+    valid = np.flatnonzero(errors == None)  # pylint: disable=singleton-comparison
+    risks = np.full(len(chunk), None, dtype=object)
+    if len(valid):
+        preds = predict.predict_batch(data[valid])
+        # As in convert_risk, any value other than 0 and 1 is a mid risk
+        risks[valid] = RISK_LEVELS[np.where((preds == 0) | (preds == 1), preds, 2)]
+
+    return chunk.assign(RiskLevel=risks, Error=errors)
+
+
+def score_chunks(chunks, workers=0, fahrenheit=False):
+    """
+    Scores DataFrames in order, optionally over a pool of processes with a
+    bounded number of chunks in flight
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield score_chunk(chunk, fahrenheit)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = collections.deque()
+        for chunk in chunks:
+            futures.append(executor.submit(score_chunk, chunk, fahrenheit))
+            if len(futures) >= 2 * workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def parse_args():
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="CSV, JSON lines or Parquet file")
+    parser.add_argument("output", help="CSV, JSON lines or Parquet file")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument(
+        "--workers", type=int, default=0, help="processes scoring the chunks"
+    )
+    parser.add_argument(
+        "--fahrenheit",
+        action="store_true",
+        help="body temperature in Fahrenheit, as in data/data.csv",
+    )
+    args = parser.parse_args()
+    for filename in [args.input, args.output]:
+        try:
+            file_format(filename)
+        except ValueError as error:
+            parser.error(str(error))
+    return args
+
+
+def main():
+    """
+    Scores a file chunk by chunk
+    """
+    args = parse_args()
+    start = time.perf_counter()
+    rows, errors = 0, 0
+
+    def counted(chunks):
+        nonlocal rows, errors
+        for chunk in chunks:
+            rows += len(chunk)
+            errors += int(chunk["Error"].notna().sum())
+            yield chunk
+
+    chunks = read_chunks(args.input, args.chunk_size)
+    write_chunks(
+        counted(score_chunks(chunks, args.workers, args.fahrenheit)),
+        args.output,
+    )
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Scored {rows} rows ({errors} invalid) in {elapsed:.1f}s, "
+        f"{rows / elapsed:.0f} rows/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
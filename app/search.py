@@ -0,0 +1,361 @@
+"""Hyperparameter search objectives module"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mlflow
+import xgboost as xgb
+from hyperopt import STATUS_OK
+from sklearn.svm import SVC
+from sklearn.metrics import accuracy_score
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from mlflow.utils.autologging_utils import disable_autologging
+
+MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI", "http://127.0.0.1:5000")
+EXPERIMENT_NAME = os.getenv("EXPERIMENT_NAME", "maternal-health-risk")
+PRUNING_ENABLED = os.getenv("PRUNING_ENABLED", "True") == "True"
+# XGBoost boosting rounds after which the trials can be pruned, each check
+# prunes about half of the remaining trials so they are kept few
+PRUNING_ROUNDS = (10, 30)
+# Fractions of the trees of the random forests after which the trials can be
+# pruned, the forests are grown with a warm start so no fit is repeated
+PRUNING_FRACTIONS = (0.25, 0.5)
+XGBOOST_ROUNDS = 100
+
+# Training data of the search objectives of the current process
+search_data = {}
+
+
+def init_search(data, flavor):
+    """
+    Sets the training data of the search objectives and the MLflow
+    autologging in the current process
+    """
+    search_data.clear()
+    search_data.update(data)
+    getattr(mlflow, flavor).autolog()
+
+
+def init_search_worker(data, flavor):
+    """
+    Initializes a search worker process
+    """
+    mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
+    mlflow.set_experiment(EXPERIMENT_NAME)
+    init_search(data, flavor)
+
+
+def start_trial_run():
+    """
+    Starts the MLflow run of a trial, tagged with the training cycle
+    """
+    return mlflow.start_run(tags={"training_cycle": search_data["training_cycle"]})
+
+
+def scaled_fold(index):
+    """
+    Returns the standardized training and validation data of a fold, the
+    scaler is fitted once per fold and search process
+    """
+    key = ("scaled_fold", index)
+    if key not in search_data:
+        train_index, val_index = search_data["folds"][index]
+        X, y = search_data["X"].to_numpy(), search_data["y"]
+        scaler = StandardScaler().fit(X[train_index])
+        search_data[key] = (
+            scaler.transform(X[train_index]),
+            y[train_index],
+            scaler.transform(X[val_index]),
+            y[val_index],
+        )
+    return search_data[key]
+
+
+def dmatrix_fold(index):
+    """
+    Returns the XGBoost training and validation matrices of a fold
+    """
+    key = ("dmatrix_fold", index)
+    if key not in search_data:
+        train_index, val_index = search_data["folds"][index]
+        X, y = search_data["X"], search_data["y"]
+        search_data[key] = (
+            xgb.DMatrix(X.iloc[train_index], label=y[train_index]),
+            xgb.DMatrix(X.iloc[val_index], label=y[val_index]),
+            y[val_index],
+        )
+    return search_data[key]
+
+
+def cross_validate(evaluate):
+    """
+    Evaluates all the folds in parallel, autologging is disabled since only
+    the final model is logged
+    """
+    n_folds = len(search_data["folds"])
+    with disable_autologging(), ThreadPoolExecutor(max_workers=n_folds) as executor:
+        return list(executor.map(evaluate, range(n_folds)))
+
+
+def should_prune(reference, step, loss):
+    """
+    Median stopping rule, a trial is pruned when its loss at a step is worse
+    than the median loss of the previous trials at the same step
+    """
+    return (
+        PRUNING_ENABLED
+        and reference is not None
+        and step < len(reference)
+        and loss > reference[step]
+    )
+
+
+class MedianPruningCallback(xgb.callback.TrainingCallback):
+    """
+    Stops the training of an XGBoost trial when its validation loss is worse
+    than the median of the previous trials at a pruning round
+    """
+
+    def __init__(self, reference):
+        super().__init__()
+        self.reference = reference
+        self.pruned = False
+
+    def after_iteration(self, model, epoch, evals_log):
+        if epoch + 1 not in PRUNING_ROUNDS:
+            return False
+        loss = next(iter(evals_log["validation"].values()))[-1]
+        self.pruned = should_prune(self.reference, epoch, loss)
+        return self.pruned
+
+
+def xgboost_objective(params, reference=None):
+    """
+    Trains and evaluates an XGBoost model, the validation loss curve is
+    returned for the pruning of the next trials
+    """
+    if "folds" in search_data:
+        return xgboost_cv_objective(params, reference)
+
+    if "train" not in search_data:
+        search_data["train"] = xgb.DMatrix(
+            search_data["X_train"], label=search_data["y_train"]
+        )
+        search_data["valid"] = xgb.DMatrix(
+            search_data["X_val"], label=search_data["y_val"]
+        )
+    valid = search_data["valid"]
+    pruning = MedianPruningCallback(reference)
+    evals_result = {}
+
+    with start_trial_run():
+        booster = xgb.train(
+            params=params,
+            dtrain=search_data["train"],
+            num_boost_round=XGBOOST_ROUNDS,
+            evals=[(valid, "validation")],
+            early_stopping_rounds=50,
+            callbacks=[pruning],
+            evals_result=evals_result,
+        )
+        y_pred = [round(x) for x in booster.predict(valid)]
+        accuracy = accuracy_score(search_data["y_val"], y_pred)
+        mlflow.log_metric("accuracy", accuracy)
+        mlflow.set_tag("pruned", pruning.pruned)
+
+    curve = next(iter(evals_result["validation"].values()))
+    return {
+        "loss": (-1) * accuracy,
+        "status": STATUS_OK,
+        "curve": curve,
+        "pruned": pruning.pruned,
+        # The rounds saved by early stopping are not saved by the pruning
+        "budget": len(curve) / XGBOOST_ROUNDS if pruning.pruned else 1.0,
+    }
+
+
+def forest_curve(clf, X_val, y_val):
+    """
+    Returns the validation loss of a fitted random forest pipeline with the
+    fractions of its trees of the pruning steps
+    """
+    forest = clf[-1]
+    X_val = clf[:-1].transform(X_val)
+    curve = []
+    for fraction in PRUNING_FRACTIONS:
+        trees = forest.estimators_[: max(1, int(len(forest.estimators_) * fraction))]
+        proba = np.mean([tree.predict_proba(X_val) for tree in trees], axis=0)
+        curve.append(-accuracy_score(y_val, forest.classes_[proba.argmax(axis=1)]))
+    return curve
+
+
+def grow_forest(clf, reference):
+    """
+    Grows the random forest of a pipeline with a warm start up to the
+    pruning steps, returns the result of the trial if it is pruned
+    """
+    X_train, y_train = search_data["X_train"], search_data["y_train"]
+    X_val, y_val = search_data["X_val"], search_data["y_val"]
+    forest = clf[-1]
+    n_estimators = forest.get_params()["n_estimators"]
+    forest.set_params(warm_start=True)
+    curve = []
+    # The steps are not logged
+    with disable_autologging():
+        for step, fraction in enumerate(PRUNING_FRACTIONS):
+            forest.set_params(n_estimators=max(1, int(n_estimators * fraction)))
+            clf.fit(X_train, y_train)
+            curve.append(-clf.score(X_val, y_val))
+            if should_prune(reference, step, curve[-1]):
+                return {
+                    "loss": curve[-1],
+                    "status": STATUS_OK,
+                    "curve": curve,
+                    "pruned": True,
+                    "budget": fraction,
+                }
+    forest.set_params(n_estimators=n_estimators)
+    return None
+
+
+def sklearn_objective(params, reference=None):
+    """
+    Trains and evaluates a scikit-learn model, a random forest is grown in
+    steps after which the trial can be pruned
+    """
+    classifier_type = params["type"]
+    del params["type"]
+
+    def make_estimator():
+        if classifier_type == "svm":
+            return SVC(**params)
+        return RandomForestClassifier(**params)
+
+    def make_classifier():
+        return make_pipeline(StandardScaler(), make_estimator())
+
+    if "folds" in search_data:
+        return sklearn_cv_objective(make_estimator, make_classifier, reference)
+
+    X_train, y_train = search_data["X_train"], search_data["y_train"]
+    X_val, y_val = search_data["X_val"], search_data["y_val"]
+    clf = make_classifier()
+
+    # An SVM cannot resume its fit, the pruning steps would be extra fits.
+    # Before the reference exists the forest is fitted at once and its curve
+    # computed from its trees afterwards
+    if PRUNING_ENABLED and classifier_type == "rf" and reference is not None:
+        result = grow_forest(clf, reference)
+        if result is not None:
+            return result
+
+    with start_trial_run():
+        clf.fit(X_train, y_train)
+        accuracy = clf.score(X_val, y_val)
+        mlflow.log_metric("accuracy", accuracy)
+
+    result = {
+        "loss": -accuracy,
+        "status": STATUS_OK,
+        "pruned": False,
+        "budget": 1.0,
+    }
+    # The SVM trials have no steps, their curve would skew the reference
+    if classifier_type == "rf":
+        result["curve"] = forest_curve(clf, X_val, y_val) + [-accuracy]
+    return result
+
+
+def cv_result(scores, reference):
+    """
+    Returns the result of a cross-validated trial that is pruned, before the
+    final model is fitted, when its mean accuracy is worse than the median
+    """
+    loss = -float(np.mean(scores))
+    pruned = should_prune(reference, 0, loss)
+    n_folds = len(scores)
+    return {
+        "loss": loss,
+        "status": STATUS_OK,
+        "curve": [loss],
+        "pruned": pruned,
+        # The final fit counts as a fold
+        "budget": n_folds / (n_folds + 1) if pruned else 1.0,
+    }
+
+
+def log_cv_metrics(scores):
+    """
+    Logs the cross-validation accuracy of the final model, apart from the
+    validation accuracy of the split mode
+    """
+    mlflow.log_metrics(
+        {
+            "cv_accuracy": float(np.mean(scores)),
+            "cv_accuracy_std": float(np.std(scores)),
+        }
+    )
+    mlflow.set_tag("cv_folds", len(scores))
+
+
+def xgboost_cv_objective(params, reference=None):
+    """
+    Cross-validates an XGBoost model, the final model is trained on the whole
+    data with the mean number of boosting rounds of the folds
+    """
+    # Share the threads of the trial between the folds
+    n_folds = len(search_data["folds"])
+    fold_params = {**params, "nthread": max(1, params["nthread"] // n_folds)}
+
+    def evaluate(index):
+        train, valid, y_valid = dmatrix_fold(index)
+        booster = xgb.train(
+            params=fold_params,
+            dtrain=train,
+            num_boost_round=XGBOOST_ROUNDS,
+            evals=[(valid, "validation")],
+            early_stopping_rounds=50,
+            verbose_eval=False,
+        )
+        y_pred = [round(x) for x in booster.predict(valid)]
+        return accuracy_score(y_valid, y_pred), booster.best_iteration + 1
+
+    scores, rounds = zip(*cross_validate(evaluate))
+    result = cv_result(scores, reference)
+    if result["pruned"]:
+        return result
+
+    if "full" not in search_data:
+        search_data["full"] = xgb.DMatrix(search_data["X"], label=search_data["y"])
+    with start_trial_run():
+        xgb.train(
+            params=params,
+            dtrain=search_data["full"],
+            num_boost_round=round(np.mean(rounds)),
+        )
+        log_cv_metrics(scores)
+    return result
+
+
+def sklearn_cv_objective(make_estimator, make_classifier, reference=None):
+    """
+    Cross-validates a scikit-learn model on the standardized folds, the final
+    pipeline is fitted on the whole data
+    """
+
+    def evaluate(index):
+        X_train, y_train, X_val, y_val = scaled_fold(index)
+        return make_estimator().fit(X_train, y_train).score(X_val, y_val)
+
+    scores = cross_validate(evaluate)
+    result = cv_result(scores, reference)
+    if result["pruned"]:
+        return result
+
+    with start_trial_run():
+        make_classifier().fit(search_data["X"], search_data["y"])
+        log_cv_metrics(scores)
+    return result
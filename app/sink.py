@@ -0,0 +1,258 @@
+"""Monitoring sink module"""
+
+import os
+import queue
+import atexit
+import asyncio
+import logging
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MonitoringSink:  # pylint: disable=too-many-instance-attributes
+    """
+    Buffers prediction records in a bounded queue and hands them over in
+    batches to the flush functions from a background thread, the records are
+    counted by outcome in the optional counter
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        flush_functions,
+        batch_size=100,
+        flush_interval=1.0,
+        queue_size=10000,
+        block=False,
+        block_timeout=1.0,
+        counter=None,
+    ):
+        self.flush_functions = flush_functions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.block = block
+        self.block_timeout = block_timeout
+        self.counter = counter
+        self.submitted = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """
+        Starts the background writer of the current process, the thread
+        does not survive a fork so forked workers start their own
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid is None:
+                atexit.register(self.close)
+            elif self._pid != os.getpid():
+                # Records queued in the parent belong to the parent
+                self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="monitoring-sink", daemon=True
+            )
+            self._thread.start()
+
+    def submit(self, record):
+        """
+        Queues a record, when the queue is full the record is dropped
+        unless backpressure is enabled
+        """
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self._queue.put(record, block=self.block, timeout=self.block_timeout)
+            self._count("submitted")
+        except queue.Full:
+            self._count("dropped")
+
+    def submit_many(self, records):
+        """
+        Queues a list of records
+        """
+        for record in records:
+            self.submit(record)
+
+    def close(self, timeout=10.0):
+        """
+        Drains the queue and stops the background writer
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Monitoring sink queue did not drain, records are lost")
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+
+            if record is _STOP:
+                self._flush(batch)
+                return
+
+            if record is not None:
+                if not batch:
+                    deadline = monotonic() + self.flush_interval
+                batch.append(record)
+
+            if batch and (len(batch) >= self.batch_size or monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        for flush_function in self.flush_functions:
+            try:
+                flush_function(batch)
+            except Exception:  # pylint: disable=broad-except
+                self._count("failed", len(batch))
+                logger.exception("Monitoring sink flush failed")
+        self._count("flushed", len(batch))
+
+    def _count(self, outcome, records=1):
+        # The records are submitted from the request threads
+        with self._counts_lock:
+            setattr(self, outcome, getattr(self, outcome) + records)
+        if self.counter is not None:
+            self.counter.labels(outcome=outcome).inc(records)
+
+
+class AsyncMonitoringSink:  # pylint: disable=too-many-instance-attributes
+    """
+    Buffers prediction records in a bounded asyncio queue and hands them over
+    in batches to the flush coroutines from a background task, the records
+    are counted by outcome in the optional counter
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        flush_functions,
+        batch_size=100,
+        flush_interval=1.0,
+        queue_size=10000,
+        block=False,
+        block_timeout=1.0,
+        counter=None,
+    ):
+        self.flush_functions = flush_functions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.block = block
+        self.block_timeout = block_timeout
+        self.counter = counter
+        self.submitted = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """
+        Starts the background writer in the running event loop
+        """
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, record):
+        """
+        Queues a record, when the queue is full the record is dropped
+        unless backpressure is enabled
+        """
+        try:
+            if self.block:
+                await asyncio.wait_for(self._queue.put(record), self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            self._count("submitted")
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            self._count("dropped")
+
+    async def submit_many(self, records):
+        """
+        Queues a list of records
+        """
+        for record in records:
+            await self.submit(record)
+
+    async def close(self, timeout=10.0):
+        """
+        Drains the queue and stops the background writer
+        """
+        if self._task is None or self._task.done():
+            return
+        try:
+            await asyncio.wait_for(self._queue.put(_STOP), timeout)
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Monitoring sink queue did not drain, records are lost")
+            self._task.cancel()
+
+    async def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            try:
+                record = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                record = None
+
+            if record is _STOP:
+                await self._flush(batch)
+                return
+
+            if record is not None:
+                if not batch:
+                    deadline = monotonic() + self.flush_interval
+                batch.append(record)
+
+            if batch and (len(batch) >= self.batch_size or monotonic() >= deadline):
+                await self._flush(batch)
+                batch = []
+                deadline = None
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        # The flush functions write to independent services concurrently
+        results = await asyncio.gather(
+            *(flush_function(batch) for flush_function in self.flush_functions),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                self._count("failed", len(batch))
+                logger.error("Monitoring sink flush failed", exc_info=result)
+        self._count("flushed", len(batch))
+
+    def _count(self, outcome, records=1):
+        setattr(self, outcome, getattr(self, outcome) + records)
+        if self.counter is not None:
+            self.counter.labels(outcome=outcome).inc(records)
@@ -0,0 +1,114 @@
+"""testing module for asynchronous prediction functions"""
+
+import asyncio
+import threading
+
+import asgi
+import httpx
+import pytest
+import predict
+
+flask_client = predict.app.test_client()
+
+
+def run_requests(requests):
+    """
+    Runs a coroutine sending requests to the served ASGI application
+    """
+
+    async def run():
+        async with asgi.lifespan(asgi.app):
+            transport = httpx.ASGITransport(app=asgi.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                return await requests(client)
+
+    return asyncio.run(run())
+
+
+def test_predict_json_endpoint():
+    """
+    Tests that the JSON predict endpoint responds as the Flask one
+    """
+    records = [
+        predict.WARM_UP_RECORD,
+        dict(predict.WARM_UP_RECORD, Age=60),
+        {"Age": 20},
+    ]
+
+    async def requests(client):
+        return await asyncio.gather(
+            *(client.post('/predict', json=record) for record in records)
+        )
+
+    for record, response in zip(records, run_requests(requests)):
+        expected = flask_client.post('/predict', json=record)
+        assert response.status_code == 200
+        assert response.content == expected.get_data()
+        assert response.headers["X-Model-Version"] == "default"
+
+
+def test_predict_batch_json_endpoint():
+    """
+    Tests that the batch predict endpoint responds as the Flask one
+    """
+    records = [predict.WARM_UP_RECORD, dict(predict.WARM_UP_RECORD, BS=20)]
+
+    async def requests(client):
+        return (
+            await client.post('/predict/batch', json=records),
+            await client.post('/predict/batch', json=predict.WARM_UP_RECORD),
+        )
+
+    response, error_response = run_requests(requests)
+    expected = flask_client.post('/predict/batch', json=records)
+    assert response.content == expected.get_data()
+    assert error_response.status_code == 400
+
+
+def test_predict_form_endpoint():
+    """
+    Tests the prediction form endpoint, the static files and the metrics
+    """
+    form = {feature: str(value) for feature, value in predict.WARM_UP_RECORD.items()}
+
+    async def requests(client):
+        return (
+            await client.get('/'),
+            await client.post('/', data=form),
+            await client.post('/', data=dict(form, Age="60")),
+            await client.get('/static/style.css'),
+            await client.get('/metrics/'),
+        )
+
+    form_page, risk_page, error_page, style, metrics = run_requests(requests)
+    assert '/static/style.css' in form_page.text
+    assert 'alert-success' in risk_page.text
+    assert 'Low risk' in risk_page.text
+    assert predict.AGE_ERROR in error_page.text
+    assert style.status_code == 200
+    assert 'predictions_total' in metrics.text
+
+
+def test_save_to_db_thread(monkeypatch):
+    """
+    Tests that the Mongo writes run in the database thread, shut down with
+    the application
+    """
+    threads = []
+    monkeypatch.setattr(
+        predict,
+        "save_to_db",
+        lambda records: threads.append(threading.current_thread().name),
+    )
+
+    async def run():
+        async with asgi.lifespan(asgi.app):
+            await asgi.save_to_db([predict.WARM_UP_RECORD])
+        return asgi.database_executor
+
+    executor = asyncio.run(run())
+    assert threads[0].startswith("database")
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
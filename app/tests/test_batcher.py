@@ -0,0 +1,72 @@
+"""testing module for prediction micro-batching functions"""
+
+import threading
+
+import pytest
+from batcher import MicroBatcher
+
+
+def run_concurrently(batcher, rows, loaded_model="model"):
+    """
+    Predicts each row from its own thread, returns the results and errors
+    """
+    results = [None] * len(rows)
+    start = threading.Barrier(len(rows))
+
+    def predict(i):
+        start.wait()
+        try:
+            results[i] = batcher.predict(rows[i], loaded_model)
+        except ValueError as error:
+            results[i] = error
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(rows))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batcher_coalesces_predictions():
+    """
+    Tests that concurrent predictions are coalesced in bounded batches and
+    that each caller gets its own result
+    """
+    batch_sizes = []
+
+    def predict_batch(data, _loaded_model):
+        batch_sizes.append(len(data))
+        return data[:, 0] * 10
+
+    batcher = MicroBatcher(predict_batch, max_batch_size=8, max_latency=0.5)
+    results = run_concurrently(batcher, [[i, 0] for i in range(20)])
+
+    assert results == [i * 10 for i in range(20)]
+    assert sum(batch_sizes) == 20
+    assert max(batch_sizes) == 8
+    assert len(batch_sizes) < 20
+
+
+def test_batcher_latency():
+    """
+    Tests that a lone prediction waits at most the maximum latency
+    """
+    batcher = MicroBatcher(lambda data, model: data[:, 0], max_latency=0.01)
+    assert batcher.predict([1, 2], "model") == 1
+
+
+def test_batcher_errors():
+    """
+    Tests that a failing model call raises in every caller of the batch
+    """
+
+    def predict_batch(data, loaded_model):
+        raise ValueError(loaded_model)
+
+    batcher = MicroBatcher(predict_batch, max_batch_size=4, max_latency=0.5)
+    results = run_concurrently(batcher, [[i] for i in range(4)])
+    assert all(isinstance(result, ValueError) for result in results)
+
+    with pytest.raises(ValueError):
+        batcher.predict([0], "model")
@@ -0,0 +1,57 @@
+"""testing module for the inference benchmark functions"""
+
+import predict
+import benchmark
+
+
+def result(seconds):
+    """
+    Returns a benchmark result of the given time
+    """
+    return {"seconds": seconds, "min_seconds": seconds, "us_per_record": 0.0}
+
+
+def test_compare_engines(monkeypatch):
+    """
+    Tests that only the batches run by the compiled engine are compared with
+    the native engine
+    """
+    monkeypatch.setattr(predict, "COMPILED_MODEL_MAX_ROWS", 64)
+    results = {
+        "xgboost/native/predict_batch/10": result(1.0),
+        "xgboost/compiled/predict_batch/10": result(0.5),
+        "sklearn/native/predict_batch/10": result(1.0),
+        "sklearn/compiled/predict_batch/10": result(1.5),
+        # Run by the native engine in both cases
+        "xgboost/native/predict_batch/1000": result(1.0),
+        "xgboost/compiled/predict_batch/1000": result(2.0),
+        # Not a batch prediction
+        "xgboost/native/predict/10": result(1.0),
+        "xgboost/compiled/predict/10": result(2.0),
+        # No native result
+        "sklearn/compiled/predict_batch/1": result(2.0),
+    }
+
+    regressions = benchmark.compare_engines(results, threshold=1.2)
+
+    assert regressions == ["sklearn/compiled/predict_batch/10"]
+
+
+def test_compare():
+    """
+    Tests that the benchmarks slower than the baseline are reported
+    """
+    baseline = {
+        "xgboost/native/predict/1": result(1.0),
+        "xgboost/native/predict_batch/1": result(1.0),
+    }
+    results = {
+        "xgboost/native/predict/1": result(1.1),
+        "xgboost/native/predict_batch/1": result(1.3),
+        # Not in the baseline
+        "xgboost/native/validate_batch/1": result(5.0),
+    }
+
+    regressions = benchmark.compare(results, baseline, threshold=1.2)
+
+    assert regressions == ["xgboost/native/predict_batch/1"]
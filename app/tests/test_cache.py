@@ -0,0 +1,45 @@
+"""testing module for prediction cache functions"""
+
+import time
+
+from cache import PredictionCache
+
+
+def test_cache_lru_eviction():
+    """
+    Tests that the least recently used keys are evicted
+    """
+    cache = PredictionCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+
+
+def test_cache_ttl_expiration():
+    """
+    Tests that expired keys are not returned
+    """
+    cache = PredictionCache(10, ttl=0.01)
+    cache.put("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 1, 1)
+
+
+def test_cache_clear():
+    """
+    Tests that clearing the cache removes all the keys
+    """
+    cache = PredictionCache(10)
+    cache.put("a", 1)
+    cache.clear()
+
+    assert cache.get("a") is None
@@ -0,0 +1,244 @@
+"""testing module for prediction log retention functions"""
+
+import datetime
+from types import SimpleNamespace
+
+import pytest
+import clean_mongo_database
+from bson import ObjectId
+
+NOW = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+OLD_HOUR = (NOW - datetime.timedelta(days=40)).replace(
+    minute=0, second=0, microsecond=0
+)
+RECORD = {
+    "Age": 25,
+    "SystolicBP": 130,
+    "DiastolicBP": 80,
+    "BS": 15,
+    "BodyTemp": 36.7,
+    "HeartRate": 86,
+}
+
+
+def matches(document, query):
+    """
+    Matches a document against the queries of the retention job
+    """
+    for field, condition in query.items():
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        if "$exists" in condition and (field in document) != condition["$exists"]:
+            return False
+        if "$in" in condition and value not in condition["$in"]:
+            return False
+        if "$gte" in condition and (value is None or value < condition["$gte"]):
+            return False
+        if "$lt" in condition and (value is None or value >= condition["$lt"]):
+            return False
+    return True
+
+
+class FakeCollection:
+    """
+    Mongo collection holding its documents in a list
+    """
+
+    def __init__(self, documents=()):
+        self.documents = [dict(document) for document in documents]
+        self.updates = []
+        self.deletes = []
+
+    def find(self, query, projection=None, limit=0, batch_size=None, sort=None):
+        """
+        Returns the matching documents, sorted by a single field
+        """
+        # pylint: disable=unused-argument
+        found = [document for document in self.documents if matches(document, query)]
+        if sort:
+            ((field, direction),) = sort
+            found.sort(key=lambda document: document[field], reverse=direction < 0)
+        if limit:
+            found = found[:limit]
+        if projection and any(projection.values()):
+            return [
+                {field: document[field] for field in projection if field in document}
+                for document in found
+            ]
+        return [
+            {
+                field: value
+                for field, value in document.items()
+                if field not in (projection or {})
+            }
+            for document in found
+        ]
+
+    def find_one(self, query, projection=None, sort=None):
+        """
+        Returns the first matching document
+        """
+        found = self.find(query, projection, limit=1, sort=sort)
+        return found[0] if found else None
+
+    def insert_one(self, document):
+        """
+        Inserts a document
+        """
+        self.documents.append(dict(document))
+
+    def update_many(self, query, pipeline):
+        """
+        Sets the timestamp of the matching documents to their insertion time,
+        recording the batch sizes
+        """
+        assert pipeline == [{"$set": {"timestamp": {"$toDate": "$_id"}}}]
+        found = [document for document in self.documents if matches(document, query)]
+        for document in found:
+            document["timestamp"] = document["_id"].generation_time.replace(tzinfo=None)
+        self.updates.append(len(found))
+        return SimpleNamespace(modified_count=len(found))
+
+    def delete_many(self, query):
+        """
+        Deletes the matching documents, recording the batch sizes
+        """
+        found = [document for document in self.documents if matches(document, query)]
+        self.documents = [
+            document for document in self.documents if document not in found
+        ]
+        self.deletes.append(len(found))
+        return SimpleNamespace(deleted_count=len(found))
+
+
+class FakeDatabase:  # pylint: disable=too-few-public-methods
+    """
+    Mongo database of fake collections
+    """
+
+    def __init__(self, predictions):
+        self.collections = {
+            clean_mongo_database.EXPERIMENT_NAME: FakeCollection(predictions),
+            clean_mongo_database.ROLLUP_COLLECTION: FakeCollection(),
+        }
+
+    def get_collection(self, name):
+        """
+        Returns a collection
+        """
+        return self.collections[name]
+
+
+def prediction(timestamp, risk="high risk", **record):
+    """
+    Returns a prediction log document
+    """
+    return dict(
+        RECORD,
+        **record,
+        _id=ObjectId(),
+        RiskLevel=risk,
+        timestamp=timestamp,
+        model_version="1",
+        request_id="abc",
+    )
+
+
+@pytest.fixture(name="database")
+def fixture_database(monkeypatch):
+    """
+    Returns a database holding two old hours and a recent one of predictions
+    """
+    monkeypatch.setattr(clean_mongo_database, "RETENTION_BATCH_SIZE", 2)
+    monkeypatch.setattr(clean_mongo_database, "RETENTION_PAUSE", 0)
+    hour = clean_mongo_database.HOUR
+    return FakeDatabase(
+        [
+            prediction(OLD_HOUR + datetime.timedelta(minutes=5), Age=20),
+            prediction(OLD_HOUR + datetime.timedelta(minutes=10), Age=30),
+            prediction(OLD_HOUR + datetime.timedelta(minutes=50), "low risk", Age=40),
+            prediction(OLD_HOUR + 3 * hour, "mid risk"),
+            prediction(NOW - datetime.timedelta(days=1)),
+        ]
+    )
+
+
+def test_hourly_rollup():
+    """
+    Tests the aggregates of an hour of predictions
+    """
+    rollup = clean_mongo_database.HourlyRollup(OLD_HOUR)
+    rollup.add([dict(RECORD, RiskLevel="high risk"), dict(RECORD, Age=31)])
+    rollup.add([dict(RECORD, BS=None, RiskLevel="low risk")])
+    document = rollup.to_document()
+
+    assert document["_id"] == OLD_HOUR
+    assert document["count"] == 3
+    assert document["features"]["Age"]["mean"] == 27
+    assert document["features"]["BS"]["count"] == 2
+    assert document["features"]["BS"]["mean"] == 15
+    # The maximum value is counted in the last bin
+    assert document["features"]["BS"]["histogram"][-1] == 2
+    assert sum(document["features"]["Age"]["histogram"]) == 3
+    assert document["risk_levels"] == {"high risk": 1, "None": 1, "low risk": 1}
+    assert document["model_versions"] == {"None": 3}
+
+
+def test_apply_retention(database):
+    """
+    Tests that the old predictions are rolled up by hour, then deleted in
+    batches
+    """
+    clean_mongo_database.apply_retention(database, 30)
+
+    predictions = database.get_collection(clean_mongo_database.EXPERIMENT_NAME)
+    assert len(predictions.documents) == 1
+    assert predictions.deletes == [2, 1, 1]
+
+    rollups = database.get_collection(clean_mongo_database.ROLLUP_COLLECTION)
+    first, second = rollups.documents
+    assert first["_id"] == OLD_HOUR
+    assert first["count"] == 3
+    assert first["features"]["Age"]["mean"] == 30
+    assert first["risk_levels"] == {"high risk": 2, "low risk": 1}
+    assert first["model_versions"] == {"1": 3}
+    assert second["_id"] == OLD_HOUR + 3 * clean_mongo_database.HOUR
+    assert second["risk_levels"] == {"mid risk": 1}
+
+
+def test_apply_retention_resumes(database):
+    """
+    Tests that a run resuming an interrupted one keeps the stored rollup of
+    an hour whose predictions were partly deleted
+    """
+    predictions = database.get_collection(clean_mongo_database.EXPERIMENT_NAME)
+    rollups = database.get_collection(clean_mongo_database.ROLLUP_COLLECTION)
+    clean_mongo_database.roll_up_hour(predictions, rollups, OLD_HOUR)
+    predictions.delete_many({"_id": {"$in": [predictions.documents[0]["_id"]]}})
+
+    clean_mongo_database.apply_retention(database, 30)
+    assert len(predictions.documents) == 1
+    assert [rollup["count"] for rollup in rollups.documents] == [3, 1]
+
+
+def test_backfill_timestamps(database):
+    """
+    Tests that the predictions logged without a timestamp are rolled up by
+    their insertion time, backfilled in batches
+    """
+    predictions = database.get_collection(clean_mongo_database.EXPERIMENT_NAME)
+    for second in range(3):
+        legacy = prediction(None)
+        legacy["_id"] = ObjectId.from_datetime(
+            OLD_HOUR + datetime.timedelta(seconds=second)
+        )
+        del legacy["timestamp"]
+        predictions.documents.append(legacy)
+
+    clean_mongo_database.apply_retention(database, 30)
+    assert predictions.updates == [2, 1]
+    rollups = database.get_collection(clean_mongo_database.ROLLUP_COLLECTION)
+    assert rollups.documents[0]["count"] == 6
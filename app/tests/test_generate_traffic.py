@@ -0,0 +1,96 @@
+"""testing module for requests simulation functions"""
+
+import json
+import time
+import asyncio
+
+import numpy as np
+import pytest
+import aiohttp
+import generate_traffic
+from aiohttp import web
+
+
+def test_send_request_timeout():
+    """
+    Tests that a request exceeding the timeout counts as a failed one
+    """
+
+    async def handler(request):
+        await asyncio.sleep(float(request.query.get("delay", 0)))
+        return web.json_response({"risk": "low risk"})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/predict", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        stats = generate_traffic.LoadStats()
+        timeout = aiohttp.ClientTimeout(total=0.2)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                for delay in (0, 1):
+                    url = f"http://127.0.0.1:{port}/predict?delay={delay}"
+                    await generate_traffic.send_request(
+                        session, url, b"{}", stats, time.perf_counter()
+                    )
+        finally:
+            await runner.cleanup()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats.count == 2
+    assert stats.errors == 1
+
+
+def test_report():
+    """
+    Tests the error rate and the latency percentiles of the report, within
+    the precision of the latency buckets
+    """
+    stats = generate_traffic.LoadStats()
+    assert stats.report()["error_rate"] == 0.0
+    assert "latency_ms" not in stats.report()
+
+    for i in range(1, 1001):
+        stats.record(i / 1000, ok=i % 10 != 0)
+    report = stats.report()
+
+    assert report["requests"] == 1000
+    assert report["errors"] == 100
+    assert report["error_rate"] == 0.1
+    latency = report["latency_ms"]
+    assert latency["mean"] == pytest.approx(500.5)
+    assert latency["max"] == pytest.approx(1000)
+    for name, expected in (("p50", 500), ("p90", 900), ("p99", 990)):
+        assert latency[name] == pytest.approx(expected, rel=0.05)
+
+
+def test_report_outer_buckets():
+    """
+    Tests that the latencies outside of the buckets range are bounded by the
+    range and the maximum latency
+    """
+    stats = generate_traffic.LoadStats()
+    stats.record(1e-7, ok=True)
+    stats.record(1e4, ok=True)
+
+    assert stats.percentiles([50, 100]).tolist() == [generate_traffic.LATENCY_MIN, 1e4]
+
+
+def test_generate_payloads():
+    """
+    Tests that the payloads are reproducible and within two standard
+    deviations from the means
+    """
+    payloads = generate_traffic.generate_payloads(100, seed=1)
+
+    assert len(payloads) == 100
+    assert payloads == generate_traffic.generate_payloads(100, seed=1)
+    values = np.array([list(json.loads(payload).values()) for payload in payloads])
+    assert list(json.loads(payloads[0])) == generate_traffic.FEATURES
+    assert np.all(values >= generate_traffic.MEANS - 2 * generate_traffic.STDS)
+    assert np.all(values <= generate_traffic.MEANS + 2 * generate_traffic.STDS)
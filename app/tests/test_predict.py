@@ -1,8 +1,21 @@
 """testing module for prediction functions"""
 
+import os
 import json
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import train
+import pandas as pd
 import predict
+import compiled
+from pymongo.errors import OperationFailure
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+DATA_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "data", "data.csv")
 
 client = predict.app.test_client()
 
@@ -164,3 +177,452 @@ def test_predict_json_endpoint():
         headers=HEADER,
     )
     assert response.json['RiskLevel'] == 'high risk'
+
+
+def test_validate_batch():
+    """
+    Tests the validate_batch function
+    """
+    records = [
+        {
+            "Age": 20,
+            "SystolicBP": 120,
+            "DiastolicBP": 70,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 60,
+        },
+        {
+            "Age": 60,
+            "SystolicBP": 120,
+            "DiastolicBP": 70,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 60,
+        },
+        {
+            "Age": 20,
+            "SystolicBP": 70,
+            "DiastolicBP": 120,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 60,
+        },
+        {
+            "Age": 20,
+            "SystolicBP": 120,
+            "DiastolicBP": 70,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 200,
+        },
+    ]
+    errors = predict.validate_batch(predict.records_to_array(records))
+    assert list(errors) == [predict.validate_data(record) for record in records]
+
+    errors = predict.validate_batch(
+        predict.records_to_array([{"Age": 20}, {**records[0], "BS": "high"}])
+    )
+    assert list(errors) == [predict.MISSING_DATA_ERROR, predict.MISSING_DATA_ERROR]
+
+
+def test_predict_batch_json_endpoint():
+    """
+    Tests the JSON batch predict endpoint
+    """
+    PREDICT_BATCH_URL = '/predict/batch'
+    HEADER = {'Content-Type': 'application/json'}
+
+    test_data = [
+        {
+            "Age": 20,
+            "SystolicBP": 120,
+            "DiastolicBP": 70,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 60,
+        },
+        {
+            "Age": 60,
+            "SystolicBP": 120,
+            "DiastolicBP": 70,
+            "BS": 2.0,
+            "BodyTemp": 36,
+            "HeartRate": 60,
+        },
+        {
+            "Age": 45,
+            "SystolicBP": 160,
+            "DiastolicBP": 90,
+            "BS": 10,
+            "BodyTemp": 38,
+            "HeartRate": 70,
+        },
+    ]
+    response = client.post(
+        PREDICT_BATCH_URL,
+        data=json.dumps(test_data),
+        headers=HEADER,
+    )
+    assert response.json == [
+        {'RiskLevel': 'low risk'},
+        {'Error': 'Age should be between 13 and 50 years'},
+        {'RiskLevel': 'high risk'},
+    ]
+
+    response = client.post(
+        PREDICT_BATCH_URL,
+        data=json.dumps(test_data[0]),
+        headers=HEADER,
+    )
+    assert response.status_code == 400
+
+
+def test_compiled_model_parity():
+    """
+    Tests the compiled models against the original ones
+    """
+    X, y = train.prepare_data.fn(pd.read_csv(DATA_FILE))
+    X = X.astype(float)
+
+    assert predict.current_model.compiled_model is not None
+    model = predict.current_model.model
+    xgboost_model = compiled.TreeEnsemble(compiled.flatten_model(model))
+    expected = model.predict(X)
+    preds = xgboost_model.predict(X.to_numpy())
+    assert np.allclose(preds, expected, atol=1e-4)
+    assert np.array_equal(np.rint(preds), np.rint(expected))
+
+    clf = make_pipeline(
+        StandardScaler(), RandomForestClassifier(max_depth=5, random_state=1)
+    )
+    clf.fit(X, y)
+    rf_model = compiled.TreeEnsemble(compiled.flatten_model(clf))
+    assert np.array_equal(rf_model.predict(X.to_numpy()), clf.predict(X))
+
+
+def test_predict_batch_engine(monkeypatch):
+    """
+    Tests that the compiled tables predict the small batches only
+    """
+    monkeypatch.setattr(predict, "COMPILED_MODEL_MAX_ROWS", 2)
+    compiled_model = SimpleNamespace(predict=lambda data: np.full(len(data), 7.0))
+    loaded_model = predict.current_model._replace(compiled_model=compiled_model)
+    data = predict.records_to_array([predict.WARM_UP_RECORD] * 3)
+
+    assert predict.predict_batch(data[:2], loaded_model).tolist() == [7, 7]
+    native = predict.predict_batch(
+        data, predict.current_model._replace(compiled_model=None)
+    )
+    assert np.array_equal(predict.predict_batch(data, loaded_model), native)
+
+
+def test_reload_model(monkeypatch):
+    """
+    Tests that a new registry version is swapped in
+    """
+    original_model = predict.current_model
+    monkeypatch.setattr(predict, "get_latest_model_version", lambda: "7")
+    monkeypatch.setattr(
+        predict, "load_model_from_registry", lambda version: original_model.model
+    )
+    try:
+        assert predict.reload_model()
+        assert predict.current_model.version == "7"
+        assert not predict.reload_model()
+
+        response = client.post('/predict', json=predict.WARM_UP_RECORD)
+        assert response.headers['X-Model-Version'] == "7"
+        assert response.json['RiskLevel'] == 'low risk'
+
+        metrics = client.get('/metrics').get_data(as_text=True)
+        assert 'model_version_info{version="7"} 1.0' in metrics
+        assert 'version="default"' not in metrics
+    finally:
+        predict.set_model(original_model)
+
+
+def test_prediction_cache():
+    """
+    Tests that predictions of canonical records are cached and warmed up
+    """
+    cache = predict.prediction_cache
+    cache.clear()
+    record = dict(predict.WARM_UP_RECORD, BS=7.0)
+
+    hits = cache.hits
+    assert predict.predict(record) == predict.predict(dict(record))
+    assert cache.hits == hits + 1
+
+    predict.warm_prediction_cache(DATA_FILE)
+    assert len(cache) > 100
+    hits = cache.hits
+    assert (
+        predict.predict(
+            {
+                "Age": 25,
+                "SystolicBP": 130,
+                "DiastolicBP": 80,
+                "BS": 15,
+                "BodyTemp": 36.7,
+                "HeartRate": 86,
+            }
+        )
+        == 0
+    )
+    assert cache.hits == hits + 1
+
+    predict.set_model(predict.current_model)
+    assert len(cache) == 0
+
+
+def test_prediction_cache_exact(monkeypatch):
+    """
+    Tests that the cache does not change the predictions of records finer
+    than the form resolution
+    """
+    model = SimpleNamespace(predict=lambda data: data["BS"].to_numpy() * 100)
+    loaded_model = predict.LoadedModel(model, None, "exact")
+    records = [dict(predict.WARM_UP_RECORD, BS=bs) for bs in (7.04, 7.0, 7.04)]
+
+    monkeypatch.setattr(predict, "prediction_cache", None)
+    uncached = [predict.predict(record, loaded_model) for record in records]
+    monkeypatch.undo()
+    cached = [predict.predict(record, loaded_model) for record in records]
+
+    assert uncached == [704, 700, 704]
+    assert cached == uncached
+
+
+def test_prediction_metrics():
+    """
+    Tests the prediction stage, risk level and validation failure metrics
+    """
+    registry = predict.prometheus_client.REGISTRY
+
+    def sample(name, **labels):
+        return registry.get_sample_value(name, labels) or 0
+
+    predictions = sample("predictions_total", risk_level="low risk")
+    age_failures = sample("validation_failures_total", rule="age")
+    predict_stages = sample("prediction_stage_duration_seconds_count", stage="predict")
+
+    client.post('/predict', json=predict.WARM_UP_RECORD)
+    client.post('/predict', json=dict(predict.WARM_UP_RECORD, Age=60))
+    client.post(
+        '/predict/batch',
+        json=[predict.WARM_UP_RECORD, dict(predict.WARM_UP_RECORD, Age=60)],
+    )
+
+    assert sample("predictions_total", risk_level="low risk") == predictions + 2
+    assert sample("validation_failures_total", rule="age") == age_failures + 2
+    assert (
+        sample("prediction_stage_duration_seconds_count", stage="predict")
+        == predict_stages + 1
+    )
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert 'prediction_stage_duration_seconds_count{stage="parse"}' in metrics
+    assert "model_load_duration_seconds_count" in metrics
+
+
+def test_profiler_endpoints(monkeypatch):
+    """
+    Tests the profiler admin endpoints
+    """
+    assert client.get('/admin/profiler').status_code == 404
+
+    monkeypatch.setattr(predict, "PROFILER_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+    assert client.get('/admin/profiler').status_code == 401
+    response = client.post('/admin/profiler', json={"sample_rate": -1}, headers=headers)
+    assert response.status_code == 400
+    try:
+        response = client.post(
+            '/admin/profiler', json={"sample_rate": 1}, headers=headers
+        )
+        assert response.json["sample_rate"] == 1
+        assert client.get('/admin/profiler/stats', headers=headers).status_code == 404
+
+        client.post('/predict', json=predict.WARM_UP_RECORD)
+        report = client.get('/admin/profiler', headers=headers).json
+        assert report["sampled"] == 1
+        (slowest,) = report["slowest"]
+        assert slowest["endpoint"] == "predict_json_endpoint"
+        assert set(slowest["stages_ms"]) >= {"parse", "validate", "predict", "convert"}
+
+        response = client.get('/admin/profiler/stats', headers=headers)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/octet-stream"
+    finally:
+        predict.profiler.reset(predict.PROFILER_SAMPLE_RATE)
+
+
+def test_decode_record():
+    """
+    Tests the typed decoding of the JSON predict requests
+    """
+    record = predict.decode_record(
+        b'{"Age": "20", "SystolicBP": 120, "DiastolicBP": 70.0, "BS": "2.0", '
+        b'"BodyTemp": 36, "HeartRate": 60, "Name": "x"}'
+    )
+    assert record == {
+        "Age": 20.0,
+        "SystolicBP": 120.0,
+        "DiastolicBP": 70.0,
+        "BS": 2.0,
+        "BodyTemp": 36.0,
+        "HeartRate": 60.0,
+    }
+    assert predict.decode_record(b'{"Age": 20}') is None
+    assert predict.decode_record(b'{"Age": "twenty"}') is None
+    assert predict.decode_record(b'[1, 2]') is None
+    assert predict.decode_record(b'not json') is None
+    assert (
+        predict.decode_record(json.dumps(dict(predict.WARM_UP_RECORD, BS=float("nan"))))
+        is None
+    )
+
+
+def test_predict_json_endpoint_responses():
+    """
+    Tests that the pre-encoded responses match the jsonify ones
+    """
+    with predict.app.app_context():
+        for risk in predict.RISK_LEVELS:
+            assert predict.RISK_RESPONSES[risk] == (
+                predict.jsonify({"RiskLevel": risk}).get_data()
+            )
+
+        response = client.post('/predict', json=dict(predict.WARM_UP_RECORD, Age=60))
+        assert response.content_type == "application/json"
+        assert response.get_data() == (
+            predict.jsonify({"Error": predict.AGE_ERROR}).get_data()
+        )
+
+    response = client.post('/predict', json={"Age": 20})
+    assert response.json == {"Error": predict.MISSING_DATA_ERROR}
+
+
+def test_micro_batching(monkeypatch):
+    """
+    Tests that coalesced predictions match the single-record ones
+    """
+    records = [
+        dict(zip(predict.FEATURES, row))
+        for row in np.random.default_rng(1).uniform(
+            [13, 100, 60, 2, 36, 50], [50, 160, 90, 12, 39, 90], (50, 6)
+        )
+    ]
+    expected = [
+        predict.predict_record(record, predict.current_model) for record in records
+    ]
+
+    batcher = predict.MicroBatcher(predict.predict_batch, max_latency=0.05)
+    monkeypatch.setattr(predict, "micro_batcher", batcher)
+    with ThreadPoolExecutor(16) as executor:
+        preds = list(
+            executor.map(
+                lambda record: predict.predict_record(record, predict.current_model),
+                records,
+            )
+        )
+    assert preds == expected
+
+
+class FakeCollection:
+    """
+    Mongo collection recording the created indexes
+    """
+
+    def __init__(self, conflict=False):
+        self.indexes = []
+        self.dropped = []
+        self.conflict = conflict
+
+    def create_index(self, keys, **options):
+        """
+        Records an index, fails once on an options conflict
+        """
+        if self.conflict:
+            self.conflict = False
+            raise OperationFailure("Index with name: timestamp_1 already exists")
+        self.indexes.append((keys, options))
+
+    def drop_index(self, name):
+        """
+        Records a dropped index
+        """
+        self.dropped.append(name)
+
+
+def test_create_indexes(monkeypatch):
+    """
+    Tests the indexes of the prediction log
+    """
+    collection = FakeCollection()
+    predict.create_indexes(collection)
+    assert collection.indexes == [
+        ("timestamp", {}),
+        ([("model_version", 1), ("timestamp", 1)], {}),
+        ("request_id", {}),
+    ]
+
+    monkeypatch.setattr(predict, "PREDICTION_LOG_TTL_DAYS", 30)
+    collection = FakeCollection(conflict=True)
+    predict.create_indexes(collection)
+    assert collection.dropped == ["timestamp_1"]
+    assert collection.indexes[0] == ("timestamp", {"expireAfterSeconds": 2592000})
+
+
+def test_prediction_log_model_version(monkeypatch):
+    """
+    Tests that a prediction is logged with the version of the model that
+    computed it, even when another one is swapped in meanwhile
+    """
+    logged = []
+    monkeypatch.setattr(predict, "MONITORING_ENABLED", True)
+    monkeypatch.setattr(
+        predict, "monitoring_sink", SimpleNamespace(submit=logged.append), raising=False
+    )
+    version = predict.current_model.version
+
+    def predict_record(_record, loaded_model):
+        monkeypatch.setattr(
+            predict, "current_model", loaded_model._replace(version="swapped")
+        )
+        return 1
+
+    monkeypatch.setattr(predict, "predict_record", predict_record)
+    predict.calculate_risk(dict(predict.WARM_UP_RECORD, BS=2.01))
+
+    assert logged[0]["model_version"] == version
+
+
+def test_prediction_log(monkeypatch):
+    """
+    Tests that the logged predictions carry their time, model version and
+    request id, which are not sent to Evidently
+    """
+    logged = []
+    monkeypatch.setattr(predict, "MONITORING_ENABLED", True)
+    monkeypatch.setattr(
+        predict,
+        "monitoring_sink",
+        SimpleNamespace(submit=logged.append, submit_many=logged.extend),
+        raising=False,
+    )
+
+    client.post(
+        '/predict', json=predict.WARM_UP_RECORD, headers={"X-Request-ID": "abc"}
+    )
+    client.post('/predict/batch', json=[predict.WARM_UP_RECORD] * 2)
+
+    single, *batch = logged
+    assert single["request_id"] == "abc"
+    assert single["model_version"] == predict.current_model.version
+    assert single["timestamp"].tzinfo is not None
+    assert batch[0]["request_id"] == batch[1]["request_id"] != "abc"
+    assert (
+        predict.evidently_rows(logged)
+        == [dict(predict.WARM_UP_RECORD, RiskLevel="low risk")] * 3
+    )
@@ -0,0 +1,59 @@
+"""testing module for request profiler functions"""
+
+import time
+import pstats
+
+from profiler import RequestProfiler
+
+
+def slow_stage(duration):
+    """
+    Stage function of the profiled requests
+    """
+    time.sleep(duration)
+
+
+def handler(duration):
+    """
+    Request handler calling the stage function
+    """
+    slow_stage(duration)
+    return duration
+
+
+def test_profiler_sampling():
+    """
+    Tests that one request in every sample rate is profiled
+    """
+    profiler = RequestProfiler(3, stages={"stage": slow_stage})
+    for _ in range(7):
+        assert profiler.profile("handler", handler, 0) == 0
+    assert profiler.sampled == 3
+
+    profiler.reset(0)
+    profiler.profile("handler", handler, 0)
+    assert profiler.report() == {"sample_rate": 0, "sampled": 0, "slowest": []}
+    assert profiler.dump_stats() is None
+
+
+def test_profiler_slowest_requests(tmp_path):
+    """
+    Tests that the slowest requests are reported with their stage times and
+    that the aggregated profile is a pstats file
+    """
+    profiler = RequestProfiler(1, stages={"stage": slow_stage}, slowest_size=2)
+    for duration in [0.01, 0.03, 0.001, 0.02]:
+        profiler.profile("handler", handler, duration)
+
+    report = profiler.report()
+    assert report["sampled"] == 4
+    assert [request["endpoint"] for request in report["slowest"]] == ["handler"] * 2
+    slowest, second = report["slowest"]
+    assert slowest["duration_ms"] >= 30
+    assert 20 <= second["duration_ms"] < 30
+    assert 30 <= slowest["stages_ms"]["stage"] <= slowest["duration_ms"]
+
+    filename = tmp_path / "profile.pstats"
+    filename.write_bytes(profiler.dump_stats())
+    stats = pstats.Stats(str(filename))
+    assert any(key[2] == "slow_stage" for key in stats.stats)
@@ -0,0 +1,94 @@
+"""testing module for bulk scoring functions"""
+
+import numpy as np
+import score
+import pandas as pd
+import pytest
+import predict
+
+RECORDS = [
+    predict.WARM_UP_RECORD,
+    dict(predict.WARM_UP_RECORD, Age=60),
+    {"Age": 35, "SystolicBP": 130, "DiastolicBP": 90, "BS": 7.0, "BodyTemp": 36.5},
+    {
+        "Age": 45,
+        "SystolicBP": 160,
+        "DiastolicBP": 90,
+        "BS": 10,
+        "BodyTemp": 38,
+        "HeartRate": 70,
+    },
+    dict(predict.WARM_UP_RECORD, BS="high"),
+]
+
+
+def expected_results():
+    """
+    Returns the responses of the batch prediction endpoint
+    """
+    return predict.calculate_batch_risk([dict(record) for record in RECORDS])
+
+
+def check_results(scored):
+    """
+    Checks that scored rows match the batch prediction endpoint
+    """
+    for (_, row), expected in zip(scored.iterrows(), expected_results()):
+        if "RiskLevel" in expected:
+            assert row["RiskLevel"] == expected["RiskLevel"]
+            assert pd.isna(row["Error"])
+        else:
+            assert pd.isna(row["RiskLevel"])
+            assert row["Error"] == expected["Error"]
+
+
+def test_score_chunk():
+    """
+    Tests that the scored records match the batch prediction endpoint
+    """
+    scored = score.score_chunk(pd.DataFrame(RECORDS))
+    assert list(scored.columns) == predict.FEATURES + ["RiskLevel", "Error"]
+    check_results(scored)
+
+
+@pytest.mark.parametrize("extension", [".csv", ".jsonl", ".parquet"])
+def test_score_files(tmp_path, extension):
+    """
+    Tests scoring a file in chunks, over a pool of processes
+    """
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+    input_file = tmp_path / "input.csv"
+    pd.DataFrame(RECORDS * 3).to_csv(input_file, index=False)
+
+    output_file = str(tmp_path / f"output{extension}")
+    chunks = score.read_chunks(str(input_file), chunk_size=2)
+    score.write_chunks(score.score_chunks(chunks, workers=2), output_file)
+
+    scored = list(score.read_chunks(output_file, chunk_size=100))
+    assert len(scored) == 1
+    assert len(scored[0]) == len(RECORDS) * 3
+    check_results(scored[0].iloc[: len(RECORDS)])
+    check_results(scored[0].iloc[-len(RECORDS) :])
+
+
+def test_score_fahrenheit(monkeypatch):
+    """
+    Tests the conversion of body temperatures in Fahrenheit
+    """
+    record = dict(predict.WARM_UP_RECORD, BodyTemp=98.0)
+    scored = score.score_chunk(pd.DataFrame([record]), fahrenheit=True)
+    assert scored["RiskLevel"][0] == "low risk"
+
+    # Not rounded, as in the training data
+    batches = []
+    monkeypatch.setattr(
+        predict,
+        "predict_batch",
+        lambda data: batches.append(data) or np.zeros(1, dtype=int),
+    )
+    score.score_chunk(pd.DataFrame([dict(record, BodyTemp=98.6)]), fahrenheit=True)
+    assert batches[0][0, 4] == (98.6 - 32) * 5 / 9
+
+    scored = score.score_chunk(pd.DataFrame([{"Age": 20}]))
+    assert scored["Error"][0] == predict.MISSING_DATA_ERROR
@@ -0,0 +1,164 @@
+"""testing module for monitoring sink functions"""
+
+import asyncio
+import threading
+
+import prometheus_client
+from sink import MonitoringSink, AsyncMonitoringSink
+
+
+def test_sink_flushes_batches():
+    """
+    Tests that records are flushed in batches and drained on close
+    """
+    batches = []
+    sink = MonitoringSink([batches.append], batch_size=3, flush_interval=60)
+    sink.submit_many([{"id": i} for i in range(7)])
+    sink.close()
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [record["id"] for batch in batches for record in batch] == list(range(7))
+    assert sink.flushed == 7
+    assert sink.dropped == 0
+
+
+def test_sink_flushes_on_interval():
+    """
+    Tests that a partial batch is flushed once the flush interval expires
+    """
+    flushed = threading.Event()
+    batches = []
+
+    def flush(batch):
+        batches.append(batch)
+        flushed.set()
+
+    sink = MonitoringSink([flush], batch_size=100, flush_interval=0.05)
+    sink.submit({"id": 0})
+
+    assert flushed.wait(5)
+    assert batches == [[{"id": 0}]]
+    sink.close()
+
+
+def test_sink_drops_when_full():
+    """
+    Tests that records are dropped and counted when the queue is full
+    """
+    release = threading.Event()
+    sink = MonitoringSink(
+        [lambda batch: release.wait(5)], batch_size=1, flush_interval=60, queue_size=1
+    )
+    sink.submit_many([{"id": i} for i in range(10)])
+
+    assert sink.dropped > 0
+    assert sink.submitted + sink.dropped == 10
+    release.set()
+    sink.close()
+
+
+def test_sink_survives_flush_errors():
+    """
+    Tests that a failing flush function does not stop the other ones
+    """
+    batches = []
+
+    def fail(batch):
+        raise ConnectionError(batch)
+
+    sink = MonitoringSink([fail, batches.append], batch_size=2, flush_interval=60)
+    sink.submit_many([{"id": 0}, {"id": 1}])
+    sink.close()
+
+    assert batches == [[{"id": 0}, {"id": 1}]]
+    assert sink.failed == 2
+
+
+def test_async_sink_flushes_batches():
+    """
+    Tests that the asynchronous sink flushes batches and survives errors
+    """
+    batches = []
+
+    async def flush(batch):
+        batches.append(batch)
+
+    async def fail(batch):
+        raise ConnectionError(batch)
+
+    async def run():
+        sink = AsyncMonitoringSink([fail, flush], batch_size=3, flush_interval=60)
+        sink.start()
+        await sink.submit_many([{"id": i} for i in range(7)])
+        await sink.close()
+        return sink
+
+    sink = asyncio.run(run())
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert sink.flushed == 7
+    assert sink.failed == 7
+
+
+def test_async_sink_flushes_on_interval():
+    """
+    Tests that the asynchronous sink flushes a partial batch on interval and
+    drops records when its queue is full
+    """
+    batches = []
+
+    async def flush(batch):
+        batches.append(batch)
+
+    async def run():
+        sink = AsyncMonitoringSink(
+            [flush], batch_size=100, flush_interval=0.05, queue_size=2
+        )
+        sink.start()
+        await sink.submit_many([{"id": i} for i in range(3)])
+        await asyncio.sleep(0.2)
+        await sink.close()
+        return sink
+
+    sink = asyncio.run(run())
+    assert batches == [[{"id": 0}, {"id": 1}]]
+    assert sink.dropped == 1
+
+
+def test_sink_counter():
+    """
+    Tests that the records are counted by outcome in the exported counter,
+    including those submitted concurrently
+    """
+    registry = prometheus_client.CollectorRegistry()
+    counter = prometheus_client.Counter(
+        "monitoring_records", "Records", ["outcome"], registry=registry
+    )
+    release = threading.Event()
+    sink = MonitoringSink(
+        [lambda batch: release.wait(5)],
+        batch_size=1,
+        flush_interval=60,
+        queue_size=10,
+        counter=counter,
+    )
+    threads = [
+        threading.Thread(target=sink.submit_many, args=([{"id": i}] * 100,))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+    sink.close()
+
+    def value(outcome):
+        return registry.get_sample_value(
+            "monitoring_records_total", {"outcome": outcome}
+        )
+
+    assert sink.dropped > 0
+    assert sink.submitted + sink.dropped == 400
+    assert value("submitted") == sink.submitted
+    assert value("dropped") == sink.dropped
+    assert value("flushed") == sink.flushed == sink.submitted
@@ -1,9 +1,37 @@
 """testing module for train functions"""
 
+import contextlib
+from types import SimpleNamespace
+
 import numpy as np
 import train
+import mlflow
 import pandas as pd
+import pytest
+import search
+from sklearn import metrics
 from deepdiff import DeepDiff
+from hyperopt import hp
+from mlflow.tracking import MlflowClient
+from prefect.utilities.importtools import load_script_as_module
+
+
+def sklearn_scorers():
+    """
+    Returns the scorers of scikit-learn, removed in scikit-learn 1.3, that
+    the MLflow 1.28 autologging of the searches needs
+    """
+    if hasattr(metrics, "SCORERS"):
+        return metrics.SCORERS
+    return {name: metrics.get_scorer(name) for name in metrics.get_scorer_names()}
+
+
+def init_search_worker(data, flavor):
+    """
+    Initializes a spawned search worker with the scikit-learn scorers
+    """
+    metrics.SCORERS = sklearn_scorers()
+    search.init_search_worker(data, flavor)
 
 
 def test_prepare_data():
@@ -63,3 +91,290 @@ def test_prepare_data():
     y_diff = DeepDiff(y_output_df, y_expected_df)
     print(f"y_diff={y_diff}")
     assert not y_diff
+
+
+def test_prepared_data_cache(tmp_path, monkeypatch):
+    """
+    Tests that the prepared data is cached and loaded back unchanged
+    """
+    monkeypatch.setattr(train, "PREPARED_DATA_DIR", str(tmp_path))
+    data_file = tmp_path / "data.csv"
+    data_file.write_text(
+        "Age,SystolicBP,DiastolicBP,BS,BodyTemp,HeartRate,RiskLevel\n"
+        + "25,130,80,15,98,86,high risk\n" * 5
+        + "35,140,90,13,98,70,low risk\n" * 5
+    )
+
+    path = train.prepared_data_path(str(data_file))
+    assert path == train.prepared_data_path(str(data_file))
+    monkeypatch.setattr(train, "MAX_AGE", 30)
+    assert path != train.prepared_data_path(str(data_file))
+
+    X, y = train.prepare_data.fn(pd.read_csv(data_file))
+    split = train.split_data.fn(X, y)
+    train.save_prepared_data.fn(path, *split)
+    X_train, X_val, y_train, y_val = train.load_prepared_data.fn(path)
+
+    assert list(X_train.columns) == list(X.columns)
+    assert np.array_equal(X_train.to_numpy(), split[0].to_numpy())
+    assert np.array_equal(X_val.to_numpy(), split[1].to_numpy())
+    assert np.array_equal(y_train, split[2])
+    assert np.array_equal(y_val, split[3])
+
+
+def test_median_pruning(monkeypatch):
+    """
+    Tests the median stopping rule of the hyperparameter search
+    """
+    monkeypatch.setattr(search, "PRUNING_ENABLED", True)
+    monkeypatch.setattr(train, "PRUNING_MIN_TRIALS", 3)
+    results = [
+        {"curve": [0.5, 0.4, 0.3]},
+        {"curve": [0.6, 0.5]},
+        {"curve": [0.7, 0.6, 0.5]},
+    ]
+
+    assert train.pruning_reference(SimpleNamespace(results=results[:2])) is None
+    reference = train.pruning_reference(SimpleNamespace(results=results))
+    assert reference == [0.6, 0.5]
+
+    assert search.should_prune(reference, 0, 0.65)
+    assert not search.should_prune(reference, 0, 0.55)
+    assert not search.should_prune(reference, 2, 0.9)
+    assert not search.should_prune(None, 0, 0.9)
+
+
+def test_make_folds(monkeypatch):
+    """
+    Tests that the cross-validation folds partition the whole data
+    """
+    monkeypatch.setattr(train, "CV_FOLDS", 4)
+    y_train = np.array([0, 1, 2] * 8)
+    y_val = np.array([0, 1, 2] * 4)
+
+    folds = train.make_folds.fn(y_train, y_val)
+
+    assert len(folds) == 4
+    val_index = np.concatenate([val for _, val in folds])
+    assert np.array_equal(np.sort(val_index), np.arange(36))
+    for train_index, val in folds:
+        assert not set(train_index) & set(val)
+        assert np.bincount(np.concatenate([y_train, y_val])[val]).tolist() == [3, 3, 3]
+
+
+def search_data_frames(n_rows=60):
+    """
+    Returns random training and validation data of the search
+    """
+    rng = np.random.default_rng(1)
+    columns = ["Age", "SystolicBP", "DiastolicBP", "BS", "BodyTemp", "HeartRate"]
+    X = pd.DataFrame(rng.normal(size=(n_rows, 6)), columns=columns)
+    y = (X["Age"] > 0).to_numpy(dtype=int) + (X["BS"] > 1).to_numpy(dtype=int)
+    split = n_rows * 3 // 4
+    return X.iloc[:split], X.iloc[split:], y[:split], y[split:]
+
+
+def test_sklearn_objective_pruning(monkeypatch):
+    """
+    Tests that a random forest trial is pruned after its first trees, and
+    that the warm-up and the SVM trials are fitted at once
+    """
+    monkeypatch.setattr(search, "PRUNING_ENABLED", True)
+    monkeypatch.setattr(search, "start_trial_run", contextlib.nullcontext)
+    monkeypatch.setattr(search.mlflow, "log_metric", lambda key, value: None)
+    X_train, X_val, y_train, y_val = search_data_frames()
+    search_data = {"X_train": X_train, "X_val": X_val}
+    monkeypatch.setattr(
+        search, "search_data", dict(search_data, y_train=y_train, y_val=y_val)
+    )
+
+    def objective(classifier_type, reference):
+        params = {"type": classifier_type, "max_depth": 3, "n_estimators": 8}
+        if classifier_type == "svm":
+            params = {"type": "svm", "C": 1.0}
+        return search.sklearn_objective(params, reference)
+
+    warm_up = objective("rf", None)
+    assert not warm_up["pruned"]
+    assert warm_up["budget"] == 1.0
+    assert len(warm_up["curve"]) == len(search.PRUNING_FRACTIONS) + 1
+    assert warm_up["curve"][-1] == warm_up["loss"]
+
+    pruned = objective("rf", [-1.5, -1.5])
+    assert pruned["pruned"]
+    assert pruned["budget"] == search.PRUNING_FRACTIONS[0]
+    assert len(pruned["curve"]) == 1
+
+    svm = objective("svm", [-1.5, -1.5])
+    assert not svm["pruned"]
+    assert "curve" not in svm
+
+
+def test_run_search_workers(tmp_path, monkeypatch):
+    """
+    Tests a search whose trials run in spawned worker processes, with the
+    training flow loaded as the Prefect deployment does
+    """
+    tracking_uri = (tmp_path / "mlruns").as_uri()
+    # The spawned workers read the tracking URI from the environment
+    monkeypatch.setenv("MLFLOW_TRACKING_URI", tracking_uri)
+    MlflowClient(tracking_uri).create_experiment(train.EXPERIMENT_NAME)
+    flow_module = load_script_as_module(train.__file__)
+    assert flow_module.__name__ == "__prefect_loader__"
+    monkeypatch.setattr(flow_module, "SEARCH_WORKERS", 2)
+    monkeypatch.setattr(flow_module, "MODEL_SEARCH_ITERATIONS", 3)
+    # Pickled by reference, the spawned workers import it from this module
+    monkeypatch.setattr(flow_module, "init_search_worker", init_search_worker)
+    space = {
+        "max_depth": 2,
+        "learning_rate": hp.uniform("learning_rate", 0.1, 0.3),
+        "objective": "reg:squarederror",
+        "seed": 42,
+        "nthread": 1,
+    }
+    data = train.search_dataset(search_data_frames(), "cycle")
+
+    trials = flow_module.run_search(
+        flow_module.xgboost_objective, space, data, "xgboost"
+    )
+
+    assert len(trials.results) == 3
+    assert all(-1 <= result["loss"] <= 0 for result in trials.results)
+    runs = mlflow.search_runs(
+        experiment_names=[train.EXPERIMENT_NAME],
+        filter_string="tags.training_cycle = 'cycle'",
+    )
+    # The trial runs and the search summary run
+    assert len(runs) == 4
+
+
+@pytest.mark.parametrize("flavor", ["xgboost", "sklearn"])
+def test_run_search_cross_validation(tmp_path, monkeypatch, flavor):
+    """
+    Tests a short cross-validated search, each trial logging the mean
+    accuracy of the folds
+    """
+    monkeypatch.setenv("MLFLOW_TRACKING_URI", (tmp_path / "mlruns").as_uri())
+    mlflow.set_experiment(train.EXPERIMENT_NAME)
+    monkeypatch.setattr(metrics, "SCORERS", sklearn_scorers(), raising=False)
+    monkeypatch.setattr(train, "MODEL_SEARCH_ITERATIONS", 3)
+    monkeypatch.setattr(train, "CV_FOLDS", 3)
+    split = search_data_frames()
+    folds = train.make_folds.fn(split[2], split[3])
+    data = train.search_dataset(split, "cycle", folds)
+    if flavor == "xgboost":
+        objective = search.xgboost_objective
+        space = {
+            "max_depth": 2,
+            "learning_rate": hp.uniform("learning_rate", 0.1, 0.3),
+            "objective": "reg:squarederror",
+            "seed": 42,
+            "nthread": 3,
+        }
+    else:
+        objective = search.sklearn_objective
+        space = {"type": "rf", "max_depth": hp.choice("max_depth", [2, 3])}
+
+    trials = train.run_search(objective, space, data, flavor)
+
+    assert len(trials.results) == 3
+    assert all(result["budget"] == 1.0 for result in trials.results)
+    runs = mlflow.search_runs(
+        experiment_names=[train.EXPERIMENT_NAME],
+        filter_string="tags.cv_folds = '3'",
+    )
+    assert len(runs) == 3
+    assert all(0 <= accuracy <= 1 for accuracy in runs["metrics.cv_accuracy"])
+    # Not comparable with the validation accuracy of the split mode
+    assert "metrics.accuracy" not in runs
+
+
+class FakeMlflowClient:
+    """
+    MLflow client recording the run searches, with a registered version
+    """
+
+    def __init__(self, runs, accuracy=None, metric=None):
+        self.runs = runs
+        self.accuracy = accuracy
+        self.metric = metric
+        self.filters = []
+        self.tags = {}
+
+    def get_experiment_by_name(self, name):
+        """Returns the experiment"""
+        return SimpleNamespace(experiment_id="1", name=name)
+
+    def get_latest_versions(self, _name):
+        """Returns the registered version, if any"""
+        if self.accuracy is None:
+            return []
+        tags = {"accuracy": str(self.accuracy)}
+        if self.metric is not None:
+            tags["accuracy_metric"] = self.metric
+        return [SimpleNamespace(version="1", tags=tags)]
+
+    def search_runs(self, **kwargs):
+        """Records the filter of the search, returns the runs"""
+        self.filters.append(kwargs["filter_string"])
+        return self.runs
+
+    def set_model_version_tag(self, _name, _version, key, value):
+        """Records the version tag"""
+        self.tags[key] = value
+
+    def update_registered_model(self, name, description):
+        """Ignores the model description"""
+
+
+def test_register_best_model(monkeypatch):
+    """
+    Tests that only an improving model of the training cycle is registered
+    """
+    run = SimpleNamespace(
+        info=SimpleNamespace(run_id="run"),
+        data=SimpleNamespace(metrics={"accuracy": 0.9}),
+    )
+    registered = SimpleNamespace(name=train.EXPERIMENT_NAME, version="2", run_id="run")
+    monkeypatch.setattr(train.mlflow, "register_model", lambda **kwargs: registered)
+
+    client = FakeMlflowClient([], accuracy=0.8)
+    monkeypatch.setattr(train, "MlflowClient", lambda: client)
+    assert train.register_best_model.fn("cycle") is None
+    assert client.filters == [
+        "tags.training_cycle = 'cycle' and metrics.accuracy > 0.8"
+    ]
+
+    client = FakeMlflowClient([run])
+    monkeypatch.setattr(train, "MlflowClient", lambda: client)
+    assert train.register_best_model.fn("cycle") is registered
+    assert client.filters == ["tags.training_cycle = 'cycle'"]
+    assert client.tags == {"accuracy": 0.9, "accuracy_metric": "accuracy"}
+
+
+def test_register_best_model_cross_validation(monkeypatch):
+    """
+    Tests that the cross-validation accuracy is only compared with the
+    registered cross-validation accuracy
+    """
+    run = SimpleNamespace(
+        info=SimpleNamespace(run_id="run"),
+        data=SimpleNamespace(metrics={"cv_accuracy": 0.85}),
+    )
+    registered = SimpleNamespace(name=train.EXPERIMENT_NAME, version="2", run_id="run")
+    monkeypatch.setattr(train.mlflow, "register_model", lambda **kwargs: registered)
+    monkeypatch.setattr(train, "CV_FOLDS", 5)
+
+    client = FakeMlflowClient([run], accuracy=0.8, metric="cv_accuracy")
+    monkeypatch.setattr(train, "MlflowClient", lambda: client)
+    assert train.register_best_model.fn("cycle") is registered
+    assert client.filters == [
+        "tags.training_cycle = 'cycle' and metrics.cv_accuracy > 0.8"
+    ]
+    assert client.tags == {"accuracy": 0.85, "accuracy_metric": "cv_accuracy"}
+
+    # A version registered with its validation accuracy
+    client = FakeMlflowClient([run], accuracy=0.9)
+    monkeypatch.setattr(train, "MlflowClient", lambda: client)
+    assert train.register_best_model.fn("cycle") is registered
+    assert client.filters == ["tags.training_cycle = 'cycle'"]
@@ -1,24 +1,36 @@
 """Training module"""
 
 import os
+import json
 import time
+import uuid
 import shutil
-
+import hashlib
+import tempfile
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait,
+)
+
+import numpy as np
 import mlflow
 import pandas as pd
-import xgboost as xgb
+from search import init_search, sklearn_objective, xgboost_objective, init_search_worker
 from prefect import flow, task
-from hyperopt import STATUS_OK, Trials, hp, tpe, fmin
-from sklearn.svm import SVC
+from compiled import export_model_tables
+from hyperopt import JOB_STATE_DONE, Trials, hp, tpe, space_eval
+from hyperopt.base import Domain
 from hyperopt.pyll import scope
-from mlflow.entities import ViewType
+from hyperopt.utils import coarse_utcnow
+from mlflow.entities import Metric, ViewType
 from mlflow.tracking import MlflowClient
-from sklearn.metrics import accuracy_score
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.pipeline import make_pipeline
-from prefect.task_runners import SequentialTaskRunner
-from sklearn.preprocessing import LabelEncoder, StandardScaler
-from sklearn.model_selection import train_test_split
+from mlflow.exceptions import MlflowException
+from prefect.task_runners import ConcurrentTaskRunner, SequentialTaskRunner
+from sklearn.preprocessing import LabelEncoder
+from sklearn.model_selection import StratifiedKFold, train_test_split
 
 KAGGLE_USERNAME = os.getenv("KAGGLE_USERNAME")
 KAGGLE_KEY = os.getenv("KAGGLE_KEY")
@@ -33,6 +45,13 @@ EXPERIMENT_NAME = os.getenv("EXPERIMENT_NAME", "maternal-health-risk")
 MIN_AGE = int(os.getenv("MIN_AGE", "13"))
 MAX_AGE = int(os.getenv("MAX_AGE", "50"))
 MODEL_SEARCH_ITERATIONS = int(os.getenv("MODEL_SEARCH_ITERATIONS", "32"))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "1"))
+PREPARED_DATA_DIR = os.getenv("PREPARED_DATA_DIR", "data/prepared")
+# Completed trials needed before pruning
+PRUNING_MIN_TRIALS = 5
+# Number of cross-validation folds of the search, the validation split is
+# used when lower than 2
+CV_FOLDS = int(os.getenv("CV_FOLDS", "0"))
 
 
 @task
@@ -79,7 +98,7 @@ def prepare_data(df):
     df = df[(df.Age >= MIN_AGE) & (df.Age <= MAX_AGE)]
 
     # Body temperature conversion from F to C
-    df.BodyTemp = df.BodyTemp.apply(lambda temp: (temp - 32) * 5 / 9)
+    df.BodyTemp = (df.BodyTemp - 32) * 5 / 9
 
     # Sort by risk
     df.sort_values(by="RiskLevel", ascending=True, inplace=True)
@@ -109,30 +128,207 @@ def split_data(X, y):
 
 
 @task
-def train_model_xgboost_search(X_train, X_val, y_train, y_val):
+def make_folds(y_train, y_val):
+    """
+    Computes the cross-validation folds, over the training and validation
+    data, shared by all the search trials
+    """
+    y = np.concatenate([y_train, y_val])
+    k_fold = StratifiedKFold(n_splits=CV_FOLDS, shuffle=True, random_state=1)
+    return list(k_fold.split(np.zeros(len(y)), y))
+
+
+def prepared_data_path(filename):
+    """
+    Returns the cache directory of the prepared data of a file, keyed by the
+    file content and the preparation settings
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(f"{MIN_AGE}-{MAX_AGE}".encode())
+    return os.path.join(PREPARED_DATA_DIR, digest.hexdigest())
+
+
+@task
+def save_prepared_data(path, X_train, X_val, y_train, y_val):
+    """
+    Saves the prepared training and validation data as NumPy arrays
+    """
+    os.makedirs(PREPARED_DATA_DIR, exist_ok=True)
+    # Write to a temporary directory first so that a cache is never partial
+    tmp_dir = tempfile.mkdtemp(dir=PREPARED_DATA_DIR)
+    np.save(os.path.join(tmp_dir, "X_train.npy"), X_train.to_numpy())
+    np.save(os.path.join(tmp_dir, "X_val.npy"), X_val.to_numpy())
+    np.save(os.path.join(tmp_dir, "y_train.npy"), y_train)
+    np.save(os.path.join(tmp_dir, "y_val.npy"), y_val)
+    with open(os.path.join(tmp_dir, "columns.json"), "w", encoding="utf-8") as file:
+        json.dump(list(X_train.columns), file)
+    try:
+        os.rename(tmp_dir, path)
+    except OSError:
+        # Saved in the meantime by another run
+        shutil.rmtree(tmp_dir)
+
+
+@task
+def load_prepared_data(path):
+    """
+    Loads the prepared training and validation data as memory-mapped arrays
+    """
+    with open(os.path.join(path, "columns.json"), encoding="utf-8") as file:
+        columns = json.load(file)
+
+    def load(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    X_train = pd.DataFrame(load("X_train"), columns=columns, copy=False)
+    X_val = pd.DataFrame(load("X_val"), columns=columns, copy=False)
+    return X_train, X_val, load("y_train"), load("y_val")
+
+
+def trial_params(space, doc):
     """
-    Searches for the best XGBoost prediction model
+    Returns the parameters of a hyperopt trial document
     """
-    train = xgb.DMatrix(X_train, label=y_train)
-    valid = xgb.DMatrix(X_val, label=y_val)
+    values = {label: value[0] for label, value in doc["misc"]["vals"].items() if value}
+    return space_eval(space, values)
 
-    mlflow.xgboost.autolog()
 
-    def objective(params):
-        with mlflow.start_run():
-            booster = xgb.train(
-                params=params,
-                dtrain=train,
-                num_boost_round=100,
-                evals=[(valid, "validation")],
-                early_stopping_rounds=50,
-            )
-            y_pred = [round(x) for x in booster.predict(valid)]
-            accuracy = accuracy_score(y_val, y_pred)
-            mlflow.log_metric("accuracy", accuracy)
+def search_dataset(split, training_cycle, folds=None):
+    """
+    Returns the data of the search objectives from the training and
+    validation split, with the whole data and the folds in cross-validation
+    mode
+    """
+    X_train, X_val, y_train, y_val = split
+    data = {"X_train": X_train, "X_val": X_val, "y_train": y_train, "y_val": y_val}
+    data["training_cycle"] = training_cycle
+    if folds is not None:
+        data["X"] = pd.concat([X_train, X_val], ignore_index=True)
+        data["y"] = np.concatenate([y_train, y_val])
+        data["folds"] = folds
+    return data
+
 
-        return {"loss": (-1) * accuracy, "status": STATUS_OK}
+def pruning_reference(trials):
+    """
+    Returns the median loss, at each step, of the completed trials that
+    reached the step, or None before enough trials have completed
+    """
+    curves = [result["curve"] for result in trials.results if "curve" in result]
+    if len(curves) < PRUNING_MIN_TRIALS:
+        return None
 
+    reference = []
+    for step in range(max(len(curve) for curve in curves)):
+        losses = [curve[step] for curve in curves if len(curve) > step]
+        if len(losses) < PRUNING_MIN_TRIALS:
+            break
+        reference.append(float(np.median(losses)))
+    return reference
+
+
+def log_search_summary(flavor, trials, duration, training_cycle):
+    """
+    Logs the number of trials, the pruned trials and the compute budget of a
+    search to a dedicated MLflow run
+    """
+    n_trials = len(trials.results)
+    budget = sum(result["budget"] for result in trials.results)
+    metrics = {
+        "trials": n_trials,
+        "pruned_trials": sum(result["pruned"] for result in trials.results),
+        # Budget in full trial units
+        "budget_used": budget,
+        "budget_saved": n_trials - budget,
+        "search_duration_seconds": duration,
+    }
+    print(f"{flavor} search: {metrics}")
+
+    # The fluent API is not used since both searches may run concurrently
+    client = MlflowClient()
+    experiment = client.get_experiment_by_name(EXPERIMENT_NAME)
+    run = client.create_run(
+        experiment.experiment_id,
+        tags={
+            "mlflow.runName": f"{flavor}-search",
+            "search_summary": "true",
+            "training_cycle": training_cycle,
+        },
+    )
+    timestamp = int(time.time() * 1000)
+    client.log_batch(
+        run.info.run_id,
+        metrics=[Metric(key, value, timestamp, 0) for key, value in metrics.items()],
+    )
+    client.set_terminated(run.info.run_id)
+
+
+def run_search(fn, space, data, flavor):
+    """
+    Runs a TPE hyperparameter search keeping a trial running on each search
+    worker, the next trial is suggested as soon as one completes
+    """
+    if SEARCH_WORKERS > 1:
+        # Spawned workers do not inherit the MLflow active run stack of the
+        # parent. They import the objectives and the initializer, pickled by
+        # reference, from the search module: Prefect loads this module as
+        # __prefect_loader__, which they could not import
+        executor = ProcessPoolExecutor(
+            max_workers=SEARCH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_search_worker,
+            initargs=(data, flavor),
+        )
+    else:
+        init_search(data, flavor)
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    start = time.perf_counter()
+    domain = Domain(fn, space)
+    trials = Trials()
+    rstate = np.random.default_rng()
+    pending = {}
+
+    with executor:
+        while len(trials) + len(pending) < MODEL_SEARCH_ITERATIONS or pending:
+            while (
+                len(pending) < SEARCH_WORKERS
+                and len(trials) + len(pending) < MODEL_SEARCH_ITERATIONS
+            ):
+                [doc] = tpe.suggest(
+                    trials.new_trial_ids(1),
+                    domain,
+                    trials,
+                    rstate.integers(2**31 - 1),
+                )
+                doc["book_time"] = coarse_utcnow()
+                params = trial_params(space, doc)
+                future = executor.submit(fn, params, pruning_reference(trials))
+                pending[future] = doc
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                doc = pending.pop(future)
+                doc["result"] = future.result()
+                doc["state"] = JOB_STATE_DONE
+                doc["refresh_time"] = coarse_utcnow()
+                trials.insert_trial_docs([doc])
+            trials.refresh()
+
+    log_search_summary(
+        flavor, trials, time.perf_counter() - start, data["training_cycle"]
+    )
+    return trials
+
+
+@task
+def train_model_xgboost_search(data):
+    """
+    Searches for the best XGBoost prediction model on the search dataset
+    """
     search_space = {
         "max_depth": scope.int(hp.uniform("max_depth", 1, 20)),
         "learning_rate": hp.uniform("learning_rate", 0.01, 0.2),
@@ -141,39 +337,18 @@ def train_model_xgboost_search(X_train, X_val, y_train, y_val):
         "min_child_weight": hp.loguniform("min_child_weight", -1, 3),
         "objective": "reg:squarederror",
         "seed": 42,
+        # Share the cores between the search workers
+        "nthread": max(1, (os.cpu_count() or 1) // SEARCH_WORKERS),
     }
 
-    fmin(
-        fn=objective,
-        space=search_space,
-        algo=tpe.suggest,
-        max_evals=MODEL_SEARCH_ITERATIONS,
-        trials=Trials(),
-    )
+    run_search(xgboost_objective, search_space, data, "xgboost")
 
 
 @task
-def train_model_sklearn_search(X_train, X_val, y_train, y_val):
+def train_model_sklearn_search(data):
     """
-    Searches for the best scikit-learn prediction model
+    Searches for the best scikit-learn prediction model on the search dataset
     """
-    mlflow.sklearn.autolog()
-
-    def objective(params):
-        with mlflow.start_run():
-            classifier_type = params["type"]
-            del params["type"]
-            if classifier_type == "svm":
-                clf = make_pipeline(StandardScaler(), SVC(**params))
-            elif classifier_type == "rf":
-                clf = make_pipeline(StandardScaler(), RandomForestClassifier(**params))
-
-            clf.fit(X_train, y_train)
-            accuracy = clf.score(X_val, y_val)
-            mlflow.log_metric("accuracy", accuracy)
-
-            return {"loss": -accuracy, "status": STATUS_OK}
-
     search_space = hp.choice(
         "classifier_type",
         [
@@ -191,39 +366,106 @@ def train_model_sklearn_search(X_train, X_val, y_train, y_val):
         ],
     )
 
-    fmin(
-        fn=objective,
-        space=search_space,
-        algo=tpe.suggest,
-        max_evals=MODEL_SEARCH_ITERATIONS,
-        trials=Trials(),
-    )
+    run_search(sklearn_objective, search_space, data, "sklearn")
+
+
+def accuracy_metric():
+    """
+    Returns the accuracy metric of the search runs, the mean accuracy of the
+    folds in cross-validation mode
+    """
+    return "cv_accuracy" if CV_FOLDS > 1 else "accuracy"
+
+
+def get_registered_accuracy(client, metric):
+    """
+    Returns the accuracy of the latest registered model version, or None when
+    no model is registered or its accuracy is another metric
+    """
+    try:
+        versions = client.get_latest_versions(EXPERIMENT_NAME)
+    except MlflowException:
+        return None
+    if not versions:
+        return None
+
+    latest = max(versions, key=lambda version: int(version.version))
+    if "accuracy" in latest.tags:
+        # Versions registered before the metric tag use the validation accuracy
+        if latest.tags.get("accuracy_metric", "accuracy") != metric:
+            return None
+        return float(latest.tags["accuracy"])
+    # Versions registered before the accuracy tag
+    return client.get_run(latest.run_id).data.metrics.get(metric)
 
 
 @task
-def register_best_model():
+def register_best_model(training_cycle):
     """
-    Registers the highest accuracy model
+    Registers the highest accuracy model of the training cycle when it
+    improves on the registered model, or when the registered accuracy is not
+    comparable
     """
     client = MlflowClient()
     experiment = client.get_experiment_by_name(EXPERIMENT_NAME)
-    best_run = client.search_runs(
+    metric = accuracy_metric()
+    registered_accuracy = get_registered_accuracy(client, metric)
+
+    # Only the runs of the training cycle are searched, by the tracking server
+    filter_string = f"tags.training_cycle = '{training_cycle}'"
+    if registered_accuracy is not None:
+        filter_string += f" and metrics.{metric} > {registered_accuracy}"
+    best_runs = client.search_runs(
         experiment_ids=experiment.experiment_id,
+        filter_string=filter_string,
         run_view_type=ViewType.ACTIVE_ONLY,
         max_results=1,
-        order_by=["metrics.accuracy DESC"],
-    )[0]
+        order_by=[f"metrics.{metric} DESC"],
+    )
+    if not best_runs:
+        print(f"No model improves on the registered {metric} {registered_accuracy}")
+        return None
+
     # register the best model
+    best_run = best_runs[0]
     run_id = best_run.info.run_id
     model_uri = f"runs:/{run_id}/model"
-    model_accuracy = round(best_run.data.metrics['accuracy'] * 100)
+    accuracy = best_run.data.metrics[metric]
     model_details = mlflow.register_model(model_uri=model_uri, name=EXPERIMENT_NAME)
+    client.set_model_version_tag(
+        model_details.name, model_details.version, "accuracy", accuracy
+    )
+    client.set_model_version_tag(
+        model_details.name, model_details.version, "accuracy_metric", metric
+    )
     client.update_registered_model(
-        name=model_details.name, description=f"Current accuracy: {model_accuracy}%"
+        name=model_details.name,
+        description=f"Current accuracy: {round(accuracy * 100)}%",
     )
+    return model_details
 
 
-@flow(task_runner=SequentialTaskRunner())
+@task
+def export_compiled_model(model_details):
+    """
+    Exports the registered model as node tables next to the model artifact
+    """
+    model_uri = f"models:/{model_details.name}/{model_details.version}"
+    model = mlflow.pyfunc.load_model(model_uri)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "model.npz")
+        try:
+            export_model_tables(model, filename, run_id=model_details.run_id)
+        except ValueError as error:
+            print(f"Compiled model not exported: {error}")
+            return
+        MlflowClient().log_artifact(model_details.run_id, filename, "compiled")
+
+
+# The in-process searches share the MLflow active run, they must not overlap
+@flow(
+    task_runner=ConcurrentTaskRunner() if SEARCH_WORKERS > 1 else SequentialTaskRunner()
+)
 def main():
     """
     Executes the training workflow
@@ -232,12 +474,24 @@ def main():
     mlflow.set_experiment(EXPERIMENT_NAME)
     if DOWNLOAD_DATA:
         download_data()
-    data = read_data("data/data.csv")
-    X, y = prepare_data(data)
-    X_train, X_val, y_train, y_val = split_data(X, y)
-    train_model_xgboost_search(X_train, X_val, y_train, y_val)
-    train_model_sklearn_search(X_train, X_val, y_train, y_val)
-    register_best_model()
+    prepared_data = prepared_data_path("data/data.csv")
+    if not os.path.exists(prepared_data):
+        data = read_data("data/data.csv")
+        X, y = prepare_data(data)
+        X_train, X_val, y_train, y_val = split_data(X, y)
+        save_prepared_data(prepared_data, X_train, X_val, y_train, y_val)
+    X_train, X_val, y_train, y_val = load_prepared_data(prepared_data)
+    folds = make_folds(y_train, y_val) if CV_FOLDS > 1 else None
+    # Identifies the runs of this flow run
+    training_cycle = uuid.uuid4().hex
+    dataset = search_dataset((X_train, X_val, y_train, y_val), training_cycle, folds)
+    xgboost_search = train_model_xgboost_search.submit(dataset)
+    sklearn_search = train_model_sklearn_search.submit(dataset)
+    xgboost_search.result()
+    sklearn_search.result()
+    model_details = register_best_model(training_cycle)
+    if model_details is not None:
+        export_compiled_model(model_details)
 
 
 if __name__ == "__main__":
@@ -10,16 +10,21 @@ The service gets a reference dataset from data.csv file and process current data
 Metrics calculation results are available with `GET /metrics` HTTP method in Prometheus compatible format.
 """
 import os
+import time
+import itertools
 import logging
 import datetime
+import threading
 import dataclasses
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 import yaml
 import flask
+import numpy as np
 import pandas as pd
 import prometheus_client
 from flask import Flask
+from bson import ObjectId
 from pymongo import MongoClient
 from evidently.dashboard import Dashboard
 from evidently.dashboard.tabs import DataDriftTab, CatTargetDriftTab
@@ -36,9 +41,22 @@ from evidently.model_monitoring import (
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from evidently.pipeline.column_mapping import ColumnMapping
 
+from window import RingBuffer, window_columns
+from drift import (
+    PROFILE_MONITORS,
+    ReferenceProfile,
+    ProfileMonitoring,
+    load_reference_profile,
+)
+from scheduler import DriftScheduler
+
 MIN_AGE = int(os.getenv("MIN_AGE", 13))
 MAX_AGE = int(os.getenv("MAX_AGE", 50))
 WINDOW_SIZE = 50
+DASHBOARD_DATASET = "maternal-health-risk"
+DASHBOARD_WINDOW_HOURS = float(os.getenv("DASHBOARD_WINDOW_HOURS", 24))
+DASHBOARD_MAX_ROWS = int(os.getenv("DASHBOARD_MAX_ROWS", 10000))
+DASHBOARD_BATCH_SIZE = int(os.getenv("DASHBOARD_BATCH_SIZE", 1000))
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 EXPERIMENT_NAME = os.getenv("EXPERIMENT_NAME", "maternal-health-risk")
 
@@ -77,6 +95,7 @@ class MonitoringServiceOptions:
     moving_reference: bool
     window_size: int
     calculation_period_sec: int
+    max_workers: int = 1
 
 
 @dataclasses.dataclass
@@ -85,8 +104,20 @@ class LoadedDataset:
     references: pd.DataFrame
     monitors: List[str]
     column_mapping: ColumnMapping
+    profile: ReferenceProfile
 
 
+DRIFT_COMPUTATION_DURATION = prometheus_client.Histogram(
+    "drift_computation_duration_seconds",
+    "Duration of the drift computations",
+    ["dataset_name"],
+)
+DRIFT_SCHEDULER_LAG = prometheus_client.Gauge(
+    "drift_scheduler_lag_seconds",
+    "Delay between the scheduled and the actual start of the last drift computation",
+    ["dataset_name"],
+)
+
 EVIDENTLY_MONITORS_MAPPING = {
     "cat_target_drift": CatTargetDriftMonitor,
     "data_drift": DataDriftMonitor,
@@ -105,81 +136,120 @@ class MonitoringService:
     last_run: Optional[datetime.datetime]
     # collection of reference data
     reference: Dict[str, pd.DataFrame]
-    # collection of current data
-    current: Dict[str, Optional[pd.DataFrame]]
-    # collection of monitoring objects
-    monitoring: Dict[str, ModelMonitoring]
+    # collection of current data windows
+    current: Dict[str, RingBuffer]
+    # collection of monitoring objects, for the monitors not computed from the
+    # reference profile
+    monitoring: Dict[str, Optional[ModelMonitoring]]
+    # collection of monitors computed from the reference profile
+    profile_monitoring: Dict[str, ProfileMonitoring]
     calculation_period_sec: float = 15
     window_size: int
-
-    def __init__(self, datasets: Dict[str, LoadedDataset], window_size: int):
+    scheduler: DriftScheduler
+
+    def __init__(
+        self,
+        datasets: Dict[str, LoadedDataset],
+        window_size: int,
+        calculation_period_sec: float = 15,
+        max_workers: int = 1,
+    ):
         self.reference = {}
         self.monitoring = {}
+        self.profile_monitoring = {}
         self.current = {}
         self.column_mapping = {}
         self.window_size = window_size
+        self.calculation_period_sec = calculation_period_sec
 
         for dataset_info in datasets.values():
             self.reference[dataset_info.name] = dataset_info.references
-            self.monitoring[dataset_info.name] = ModelMonitoring(
-                monitors=[
-                    EVIDENTLY_MONITORS_MAPPING[k]() for k in dataset_info.monitors
-                ],
-                options=[],
+            self.profile_monitoring[dataset_info.name] = ProfileMonitoring(
+                dataset_info.profile,
+                [k for k in dataset_info.monitors if k in PROFILE_MONITORS],
+            )
+            evidently_monitors = [
+                k for k in dataset_info.monitors if k not in PROFILE_MONITORS
+            ]
+            self.monitoring[dataset_info.name] = (
+                ModelMonitoring(
+                    monitors=[
+                        EVIDENTLY_MONITORS_MAPPING[k]() for k in evidently_monitors
+                    ],
+                    options=[],
+                )
+                if evidently_monitors
+                else None
             )
             self.column_mapping[dataset_info.name] = dataset_info.column_mapping
 
         self.metrics = {}
-        self.next_run_time = {}
-
-    def iterate(self, dataset_name: str, new_rows: pd.DataFrame):
-        """Add data to current dataset for specified dataset"""
-        window_size = self.window_size
-
-        if dataset_name in self.current:
-            current_data = self.current[dataset_name].append(
-                new_rows, ignore_index=True
-            )
-
-        else:
-            current_data = new_rows
-
-        current_size = current_data.shape[0]
-
-        if current_size > self.window_size:
-            # cut current_size by window size value
-            current_data.drop(
-                index=list(range(0, current_size - self.window_size)), inplace=True
-            )
-            current_data.reset_index(drop=True, inplace=True)
-
-        self.current[dataset_name] = current_data
-
-        if current_size < window_size:
-            logging.info(
-                f"Not enough data for measurement: {current_size} of {window_size}."
-                f" Waiting more data"
-            )
-            return
+        # guards the windows, shared by the request handlers and the scheduler
+        self.lock = threading.Lock()
+        self.metrics_lock = threading.Lock()
+        self.scheduler = DriftScheduler(
+            self.calculate,
+            self.current,
+            self.lock,
+            window_size,
+            calculation_period_sec,
+            max_workers,
+        )
 
-        next_run_time = self.next_run_time.get(dataset_name)
+    def iterate(
+        self, dataset_name: str, new_rows: Union[pd.DataFrame, List[Dict[str, Any]]]
+    ):
+        """Add data to current dataset for specified dataset, drift is computed by the
+        scheduler"""
+        with self.lock:
+            if dataset_name not in self.current:
+                self.current[dataset_name] = RingBuffer(
+                    *window_columns(
+                        self.column_mapping[dataset_name],
+                        list(self.reference[dataset_name].columns),
+                    ),
+                    capacity=self.window_size,
+                )
 
-        if next_run_time is not None and next_run_time > datetime.datetime.now():
-            logging.info("Next run for dataset %s at %s", dataset_name, next_run_time)
+            self.current[dataset_name].extend(new_rows)
+
+    def start_scheduler(self):
+        """Start the background thread submitting the due drift computations"""
+        self.scheduler.start()
+
+    def calculate(
+        self,
+        dataset_name: str,
+        current_data: pd.DataFrame,
+        scheduled_time: datetime.datetime,
+    ):
+        """Compute the drift of a window snapshot and update the metrics"""
+        lag = datetime.datetime.now() - scheduled_time
+        DRIFT_SCHEDULER_LAG.labels(dataset_name=dataset_name).set(lag.total_seconds())
+
+        try:
+            with DRIFT_COMPUTATION_DURATION.labels(dataset_name=dataset_name).time():
+                metrics = list(
+                    self.profile_monitoring[dataset_name].metrics(current_data)
+                )
+                monitoring = self.monitoring[dataset_name]
+
+                if monitoring is not None:
+                    monitoring.execute(
+                        self.reference[dataset_name],
+                        current_data,
+                        self.column_mapping[dataset_name],
+                    )
+                    metrics.extend(
+                        (metric.name, value, labels)
+                        for metric, value, labels in monitoring.metrics()
+                    )
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Drift computation failed for dataset %s", dataset_name)
             return
 
-        self.next_run_time[dataset_name] = datetime.datetime.now() + datetime.timedelta(
-            seconds=self.calculation_period_sec
-        )
-        self.monitoring[dataset_name].execute(
-            self.reference[dataset_name],
-            current_data,
-            self.column_mapping[dataset_name],
-        )
-
-        for metric, value, labels in self.monitoring[dataset_name].metrics():
-            metric_key = f"evidently:{metric.name}"
-            found = self.metrics.get(metric_key)
+        for metric_name, value, labels in metrics:
+            metric_key = f"evidently:{metric_name}"
 
             if not labels:
                 labels = {}
@@ -189,11 +259,14 @@ class MonitoringService:
             if isinstance(value, str):
                 continue
 
-            if found is None:
-                found = prometheus_client.Gauge(
-                    metric_key, "", list(sorted(labels.keys()))
-                )
-                self.metrics[metric_key] = found
+            with self.metrics_lock:
+                found = self.metrics.get(metric_key)
+
+                if found is None:
+                    found = prometheus_client.Gauge(
+                        metric_key, "", list(sorted(labels.keys()))
+                    )
+                    self.metrics[metric_key] = found
 
             try:
                 found.labels(**labels).set(value)
@@ -234,12 +307,21 @@ def configure_service():
         )
 
         reference_data = load_reference_data(reference_file)
+        column_mapping = ColumnMapping(**dataset_options["column_mapping"])
+
+        # the reference statistics are computed once and cached next to the config file
+        profile_file = os.path.join(
+            os.path.dirname(config_file_path), f"{dataset_name}.profile.pkl"
+        )
 
         datasets[dataset_name] = LoadedDataset(
             name=dataset_name,
             references=reference_data,
             monitors=dataset_options['monitors'],
-            column_mapping=ColumnMapping(**dataset_options["column_mapping"]),
+            column_mapping=column_mapping,
+            profile=load_reference_profile(
+                profile_file, reference_data, column_mapping
+            ),
         )
         logging.info(
             "Reference is loaded for dataset %s: %s rows",
@@ -247,7 +329,13 @@ def configure_service():
             len(reference_data),
         )
 
-    SERVICE = MonitoringService(datasets=datasets, window_size=options.window_size)
+    SERVICE = MonitoringService(
+        datasets=datasets,
+        window_size=options.window_size,
+        calculation_period_sec=options.calculation_period_sec,
+        max_workers=options.max_workers,
+    )
+    SERVICE.start_scheduler()
 
 
 @app.route("/iterate/<dataset>", methods=["POST"])
@@ -258,65 +346,176 @@ def iterate(dataset: str):
     if SERVICE is None:
         return "Internal Server Error: service not found", 500
 
-    SERVICE.iterate(dataset_name=dataset, new_rows=pd.DataFrame.from_dict(item))
+    if dataset not in SERVICE.column_mapping:
+        return f"Bad Request: unknown dataset {dataset}", 400
+
+    SERVICE.iterate(
+        dataset_name=dataset, new_rows=item if isinstance(item, list) else [item]
+    )
     return "ok"
 
 
 #############################################################################
 
 
-def get_data_from_db():
-    """fetch data from db"""
-    data = (
+def get_data_from_db(columns: List[str], since: datetime.datetime) -> pd.DataFrame:
+    """fetch the latest predictions made since a time, only the dashboard columns"""
+    # the prediction service indexes the prediction time, so the query scans the
+    # window only
+    cursor = (
         mongo_client.get_database("prediction_service")
         .get_collection(EXPERIMENT_NAME)
-        .find()
+        .find(
+            {"timestamp": {"$gte": since}},
+            projection={**{column: True for column in columns}, "_id": False},
+            batch_size=DASHBOARD_BATCH_SIZE,
+        )
+        .sort("timestamp", -1)
+        .limit(DASHBOARD_MAX_ROWS)
     )
-    return pd.DataFrame(list(data))
 
+    batches = []
+    while True:
+        batch = list(itertools.islice(cursor, DASHBOARD_BATCH_SIZE))
+        if not batch:
+            break
+        batches.append(pd.DataFrame.from_records(batch, columns=columns))
 
-def create_dashboard():
-    """create dashboard"""
+    if not batches:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(batches, ignore_index=True)
 
-    collected_data = get_data_from_db()
-    if len(collected_data) < WINDOW_SIZE:
-        return "Not enough data to create report, please refresh after some time!"
 
-    reference_data = load_reference_data('./datasets/data.csv')
+def get_latest_prediction_id() -> Optional[ObjectId]:
+    """fetch the _id of the latest logged prediction"""
+    latest = (
+        mongo_client.get_database("prediction_service")
+        .get_collection(EXPERIMENT_NAME)
+        .find_one({}, projection={"_id": True}, sort=[("_id", -1)])
+    )
+    return None if latest is None else latest["_id"]
 
-    numerical_features = [
-        'Age',
-        'SystolicBP',
-        'DiastolicBP',
-        'BS',
-        'BodyTemp',
-        'HeartRate',
-    ]
-    target = "RiskLevel"
-    column_mapping = ColumnMapping()
-    column_mapping.numerical_features = numerical_features
-    column_mapping.target = target
 
-    data_drift_dashboard = Dashboard(
-        tabs=[DataDriftTab(verbose_level=1), CatTargetDriftTab(verbose_level=1)]
+def get_hourly_rollups(since: datetime.datetime) -> List[Dict[str, Any]]:
+    """fetch the hourly aggregates of the predictions rolled up by the retention job
+    since a time"""
+    return list(
+        mongo_client.get_database("prediction_service")
+        .get_collection(f"{EXPERIMENT_NAME}-hourly")
+        .find({"_id": {"$gte": since}})
+        .sort("_id", 1)
     )
 
-    data_drift_dashboard.calculate(
-        reference_data, collected_data, column_mapping=column_mapping
+
+def summarize_rollups(rollups: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """combine hourly aggregates into the count, means, histograms and risk levels of
+    their whole range"""
+    features: Dict[str, Dict[str, Any]] = {}
+    risk_levels: Dict[str, int] = {}
+
+    for rollup in rollups:
+        for feature, aggregate in rollup["features"].items():
+            total = features.setdefault(
+                feature,
+                {
+                    "count": 0,
+                    "sum": 0.0,
+                    "bins": aggregate["bins"],
+                    "histogram": np.zeros(len(aggregate["histogram"]), dtype=int),
+                },
+            )
+            total["count"] += aggregate["count"]
+            total["sum"] += aggregate["sum"]
+            total["histogram"] += aggregate["histogram"]
+        for risk_level, count in rollup["risk_levels"].items():
+            risk_levels[risk_level] = risk_levels.get(risk_level, 0) + count
+
+    return {
+        "count": sum(rollup["count"] for rollup in rollups),
+        "features": {
+            feature: {
+                "count": total["count"],
+                "mean": total["sum"] / total["count"] if total["count"] else None,
+                "bins": total["bins"],
+                "histogram": total["histogram"].tolist(),
+            }
+            for feature, total in features.items()
+        },
+        "risk_levels": risk_levels,
+        "hours": [
+            {
+                "hour": rollup["_id"].isoformat(),
+                "count": rollup["count"],
+                "means": {
+                    feature: aggregate["mean"]
+                    for feature, aggregate in rollup["features"].items()
+                },
+                "risk_levels": rollup["risk_levels"],
+            }
+            for rollup in rollups
+        ],
+    }
+
+
+# html of the last dashboard and the time window and latest prediction it was built from
+DASHBOARD_CACHE: Dict[str, Any] = {}
+dashboard_lock = threading.Lock()
+
+
+def create_dashboard():
+    """create dashboard of the predictions of the last time window, cached until new
+    data arrives"""
+    window = DASHBOARD_WINDOW_HOURS * 3600
+    # the window start moves by steps of a tenth of the window so that the cache can
+    # be reused
+    step = window / 10
+    since = datetime.datetime.fromtimestamp(
+        (time.time() - window) // step * step, tz=datetime.timezone.utc
     )
 
-    data_drift_dashboard.save("data_drift_dashboard.html")
-    with open("./data_drift_dashboard.html", "r", encoding="utf-8") as file:
-        dashboard = file.read()
+    with dashboard_lock:
+        cache_key = (since, get_latest_prediction_id())
+        if DASHBOARD_CACHE.get("key") == cache_key:
+            return DASHBOARD_CACHE["html"]
+
+        reference_data = SERVICE.reference[DASHBOARD_DATASET]
+        column_mapping = SERVICE.column_mapping[DASHBOARD_DATASET]
+        collected_data = get_data_from_db(list(reference_data.columns), since)
+
+        if len(collected_data) < WINDOW_SIZE:
+            return "Not enough data to create report, please refresh after some time!"
 
-    return dashboard
+        data_drift_dashboard = Dashboard(
+            tabs=[DataDriftTab(verbose_level=1), CatTargetDriftTab(verbose_level=1)]
+        )
+
+        # Evidently drops the rows with missing values in place
+        data_drift_dashboard.calculate(
+            reference_data.copy(), collected_data, column_mapping=column_mapping
+        )
+
+        DASHBOARD_CACHE["key"] = cache_key
+        DASHBOARD_CACHE["html"] = data_drift_dashboard.html()
+        return DASHBOARD_CACHE["html"]
 
 
 @app.get("/dashboard")
 def data_drift():
     """api to get dashboard"""
+    if SERVICE is None:
+        return "Internal Server Error: service not found", 500
+
     return create_dashboard()
 
 
+@app.get("/history")
+def history():
+    """api to get the hourly aggregates of the predictions older than the retention
+    period"""
+    days = flask.request.args.get("days", 90, type=float)
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    return flask.jsonify(summarize_rollups(get_hourly_rollups(since)))
+
+
 if __name__ == "__main__":
     app.run(debug=True)
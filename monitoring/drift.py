@@ -0,0 +1,228 @@
+"""
+Drift tests of the monitoring windows against a precomputed reference profile.
+"""
+import os
+import pickle
+import hashlib
+import logging
+import dataclasses
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from window import window_columns
+
+if TYPE_CHECKING:
+    from evidently.pipeline.column_mapping import ColumnMapping
+
+
+# drift options of the Evidently monitors replaced by the reference profile
+PROFILE_MONITORS = ("data_drift", "cat_target_drift")
+DRIFT_THRESHOLD = 0.05
+DRIFT_SHARE = 0.5
+# numerical columns with few distinct values are tested with the chi-square test
+MAX_CATEGORIES = 5
+# changes of the profile layout invalidate the profiles cached on disk
+PROFILE_VERSION = 2
+
+
+@dataclasses.dataclass
+class FeatureProfile:
+    # feature type reported in the metrics labels, "num" or "cat"
+    feature_type: str
+    # sorted finite reference values, for the Kolmogorov-Smirnov test
+    sorted_values: Optional[np.ndarray] = None
+    # reference categories and their frequencies, for the chi-square test
+    categories: Optional[np.ndarray] = None
+    frequencies: Optional[np.ndarray] = None
+
+
+@dataclasses.dataclass
+class ReferenceProfile:
+    """Summary of a reference dataset, all that the drift tests need from it"""
+
+    key: str
+    size: int
+    # features tested by the data drift monitor
+    features: Dict[str, FeatureProfile]
+    target: Optional[str]
+    target_profile: Optional[FeatureProfile] = None
+
+
+def profile_feature(values: pd.Series, feature_type: str) -> FeatureProfile:
+    values = values.replace([np.inf, -np.inf], np.nan).dropna()
+
+    if feature_type == "num" and values.nunique() > MAX_CATEGORIES:
+        return FeatureProfile(
+            feature_type, sorted_values=np.sort(values.to_numpy(dtype=float))
+        )
+
+    counts = values.value_counts()
+    return FeatureProfile(
+        feature_type,
+        categories=counts.index.to_numpy(),
+        frequencies=counts.to_numpy() / counts.sum(),
+    )
+
+
+def reference_profile_key(
+    reference: pd.DataFrame, column_mapping: "ColumnMapping"
+) -> str:
+    """Hash of the reference content and of the profiled columns"""
+    digest = hashlib.sha256(
+        pd.util.hash_pandas_object(reference, index=False).to_numpy().tobytes()
+    )
+    profiled_columns = (
+        column_mapping.numerical_features,
+        column_mapping.categorical_features,
+        column_mapping.target,
+    )
+    digest.update(repr((PROFILE_VERSION, profiled_columns)).encode())
+    return digest.hexdigest()
+
+
+def build_reference_profile(
+    reference: pd.DataFrame, column_mapping: "ColumnMapping"
+) -> ReferenceProfile:
+    numerical_columns, other_columns = window_columns(
+        column_mapping, list(reference.columns)
+    )
+    target = column_mapping.target if column_mapping.target in other_columns else None
+    # as in Evidently, the data drift covers the mapped features only, the target
+    # is tested by the target drift
+    categorical_columns = [
+        column
+        for column in column_mapping.categorical_features or []
+        if column in other_columns
+    ]
+
+    # categorical features come first, as in the Evidently metrics
+    features = {
+        column: profile_feature(reference[column], "cat")
+        for column in categorical_columns
+    }
+    features.update(
+        {
+            column: profile_feature(reference[column], "num")
+            for column in numerical_columns
+        }
+    )
+
+    return ReferenceProfile(
+        key=reference_profile_key(reference, column_mapping),
+        size=len(reference),
+        features=features,
+        target=target,
+        target_profile=profile_feature(reference[target], "cat") if target else None,
+    )
+
+
+def load_reference_profile(
+    profile_file: str, reference: pd.DataFrame, column_mapping: "ColumnMapping"
+) -> ReferenceProfile:
+    """Load the reference profile cached on disk, rebuilding it when the reference
+    has changed"""
+    key = reference_profile_key(reference, column_mapping)
+
+    if os.path.exists(profile_file):
+        try:
+            with open(profile_file, "rb") as file:
+                profile = pickle.load(file)
+            if profile.key == key:
+                return profile
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Cannot read the reference profile %s", profile_file)
+
+    profile = build_reference_profile(reference, column_mapping)
+
+    try:
+        with open(profile_file, "wb") as file:
+            pickle.dump(profile, file)
+    except OSError:
+        logging.exception("Cannot cache the reference profile to %s", profile_file)
+
+    return profile
+
+
+def ks_p_value(sorted_reference: np.ndarray, current: np.ndarray) -> float:
+    """Two-sample Kolmogorov-Smirnov test against the sorted finite reference values,
+    with the exact or asymptotic p-value that Evidently gets from SciPy"""
+    current = current[np.isfinite(current)]
+    if len(current) == 0 or len(sorted_reference) == 0:
+        return np.nan
+
+    return float(stats.ks_2samp(sorted_reference, current).pvalue)
+
+
+def chi_square_p_value(
+    categories: np.ndarray, frequencies: np.ndarray, current: pd.Series
+) -> float:
+    """Chi-square goodness of fit of the current values to the reference frequencies"""
+    current = current.replace([np.inf, -np.inf], np.nan).dropna()
+    if len(current) == 0:
+        return np.nan
+
+    counts = current.value_counts()
+    if not counts.index.isin(categories).all():
+        # a category never seen in the reference
+        return 0.0
+
+    observed = counts.reindex(categories, fill_value=0).to_numpy()
+    expected = frequencies * len(current)
+    statistic = np.sum((observed - expected) ** 2 / expected)
+    return float(stats.chi2.sf(statistic, max(len(categories) - 1, 1)))
+
+
+class ProfileMonitoring:
+    """Data and target drift monitors computed against a reference profile.
+
+    They publish the metrics of the Evidently monitors of the same name, without
+    recomputing the reference statistics at every run.
+    """
+
+    def __init__(self, profile: ReferenceProfile, monitors: List[str]):
+        self.profile = profile
+        self.monitors = monitors
+
+    def p_value(self, feature: FeatureProfile, current: pd.Series) -> float:
+        if feature.sorted_values is not None:
+            return ks_p_value(feature.sorted_values, current.to_numpy(dtype=float))
+        return chi_square_p_value(feature.categories, feature.frequencies, current)
+
+    def metrics(
+        self, current_data: pd.DataFrame
+    ) -> Iterator[Tuple[str, Any, Dict[str, str]]]:
+        if "data_drift" in self.monitors:
+            p_values = {
+                name: self.p_value(feature, current_data[name])
+                for name, feature in self.profile.features.items()
+            }
+            n_drifted_features = sum(
+                p_value < DRIFT_THRESHOLD for p_value in p_values.values()
+            )
+            share_drifted_features = (
+                n_drifted_features / len(p_values) if p_values else 0.0
+            )
+
+            yield "data_drift:share_drifted_features", share_drifted_features, {}
+            yield "data_drift:n_drifted_features", n_drifted_features, {}
+            yield "data_drift:dataset_drift", share_drifted_features >= DRIFT_SHARE, {}
+
+            for name, p_value in p_values.items():
+                feature_type = self.profile.features[name].feature_type
+                yield "data_drift:p_value", p_value, dict(
+                    feature=name, feature_type=feature_type
+                )
+
+        if "cat_target_drift" in self.monitors and self.profile.target is not None:
+            # rows with any missing value are not counted, as in Evidently
+            current_data = current_data.replace([np.inf, -np.inf], np.nan).dropna()
+            target = self.profile.target_profile
+
+            yield "cat_target_drift:count", self.profile.size, dict(dataset="reference")
+            yield "cat_target_drift:count", len(current_data), dict(dataset="current")
+            yield "cat_target_drift:drift", self.p_value(
+                target, current_data[self.profile.target]
+            ), dict(kind="target")
@@ -0,0 +1,117 @@
+"""
+Background scheduler of the drift computations of the monitoring windows.
+"""
+import logging
+import datetime
+import threading
+import concurrent.futures.thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+import pandas as pd
+
+from window import RingBuffer
+
+
+class DriftScheduler:
+    """Submit a drift computation for each full window, once per calculation period.
+
+    The computations run on a snapshot of the window in a pool of threads. A dataset
+    whose computation is still running is skipped until it completes, the next one
+    then reports as lag the delay since it was due.
+    """
+
+    def __init__(
+        self,
+        calculate: Callable[[str, pd.DataFrame, datetime.datetime], None],
+        windows: Dict[str, RingBuffer],
+        lock: threading.Lock,
+        window_size: int,
+        calculation_period_sec: float = 15,
+        max_workers: int = 1,
+    ):
+        self.calculate = calculate
+        # windows of each dataset, guarded by the lock shared with the request handlers
+        self.windows = windows
+        self.lock = lock
+        self.window_size = window_size
+        self.calculation_period_sec = calculation_period_sec
+        self.next_run_time: Dict[str, datetime.datetime] = {}
+        # running drift computation of each dataset
+        self.running: Dict[str, Future] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="drift"
+        )
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Start the background thread submitting the due drift computations"""
+        threading.Thread(target=self.run, name="drift-scheduler", daemon=True).start()
+
+    def stop(self):
+        """Stop the background thread and the computations not started yet"""
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+    def shut_down(self) -> bool:
+        """Whether the computations can no longer be submitted, once stopped or when
+        the interpreter exits"""
+        # pylint: disable=protected-access
+        return (
+            self.stopped.is_set()
+            or self.executor._shutdown
+            or concurrent.futures.thread._shutdown
+        )
+
+    def run(self):
+        """Submit the due drift computations until stopped, the errors are logged"""
+        while not self.stopped.is_set():
+            try:
+                self.schedule()
+            except Exception as error:  # pylint: disable=broad-except
+                if isinstance(error, RuntimeError) and self.shut_down():
+                    logging.info("Drift scheduler stopped")
+                    return
+                logging.exception("Drift scheduling failed")
+
+            self.stopped.wait(min(1.0, self.calculation_period_sec))
+
+    def schedule(self, now: Optional[datetime.datetime] = None):
+        """Submit a drift computation, on a snapshot of the window, for each dataset
+        that is due"""
+        window_size = self.window_size
+        now = now or datetime.datetime.now()
+
+        with self.lock:
+            windows = list(self.windows.items())
+
+        for dataset_name, window in windows:
+            current_size = window.size
+
+            if current_size < window_size:
+                logging.debug(
+                    f"Not enough data for measurement: {current_size} of {window_size}."
+                    f" Waiting more data"
+                )
+                continue
+
+            running = self.running.get(dataset_name)
+
+            if running is not None and not running.done():
+                # the computation is late, the lag metric tracks by how much
+                continue
+
+            next_run_time = self.next_run_time.get(dataset_name)
+
+            if next_run_time is not None and next_run_time > now:
+                continue
+
+            with self.lock:
+                current_data = window.to_frame()
+
+            self.next_run_time[dataset_name] = now + datetime.timedelta(
+                seconds=self.calculation_period_sec
+            )
+            self.running[dataset_name] = self.executor.submit(
+                self.calculate, dataset_name, current_data, next_run_time or now
+            )
@@ -0,0 +1,167 @@
+"""testing module for the drift tests against the reference profile"""
+
+import os
+import dataclasses
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from drift import (
+    ProfileMonitoring,
+    ks_p_value,
+    chi_square_p_value,
+    load_reference_profile,
+    build_reference_profile,
+)
+
+DATA_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "data.csv"
+)
+FEATURES = ["Age", "SystolicBP", "DiastolicBP", "BS", "BodyTemp", "HeartRate"]
+
+# metrics of the Evidently DataDriftMonitor and CatTargetDriftMonitor
+EVIDENTLY_METRICS = {
+    ("data_drift:share_drifted_features", ()),
+    ("data_drift:n_drifted_features", ()),
+    ("data_drift:dataset_drift", ()),
+    *(
+        ("data_drift:p_value", (("feature", feature), ("feature_type", "num")))
+        for feature in FEATURES
+    ),
+    ("cat_target_drift:count", (("dataset", "reference"),)),
+    ("cat_target_drift:count", (("dataset", "current"),)),
+    ("cat_target_drift:drift", (("kind", "target"),)),
+}
+
+
+@dataclasses.dataclass
+class ColumnMapping:
+    """Column mapping of the monitoring config, with the Evidently defaults"""
+
+    numerical_features: List[str]
+    categorical_features: Optional[List[str]] = None
+    target: str = "RiskLevel"
+    prediction: str = "prediction"
+
+
+def load_reference():
+    """Reference data of the monitoring service"""
+    reference = pd.read_csv(DATA_FILE)
+    reference["BodyTemp"] = (reference["BodyTemp"] - 32) * 5 / 9
+    return reference
+
+
+def metric_set(metrics):
+    """Names and labels of the emitted metrics"""
+    return {(name, tuple(sorted(labels.items()))) for name, _, labels in metrics}
+
+
+def test_ks_p_value():
+    """The KS p-value against the sorted reference is the SciPy one"""
+    rng = np.random.default_rng(1)
+    reference = rng.normal(size=1000)
+    for current in (rng.normal(size=50), rng.normal(0.5, size=50)):
+        expected = stats.ks_2samp(reference, current).pvalue
+        assert ks_p_value(np.sort(reference), current) == pytest.approx(expected)
+
+    current = np.append(rng.normal(size=50), [np.nan, np.inf])
+    expected = stats.ks_2samp(reference, current[:50]).pvalue
+    assert ks_p_value(np.sort(reference), current) == pytest.approx(expected)
+    assert np.isnan(ks_p_value(np.sort(reference), np.array([np.nan])))
+
+
+def test_chi_square_p_value():
+    """The chi-square p-value of the current counts against the reference
+    frequencies"""
+    categories = np.array(["low risk", "mid risk", "high risk"])
+    frequencies = np.array([0.4, 0.33, 0.27])
+    current = pd.Series(["low risk"] * 20 + ["mid risk"] * 20 + ["high risk"] * 10)
+
+    expected = stats.chisquare([20, 20, 10], frequencies * 50).pvalue
+    assert chi_square_p_value(categories, frequencies, current) == pytest.approx(
+        expected
+    )
+    # a category missing from the current values counts as observed 0 times
+    expected = stats.chisquare([30, 20, 0], frequencies * 50).pvalue
+    current = pd.Series(["low risk"] * 30 + ["mid risk"] * 20 + [None])
+    assert chi_square_p_value(categories, frequencies, current) == pytest.approx(
+        expected
+    )
+    # a category never seen in the reference
+    current = pd.Series(["low risk", "unknown"])
+    assert chi_square_p_value(categories, frequencies, current) == 0.0
+
+
+def test_profile_metrics():
+    """The profile monitors emit the metrics of the Evidently monitors, the target
+    is not a data drift feature"""
+    reference = load_reference()
+    profile = build_reference_profile(reference, ColumnMapping(FEATURES))
+    assert list(profile.features) == FEATURES
+    assert profile.target == "RiskLevel"
+
+    current = reference.sample(50, random_state=1)
+    monitoring = ProfileMonitoring(profile, ["data_drift", "cat_target_drift"])
+    metrics = list(monitoring.metrics(current))
+
+    assert metric_set(metrics) == EVIDENTLY_METRICS
+    values = {(name, tuple(labels.values())): value for name, value, labels in metrics}
+    assert values[("cat_target_drift:count", ("reference",))] == len(reference)
+    assert values[("cat_target_drift:count", ("current",))] == 50
+    # a sample of the reference does not drift
+    assert values[("data_drift:n_drifted_features", ())] == 0
+    assert not values[("data_drift:dataset_drift", ())]
+    expected = stats.ks_2samp(reference["Age"], current["Age"]).pvalue
+    assert values[("data_drift:p_value", ("Age", "num"))] == pytest.approx(expected)
+
+
+def test_load_reference_profile(tmp_path):
+    """The profile is cached on disk and rebuilt when the reference changes"""
+    reference = load_reference()
+    profile_file = str(tmp_path / "profile.pkl")
+    profile = load_reference_profile(profile_file, reference, ColumnMapping(FEATURES))
+
+    cached = load_reference_profile(profile_file, reference, ColumnMapping(FEATURES))
+    assert cached.key == profile.key
+    assert cached.size == profile.size
+
+    changed = load_reference_profile(
+        profile_file, reference.iloc[1:], ColumnMapping(FEATURES)
+    )
+    assert changed.key != profile.key
+    assert changed.size == profile.size - 1
+
+
+def test_evidently_metrics():
+    """The profile monitors emit the metrics and p-values of the Evidently ones"""
+    column_mapping = pytest.importorskip("evidently.pipeline.column_mapping")
+    monitoring = pytest.importorskip("evidently.model_monitoring")
+
+    reference = load_reference()
+    current = reference.sample(50, random_state=2)
+    current["Age"] += 5
+    mapping = column_mapping.ColumnMapping(
+        numerical_features=FEATURES, target="RiskLevel"
+    )
+    evidently_monitoring = monitoring.ModelMonitoring(
+        monitors=[monitoring.DataDriftMonitor(), monitoring.CatTargetDriftMonitor()],
+        options=[],
+    )
+    evidently_monitoring.execute(reference, current, mapping)
+    expected = {
+        (metric.name, tuple(sorted(labels.items()))): value
+        for metric, value, labels in evidently_monitoring.metrics()
+    }
+
+    profile = build_reference_profile(reference, mapping)
+    metrics = ProfileMonitoring(profile, ["data_drift", "cat_target_drift"]).metrics(
+        current
+    )
+    values = {
+        (name, tuple(sorted(labels.items()))): value for name, value, labels in metrics
+    }
+    assert set(values) == set(expected) == EVIDENTLY_METRICS
+    for key, value in values.items():
+        assert value == pytest.approx(expected[key]), key
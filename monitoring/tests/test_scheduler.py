@@ -0,0 +1,120 @@
+"""testing module for the drift computation scheduler"""
+
+import logging
+import datetime
+import threading
+
+from window import RingBuffer
+from scheduler import DriftScheduler
+
+START = datetime.datetime(2022, 9, 1, 12)
+
+
+class Computations:
+    """Drift computations recording their window and scheduled time"""
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, dataset_name, current_data, scheduled_time):
+        self.calls.append((dataset_name, len(current_data), scheduled_time))
+        self.release.wait(5)
+
+
+def make_scheduler(rows=4, window_size=4):
+    """Scheduler of a dataset window holding some rows"""
+    window = RingBuffer(["Age"], [], capacity=window_size)
+    window.extend([{"Age": float(i)} for i in range(rows)])
+    computations = Computations()
+    scheduler = DriftScheduler(
+        computations,
+        {"dataset": window},
+        threading.Lock(),
+        window_size,
+        calculation_period_sec=10,
+    )
+    return scheduler, computations
+
+
+def seconds(value):
+    """Time after the start of the tests"""
+    return START + datetime.timedelta(seconds=value)
+
+
+def test_schedule_waits_for_full_window():
+    """No drift is computed before the window is full"""
+    scheduler, computations = make_scheduler(rows=3)
+    scheduler.schedule(START)
+    scheduler.executor.shutdown()
+    assert not computations.calls
+
+
+def test_schedule_once_per_period():
+    """A dataset is computed once per calculation period, on time"""
+    scheduler, computations = make_scheduler()
+    for time in (0, 5, 10, 15, 21):
+        scheduler.schedule(seconds(time))
+        scheduler.running["dataset"].result()
+
+    assert computations.calls == [
+        ("dataset", 4, seconds(0)),
+        ("dataset", 4, seconds(10)),
+        ("dataset", 4, seconds(20)),
+    ]
+    assert scheduler.next_run_time["dataset"] == seconds(31)
+
+
+def test_schedule_skips_running_computation():
+    """A late computation is not run twice, the next one reports the lag"""
+    scheduler, computations = make_scheduler()
+    computations.release.clear()
+    scheduler.schedule(seconds(0))
+    # the computation is still running when the next one is due
+    scheduler.schedule(seconds(12))
+    scheduler.schedule(seconds(25))
+    computations.release.set()
+    scheduler.running["dataset"].result()
+
+    scheduler.schedule(seconds(30))
+    scheduler.running["dataset"].result()
+    # scheduled 10 seconds after the first run, so it reports a 20 seconds lag
+    assert computations.calls == [
+        ("dataset", 4, seconds(0)),
+        ("dataset", 4, seconds(10)),
+    ]
+
+
+def test_run_logs_scheduling_errors(caplog):
+    """A scheduling error is logged and the scheduler keeps running"""
+    scheduler, _ = make_scheduler()
+    scheduler.calculation_period_sec = 0.01
+    errors = iter([RuntimeError("scheduling failed"), KeyError("dataset")])
+
+    def schedule():
+        error = next(errors, None)
+        if error is None:
+            scheduler.stopped.set()
+        else:
+            raise error
+
+    scheduler.schedule = schedule
+    with caplog.at_level(logging.INFO):
+        scheduler.run()
+
+    assert [record.message for record in caplog.records] == [
+        "Drift scheduling failed",
+        "Drift scheduling failed",
+    ]
+
+
+def test_run_stops_on_shutdown(caplog):
+    """The scheduler stops once its executor is shut down"""
+    scheduler, computations = make_scheduler()
+    scheduler.executor.shutdown()
+    with caplog.at_level(logging.INFO):
+        scheduler.run()
+
+    assert [record.message for record in caplog.records] == ["Drift scheduler stopped"]
+    assert not computations.calls
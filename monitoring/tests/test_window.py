@@ -0,0 +1,67 @@
+"""testing module for the monitoring windows"""
+
+import numpy as np
+import pandas as pd
+from window import RingBuffer, window_columns
+
+
+def make_rows(start, stop):
+    """Rows with a numerical and a categorical column"""
+    return [{"Age": float(i), "RiskLevel": f"risk {i}"} for i in range(start, stop)]
+
+
+def test_ring_buffer_wraparound():
+    """The window keeps the latest rows in arrival order once it wraps around"""
+    window = RingBuffer(["Age"], ["RiskLevel"], capacity=4)
+    window.extend(make_rows(0, 3))
+    assert window.size == 3
+    assert window.to_frame()["Age"].tolist() == [0, 1, 2]
+
+    window.extend(make_rows(3, 6))
+    frame = window.to_frame()
+    assert window.size == 4
+    assert window.position == 2
+    assert frame["Age"].tolist() == [2, 3, 4, 5]
+    assert frame["RiskLevel"].tolist() == ["risk 2", "risk 3", "risk 4", "risk 5"]
+
+
+def test_ring_buffer_bulk_larger_than_capacity():
+    """Only the latest rows of a bulk larger than the window are kept"""
+    window = RingBuffer(["Age"], ["RiskLevel"], capacity=4)
+    window.extend(make_rows(0, 1))
+    window.extend(pd.DataFrame(make_rows(1, 11)))
+
+    frame = window.to_frame()
+    assert window.size == 4
+    assert frame["Age"].tolist() == [7, 8, 9, 10]
+    assert frame["RiskLevel"].tolist() == ["risk 7", "risk 8", "risk 9", "risk 10"]
+
+    window.extend(make_rows(11, 12))
+    assert window.to_frame()["Age"].tolist() == [8, 9, 10, 11]
+
+
+def test_ring_buffer_missing_values():
+    """Missing columns of a record are stored as missing values"""
+    window = RingBuffer(["Age"], ["RiskLevel"], capacity=2)
+    window.extend([{"Age": 20.0}, {"RiskLevel": "low risk"}])
+
+    frame = window.to_frame()
+    assert np.isnan(frame["Age"][1])
+    assert pd.isna(frame["RiskLevel"][0])
+    assert frame["RiskLevel"][1] == "low risk"
+
+
+def test_window_columns():
+    """The target is kept apart from the numerical features"""
+
+    class Mapping:  # pylint: disable=too-few-public-methods
+        """Column mapping with the Evidently defaults"""
+
+        numerical_features = ["Age", "BS", "Unknown"]
+        categorical_features = None
+        target = "RiskLevel"
+        prediction = "prediction"
+
+    numerical, other = window_columns(Mapping(), ["Age", "BS", "RiskLevel"])
+    assert numerical == ["Age", "BS"]
+    assert other == ["RiskLevel"]
@@ -0,0 +1,85 @@
+"""
+Column-oriented windows of the latest rows of the monitored datasets.
+"""
+from typing import TYPE_CHECKING, Any, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+    from evidently.pipeline.column_mapping import ColumnMapping
+
+
+class RingBuffer:
+    """Fixed-size, column-oriented window of the latest rows.
+
+    Rows are written in place into preallocated NumPy arrays, so adding rows costs
+    O(rows added) whatever the window size. A DataFrame is only built on demand.
+    """
+
+    def __init__(
+        self, numerical_columns: List[str], other_columns: List[str], capacity: int
+    ):
+        self.capacity = capacity
+        self.columns = numerical_columns + other_columns
+        self.data: Dict[str, np.ndarray] = {
+            column: np.full(capacity, np.nan) for column in numerical_columns
+        }
+        self.data.update(
+            {column: np.empty(capacity, dtype=object) for column in other_columns}
+        )
+        # index of the next row to write
+        self.position = 0
+        self.size = 0
+
+    def extend(self, rows: Union[pd.DataFrame, List[Dict[str, Any]]]):
+        """Add a single or a bulk of rows, given as a DataFrame or a list of records"""
+        rows_count = len(rows)
+        if rows_count == 0:
+            return
+
+        # only the latest rows fitting in the window are written
+        skip = max(rows_count - self.capacity, 0)
+        indices = (self.position + np.arange(rows_count - skip)) % self.capacity
+
+        for column in self.columns:
+            if isinstance(rows, pd.DataFrame):
+                values = rows[column].to_numpy()[skip:]
+            else:
+                values = [row.get(column) for row in rows[skip:]]
+            self.data[column][indices] = values
+
+        self.position = (self.position + rows_count - skip) % self.capacity
+        self.size = min(self.size + rows_count, self.capacity)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Build a DataFrame of the window with rows in arrival order"""
+        indices = (self.position - self.size + np.arange(self.size)) % self.capacity
+        return pd.DataFrame(
+            {column: self.data[column][indices] for column in self.columns}
+        )
+
+
+def window_columns(column_mapping: "ColumnMapping", available_columns: List[str]):
+    """Split the mapped columns available in the reference into numerical and other
+    columns"""
+    numerical_columns = [
+        column
+        for column in column_mapping.numerical_features or []
+        if column in available_columns
+    ]
+    other_columns = list(column_mapping.categorical_features or [])
+
+    # target and prediction default to "target" and "prediction" even when not used
+    for column in (column_mapping.target, column_mapping.prediction):
+        if isinstance(column, str):
+            other_columns.append(column)
+        elif column:
+            other_columns.extend(column)
+
+    other_columns = [
+        column
+        for column in dict.fromkeys(other_columns)
+        if column in available_columns and column not in numerical_columns
+    ]
+    return numerical_columns, other_columns